@@ -26,13 +26,22 @@
 
 
 import asyncio
+import concurrent.futures
+import functools
+import gc
 import logging
 import os
+import random
 import signal
+import time
 
 from . import protocols
-from .smtp import Smtp
+from .config import Config
+from .control import TLS_CONTEXTS, set_ticket_keys
+from .smtp import ENGINES
 from .streams import StreamProtocol
+from .tls import HandshakeProtocol, SocketHandshakeProtocol
+from .utils import ktls_available, rss
 
 
 __all__ = ("Child",)
@@ -48,50 +57,304 @@ class Child:
 
     Each child process maintains a list of the internal
     :py:class:`asyncio.Server` instances it utilises. Each child also
-    maintains a list of all connections being managed by the child.
+    maintains a set of all connections being managed by the child.
     """
 
     _started = False
-    servers = []
-    """List of :py:class:`asyncio.Server` instances."""
+    stats_interval = 1
+    """Seconds between each report of the child's stats to it's worker."""
 
-    clients = []
-    """List of clients connected to this process."""
+    gc_thresholds = (10000, 20, 20)
+    """
+    Garbage collection thresholds used by children.
+
+    Most objects created for a connection are freed as soon as the connection
+    closes, so the youngest generation is collected far less often than
+    Python's default of every 700 allocations.
+    """
+
+    recycle_jitter = 0.1
+    """
+    The most a child's recycling limits are randomly raised by, as a fraction.
+
+    Children started at the same time reach their limits at different times,
+    so they are not all recycled at once.
+    """
 
-    def __init__(self, up_read, down_write, socks, idx):
+    def __init__(self, up_read, down_write, socks, idx, spare=False):
         """
         Initialise a child process.
 
         :param int up_read: A file descriptor for reading.
         :param int down_write: A file descriptor for writing.
         :param list socks: A list of sockets.
+        :param str idx: The number reference of the worker and child.
+        :param bool spare: Wait for a :const:`blackhole.protocols.SERVE`
+                           message before accepting connections. Default:
+                           ``False``.
         """
         self.up_read = up_read
         self.down_write = down_write
         self.socks = socks
         self.idx = idx
+        self.spare = spare
+        self.servers = []
+        self.clients = set()
+        self.snapshots = []
+        self.stats = protocols.Stats()
+        self.engine = None
+        self.writer = None
+        self.drain_task = None
+        self.executor = None
+        self.ktls = False
+        self.accepted = 0
+        self.max_connections, self.max_rss = self.recycle_limits()
+
+    def recycle_limits(self):
+        """
+        Get the connection and memory limits the child is recycled at.
+
+        https://kura.gg/blackhole/configuration.html#max-connections-per-child
+
+        https://kura.gg/blackhole/configuration.html#max-child-rss
+
+        :returns: The number of connections and resident memory in bytes,
+                  ``0`` for no limit.
+        :rtype: :py:obj:`tuple`
+        """
+        config = Config()
+
+        def jitter(limit):
+            extra = random.uniform(0, self.recycle_jitter)  # nosec
+            return int(limit * (1 + extra))
+
+        return (
+            jitter(config.max_connections_per_child),
+            jitter(config.max_child_rss),
+        )
+
+    @property
+    def connections(self):
+        """
+        The number of clients connected to this process.
+
+        :returns: Number of connected clients.
+        :rtype: :py:obj:`int`
+        """
+        return len(self.clients)
 
     def start(self):
         """Start the child process."""
         logger.debug(f"Starting child {self.idx}")
         self._started = True
+        gc.set_threshold(*self.gc_thresholds)
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
-        signal.signal(signal.SIGTERM, self.stop)
+        self.loop.add_signal_handler(signal.SIGTERM, self.drain)
         self.heartbeat_task = asyncio.Task(self.heartbeat())
         self.loop.run_forever()
         self.stop()
         os._exit(os.EX_OK)
 
     async def _start(self):
-        """Create an asyncio server for each socket."""
-        for sock in self.socks:
+        """
+        Create an asyncio server for each socket.
+
+        .. note::
+
+           A snapshot of the configuration is taken once for each listener
+           and shared by every connection to it, including the TLS context
+           used to upgrade connections with STARTTLS. --
+           https://kura.gg/blackhole/configuration.html#starttls
+
+           The servers of a spare child are created without accepting
+           connections, until it is told to with :meth:`serve`.
+
+           When ``tls_handshake_threads`` is set, the servers of
+           ``tls_listen`` sockets are created without TLS and each
+           connection's handshake is performed in the child's thread pool
+           by :meth:`handshake_protocol`. --
+           https://kura.gg/blackhole/configuration.html#tls-handshake-threads
+
+           The same is done when ``tls_ktls`` is enabled and supported, so
+           the handshake is performed on the connection's socket. --
+           https://kura.gg/blackhole/configuration.html#tls-ktls
+        """
+        config = Config()
+        self.engine = ENGINES[config.engine]
+        self.ktls = config.tls_ktls and ktls_available()
+        if config.tls_handshake_threads and any(s["ssl"] for s in self.socks):
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.tls_handshake_threads,
+                thread_name_prefix=f"child.{self.idx}.tls",
+            )
+        for idx, sock in enumerate(self.socks):
+            sock_name = sock["sock"].getsockname()
+            snapshot = config.snapshot(
+                sock_name[0],
+                sock_name[1],
+                sock.get("starttls"),
+            )
+            self.snapshots.append(snapshot)
+            factory = functools.partial(self.protocol, idx)
+            tls = sock["ssl"]
+            if tls is not None and (self.executor is not None or self.ktls):
+                factory = functools.partial(self.handshake_protocol, idx, tls)
+                tls = None
             server = await self.loop.create_server(
-                lambda: Smtp(self.clients),
-                **sock,
+                factory,
+                sock=sock["sock"],
+                ssl=tls,
+                start_serving=not self.spare,
             )
             self.servers.append(server)
 
+    async def serve(self):
+        """
+        Start accepting connections as a spare child.
+
+        .. note::
+
+           Called when a spare child receives a
+           :const:`blackhole.protocols.SERVE` message from it's worker, once
+           the child it is replacing has gone. --
+           https://kura.gg/blackhole/configuration.html#spare-children
+        """
+        if not self.spare:
+            return
+        self.spare = False
+        await self.server_task
+        for server in self.servers:
+            await server.start_serving()
+        logger.debug(f"child.{self.idx}: Spare child serving")
+        self.stats_task = asyncio.Task(self.report())
+
+    def protocol(self, idx):
+        """
+        Create a protocol instance for a new connection.
+
+        :param int idx: The index of the listener the connection was made to.
+        :returns: A protocol instance.
+        :rtype: :class:`blackhole.smtp.SmtpMixin`
+        """
+        self.accepted += 1
+        if self.max_connections and self.accepted == self.max_connections:
+            # Recycle once the connection has been made, so it is drained
+            # rather than lost.
+            self.loop.call_soon(self.recycle, f"{self.accepted} connections")
+        return self.engine(
+            self.clients,
+            snapshot=self.snapshots[idx],
+            stats=self.stats,
+        )
+
+    def handshake_protocol(self, idx, context):
+        """
+        Create a protocol that performs the TLS handshake.
+
+        https://kura.gg/blackhole/configuration.html#tls-handshake-threads
+
+        :param int idx: The index of the listener the connection was made to.
+        :param ssl.SSLContext context: The TLS context of the listener.
+        :returns: A protocol instance, that hands the connection to
+                  :meth:`protocol` once the handshake is complete.
+        :rtype: :class:`blackhole.tls.HandshakeProtocol` or
+                :class:`blackhole.tls.SocketHandshakeProtocol`
+
+        .. note::
+
+           With ``tls_ktls`` the handshake is performed on the connection's
+           socket, in a thread if ``tls_handshake_threads`` is set. --
+           https://kura.gg/blackhole/configuration.html#tls-ktls
+        """
+        cls = SocketHandshakeProtocol if self.ktls else HandshakeProtocol
+        return cls(
+            self.protocol(idx),
+            context,
+            self.executor,
+            self.snapshots[idx].timeout,
+            loop=self.loop,
+        )
+
+    def set_ticket_keys(self, keys):
+        """
+        Set the TLS session ticket keys of every listener.
+
+        https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+        :param bytes keys: The keys generated by the supervisor.
+        """
+        contexts = [sock.get(k) for sock in self.socks for k in TLS_CONTEXTS]
+        if not set_ticket_keys(contexts, keys):
+            logger.warning(
+                f"child.{self.idx}: Unable to set TLS session ticket keys",
+            )
+
+    def drain(self):
+        """
+        Stop accepting new connections and exit once clients have finished.
+
+        .. note::
+
+           Called when the child receives :py:obj:`signal.SIGTERM` or a
+           :const:`blackhole.protocols.DRAIN` message. Clients are
+           disconnected once their current transaction is complete, see
+           :meth:`finish`.
+        """
+        if self.drain_task is not None:
+            return
+        logger.debug(f"child.{self.idx}: Draining")
+        for _ in range(len(self.servers)):
+            server = self.servers.pop()
+            server.close()
+        self.drain_task = asyncio.ensure_future(self.finish())
+
+    def recycle(self, reason):
+        """
+        Ask the worker for a replacement and drain the child's clients.
+
+        :param str reason: Why the child is being recycled.
+
+        .. note::
+
+           Sends a :const:`blackhole.protocols.RECYCLE` message to the worker
+           before draining. A child is only recycled once.
+        """
+        if self.drain_task is not None:
+            return
+        logger.info(f"child.{self.idx}: Recycling after {reason}")
+        if self.writer is not None:
+            body = reason.encode("utf-8")
+            self.writer.write(protocols.frame(protocols.RECYCLE, body))
+        self.drain()
+
+    async def finish(self):
+        """
+        Wait for clients to finish and stop the child process.
+
+        .. note::
+
+           Clients still connected after ``drain_timeout`` seconds are cut
+           off. The number of clients that finished and that were cut off
+           are sent to the worker before the child stops. --
+           https://kura.gg/blackhole/configuration.html#drain-timeout
+        """
+        clients = self.connections
+        for client in tuple(self.clients):
+            transport = getattr(client, "transport", client)
+            transport.get_protocol().drain()
+        deadline = time.monotonic() + Config().drain_timeout
+        while self.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.stats.cut = self.connections
+        self.stats.drained = clients - self.stats.cut
+        logger.info(
+            f"child.{self.idx}: {self.stats.drained} clients drained, "
+            f"{self.stats.cut} cut off",
+        )
+        self.send_stats()
+        self.stop()
+
     def stop(self, *args, **kwargs):
         """
         Stop the child process.
@@ -101,12 +364,14 @@ def stop(self, *args, **kwargs):
         finally stops the process and exits.
         """
         self._started = False
-        for _ in range(len(self.clients)):
-            client = self.clients.pop()
+        for client in tuple(self.clients):
             client.close()
+        self.clients.clear()
         for _ in range(len(self.servers)):
             server = self.servers.pop()
             server.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
         self.heartbeat_task.cancel()
         self.server_task.cancel()
         for task in asyncio.all_tasks(self.loop):
@@ -125,10 +390,15 @@ async def heartbeat(self):
 
         .. note::
 
-           3 bytes are used in the communication channel.
+           Messages are framed with :const:`blackhole.protocols.HEADER`.
+
+           - :const:`blackhole.protocols.PING` -- replied to with a
+             :const:`blackhole.protocols.PONG`
+           - :const:`blackhole.protocols.DRAIN` -- :meth:`drain`
+           - :const:`blackhole.protocols.SERVE` -- :meth:`serve`
+           - :const:`blackhole.protocols.TICKETS` -- :meth:`set_ticket_keys`
 
-           - b'x01' -- :const:`blackhole.protocols.PING`
-           - b'x02' -- :const:`blackhole.protocols.PONG`
+           Spare children do not report their stats until they are serving.
 
            These message values are defined in the :mod:`blackhole.protocols`
            schema. Documentation is available at --
@@ -146,20 +416,64 @@ async def heartbeat(self):
         )
         reader = r_proto.reader
         writer = asyncio.StreamWriter(w_trans, w_proto, reader, self.loop)
+        self.writer = writer
         self.server_task = asyncio.Task(self._start())
+        if not self.spare:
+            self.stats_task = asyncio.Task(self.report())
 
         while self._started:
             try:
-                msg = await reader.read(3)
+                kind, body = await protocols.read_frame(reader)
             except:  # noqa
                 break
-            if msg == protocols.PING:
+            if kind == protocols.PING:
                 logger.debug(
                     f"child.{self.idx}.heartbeat: Ping request received from "
                     "parent",
                 )
-                writer.write(protocols.PONG)
-            await asyncio.sleep(5)
+                writer.write(protocols.frame(protocols.PONG))
+            elif kind == protocols.DRAIN:
+                self.drain()
+            elif kind == protocols.SERVE:
+                asyncio.ensure_future(self.serve())
+            elif kind == protocols.TICKETS:
+                self.set_ticket_keys(body)
         r_trans.close()
         w_trans.close()
+        if self.drain_task is not None:
+            # A recycled child is disconnected from it's worker while it is
+            # still draining, finish will stop the child.
+            await self.drain_task
         self.stop()
+
+    async def report(self):
+        """
+        Send the child's stats to it's worker.
+
+        .. note::
+
+           Sent every :attr:`stats_interval` seconds in a
+           :const:`blackhole.protocols.STATS` message. The event loop lag is
+           how much later than expected the child wakes up to send them.
+
+           The child is recycled, with :meth:`recycle`, if it's resident
+           memory is over it's limit.
+        """
+        while self._started:
+            slept = time.monotonic()
+            await asyncio.sleep(self.stats_interval)
+            lag = time.monotonic() - slept - self.stats_interval
+            self.stats.lag = max(lag, 0.0)
+            self.send_stats()
+            size = rss() if self.max_rss else 0
+            if size > self.max_rss:
+                self.recycle(f"reaching {size} bytes RSS")
+
+    def send_stats(self):
+        """Send a :const:`blackhole.protocols.STATS` message to the worker."""
+        if self.writer is None:
+            return
+        self.stats.connections = self.connections
+        self.stats.cpu = time.process_time()
+        body = self.stats.pack()
+        self.writer.write(protocols.frame(protocols.STATS, body))
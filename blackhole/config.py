@@ -26,6 +26,7 @@
 
 
 import argparse
+import collections
 import getpass
 import grp
 import inspect
@@ -36,12 +37,26 @@
 import pwd
 import socket
 import tempfile
+import types
 
 from .exceptions import ConfigException
-from .utils import Singleton, get_version, mailname
-
-
-__all__ = ("parse_cmd_args", "warn_options", "config_test", "Config")
+from .utils import (
+    Singleton,
+    available_cpus,
+    cpu_list,
+    get_version,
+    ktls_available,
+    mailname,
+)
+
+
+__all__ = (
+    "parse_cmd_args",
+    "warn_options",
+    "config_test",
+    "Config",
+    "ListenerConfig",
+)
 """Tuple all the things."""
 
 
@@ -149,6 +164,11 @@ def warn_options(config):
             "TLS is enabled but no Diffie Hellman ephemeral "
             "parameters file was provided.",
         )
+    if config.tls_ktls and not ktls_available():
+        logger.warning(
+            "tls_ktls is enabled but kernel TLS is not available, TLS "
+            "records are encrypted and decrypted by OpenSSL.",
+        )
     _compare_uid_and_gid(config)
 
 
@@ -195,6 +215,37 @@ def _compare_uid_and_gid(config):
         )
 
 
+class ListenerConfig(
+    collections.namedtuple(
+        "ListenerConfig",
+        (
+            "address",
+            "port",
+            "mailname",
+            "timeout",
+            "max_message_size",
+            "mode",
+            "delay",
+            "dynamic_switch",
+            "debug_sample",
+            "flags",
+            "starttls",
+        ),
+    ),
+):
+    """
+    A frozen snapshot of the options used to handle a connection.
+
+    Snapshots are taken once per listener with :meth:`Config.snapshot` and
+    shared by every connection to that listener.
+
+    ``starttls`` is the TLS context used to upgrade a connection to the
+    listener with STARTTLS, or :py:obj:`None` if STARTTLS is not available.
+    """
+
+    __slots__ = ()
+
+
 class Config(metaclass=Singleton):
     """
     Configuration module.
@@ -211,7 +262,52 @@ class Config(metaclass=Singleton):
     config_file = None
     """A file containing configuration values."""
 
+    restart_options = (
+        "listen",
+        "tls_listen",
+        "user",
+        "group",
+        "pidfile",
+        "tls_key",
+        "tls_cert",
+        "tls_dhparams",
+        "workers",
+        "min_workers",
+        "max_workers",
+        "reuse_port",
+        "supervisor_cpu_affinity",
+        "tls_ticket_rotation",
+        "tls_watch_interval",
+    )
+    """Options that can only be changed by restarting Blackhole."""
+
+    tls_flags = ("tls_cert", "tls_key")
+    """
+    Listener flags that configure a listener's TLS certificate and key.
+
+    They are not part of a listener's :class:`ListenerConfig` flags, so they
+    do not disable dynamic switching.
+    """
+
+    _restart_tests = (
+        "test_port",
+        "test_tls_port",
+        "test_ipv6_support",
+        "test_tls_ipv6_support",
+        "test_same_listeners",
+        "test_no_listeners",
+        "test_user",
+        "test_group",
+        "test_pidfile",
+        "test_tls_settings",
+        "test_tls_dhparams",
+        "test_workers",
+        "test_reuse_port",
+    )
+
     _workers = 1
+    _min_workers = 1
+    _max_workers = None
     _listen = []
     _tls_listen = []
     _user = None
@@ -225,6 +321,21 @@ class Config(metaclass=Singleton):
     _mode = "accept"
     _max_message_size = 512000
     _dynamic_switch = None
+    _engine = "stream"
+    _debug_sample = 1.0
+    _reuse_port = None
+    _heartbeat_interval = 15
+    _drain_timeout = 60
+    _worker_cpu_affinity = None
+    _supervisor_cpu_affinity = None
+    _spare_children = 0
+    _max_connections_per_child = 0
+    _max_child_rss = 0
+    _tls_ticket_rotation = 3600
+    _tls_handshake_threads = 0
+    _tls_sni = {}
+    _tls_watch_interval = 0
+    _tls_ktls = None
 
     def __init__(self, config_file=None):
         """
@@ -282,6 +393,50 @@ def load(self):
                     self.validate_option(line)
         return self
 
+    def reload(self):
+        """
+        Reload the configuration file.
+
+        https://kura.gg/blackhole/configuration.html#reloading
+
+        :raises ConfigException: When the configuration is invalid, the
+                                 running configuration is left unchanged.
+        :returns: Options in :attr:`restart_options` that were changed, these
+                  keep their running values.
+        :rtype: :py:obj:`list`
+
+        .. note::
+
+           Other options that are no longer in the configuration file are
+           reset to their default values.
+        """
+        running = dict(vars(self))
+        restart = [f"_{option}" for option in self.restart_options]
+        for attr in running:
+            if attr.startswith("_") and attr not in restart:
+                delattr(self, attr)
+        try:
+            self.load()
+            changed = []
+            for option, attr in zip(self.restart_options, restart):
+                if vars(self).get(attr) != running.get(attr):
+                    changed.append(option)
+                    vars(self).pop(attr, None)
+                    if attr in running:
+                        setattr(self, attr, running[attr])
+            members = inspect.getmembers(self, predicate=inspect.ismethod)
+            for name, method in members:
+                if (
+                    name.startswith("test_")
+                    and name not in self._restart_tests
+                ):
+                    method()
+        except (ConfigException, ValueError) as err:
+            vars(self).clear()
+            vars(self).update(running)
+            raise ConfigException(f"{err}") from err
+        return changed
+
     def validate_option(self, key):
         """
         Validate config option is actually... valid...
@@ -327,13 +482,69 @@ def workers(self):
            Default value is 1.
 
            A supervisor process will always exist separately from the workers.
+
+           When set to ``auto``, this is the number of workers started,
+           :attr:`min_workers`.
         """
+        if self.autoscale:
+            return self.min_workers
         return int(self._workers) or 1
 
     @workers.setter
     def workers(self, workers):
         self._workers = workers
 
+    @property
+    def autoscale(self):
+        """
+        Whether the number of workers is scaled with load.
+
+        https://kura.gg/blackhole/configuration.html#workers
+
+        :returns: Whether workers are scaled with load. Default: ``False``.
+        :rtype: :py:obj:`bool`
+
+        .. note::
+
+           Enabled by setting ``workers = auto``.
+        """
+        return str(self._workers).lower() == "auto"
+
+    @property
+    def min_workers(self):
+        """
+        The minimum number of workers when workers are scaled with load.
+
+        https://kura.gg/blackhole/configuration.html#min-workers
+
+        :returns: Minimum number of workers. Default: ``1``.
+        :rtype: :py:obj:`int`
+        """
+        return int(self._min_workers)
+
+    @min_workers.setter
+    def min_workers(self, workers):
+        self._min_workers = workers
+
+    @property
+    def max_workers(self):
+        """
+        The maximum number of workers when workers are scaled with load.
+
+        https://kura.gg/blackhole/configuration.html#max-workers
+
+        :returns: Maximum number of workers. Default: the number of
+                  processors or cores.
+        :rtype: :py:obj:`int`
+        """
+        if self._max_workers is None:
+            return multiprocessing.cpu_count()
+        return int(self._max_workers)
+
+    @max_workers.setter
+    def max_workers(self, workers):
+        self._max_workers = workers
+
     @property
     def listen(self):
         """
@@ -612,6 +823,341 @@ def dynamic_switch(self, switch):
             msg = f"{switch} is not valid. Options are true or false."
             raise ConfigException(msg)
 
+    @property
+    def engine(self):
+        """
+        The protocol engine used to handle SMTP connections.
+
+        https://kura.gg/blackhole/configuration.html#engine
+
+        :returns: A protocol engine. Default: ``stream``.
+        :rtype: :py:obj:`str`
+
+        .. note::
+
+           Defaults to 'stream'.
+           Options: 'stream' and 'callback'.
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        self._engine = engine.lower()
+
+    @property
+    def debug_sample(self):
+        """
+        The fraction of connections traced when debugging is enabled.
+
+        https://kura.gg/blackhole/configuration.html#debug-sample
+
+        :returns: A fraction of connections. Default: ``1.0``.
+        :rtype: :py:obj:`float`
+
+        .. note::
+
+           Allowed values are between 0.0 and 1.0. 1.0 traces every
+           connection.
+        """
+        return float(self._debug_sample)
+
+    @debug_sample.setter
+    def debug_sample(self, sample):
+        self._debug_sample = sample
+
+    @property
+    def reuse_port(self):
+        """
+        Give each worker it's own listening socket for each listener.
+
+        https://kura.gg/blackhole/configuration.html#reuse-port
+
+        :returns: Whether each worker has it's own sockets or not. Default:
+                  ``False``.
+        :rtype: :py:obj:`bool`
+
+        .. note::
+
+           Allowed values are :py:obj:`True` and :py:obj:`False`.
+           Default: :py:obj:`False`
+        """
+        if self._reuse_port is None:
+            return False
+        return self._reuse_port
+
+    @reuse_port.setter
+    def reuse_port(self, reuse):
+        if reuse.lower() == "false":
+            self._reuse_port = False
+        elif reuse.lower() == "true":
+            self._reuse_port = True
+        else:
+            msg = f"{reuse} is not valid. Options are true or false."
+            raise ConfigException(msg)
+
+    @property
+    def heartbeat_interval(self):
+        """
+        Interval in seconds between a worker pinging it's child.
+
+        https://kura.gg/blackhole/configuration.html#heartbeat-interval
+
+        :returns: Interval in seconds. Default: ``15``
+        :rtype: :py:obj:`int`
+
+        .. note::
+
+           A child that has not responded for twice this interval is
+           considered hung and is restarted. A child that exits is restarted
+           straight away.
+        """
+        return int(self._heartbeat_interval)
+
+    @heartbeat_interval.setter
+    def heartbeat_interval(self, interval):
+        self._heartbeat_interval = interval
+
+    @property
+    def drain_timeout(self):
+        """
+        Seconds a child waits for it's clients to finish when shutting down.
+
+        https://kura.gg/blackhole/configuration.html#drain-timeout
+
+        :returns: Grace period in seconds. Default: ``60``
+        :rtype: :py:obj:`int`
+
+        .. note::
+
+           Clients that are still connected after this period are
+           disconnected.
+        """
+        return int(self._drain_timeout)
+
+    @drain_timeout.setter
+    def drain_timeout(self, timeout):
+        self._drain_timeout = timeout
+
+    @property
+    def worker_cpu_affinity(self):
+        """
+        CPUs to pin each worker's child process to.
+
+        https://kura.gg/blackhole/configuration.html#worker-cpu-affinity
+
+        :returns: ``auto``, the CPUs for each worker in turn or
+                  :py:obj:`None` if children are not pinned. Default:
+                  :py:obj:`None`.
+        :rtype: :py:obj:`str`, :py:obj:`tuple` or :py:obj:`None`
+
+        .. note::
+
+           Set to ``auto`` to pin each child to a physical core of it's own,
+           or to a list of CPUs for each worker, separated by spaces, in the
+           Linux cpulist format, i.e. ``0,32 1,33 2-3``.
+        """
+        if self._worker_cpu_affinity is None:
+            return None
+        if self._worker_cpu_affinity.lower() == "auto":
+            return "auto"
+        return tuple(cpu_list(c) for c in self._worker_cpu_affinity.split())
+
+    @worker_cpu_affinity.setter
+    def worker_cpu_affinity(self, affinity):
+        self._worker_cpu_affinity = affinity
+
+    @property
+    def supervisor_cpu_affinity(self):
+        """
+        CPUs to pin the supervisor process to.
+
+        https://kura.gg/blackhole/configuration.html#supervisor-cpu-affinity
+
+        :returns: The CPUs or :py:obj:`None` if the supervisor is not
+                  pinned. Default: :py:obj:`None`.
+        :rtype: :py:obj:`tuple` or :py:obj:`None`
+        """
+        if self._supervisor_cpu_affinity is None:
+            return None
+        return cpu_list(self._supervisor_cpu_affinity)
+
+    @supervisor_cpu_affinity.setter
+    def supervisor_cpu_affinity(self, affinity):
+        self._supervisor_cpu_affinity = affinity
+
+    @property
+    def spare_children(self):
+        """
+        Standby children each worker keeps ready to replace it's child.
+
+        https://kura.gg/blackhole/configuration.html#spare-children
+
+        :returns: The number of spare children. Default: ``0``
+        :rtype: :py:obj:`int`
+
+        .. note::
+
+           Spare children are forked with their servers created but not
+           accepting connections, when a child exits or is restarted one of
+           it's worker's spares starts accepting connections straight away.
+        """
+        return int(self._spare_children)
+
+    @spare_children.setter
+    def spare_children(self, spares):
+        self._spare_children = spares
+
+    @property
+    def max_connections_per_child(self):
+        """
+        Connections a child accepts before it is recycled.
+
+        https://kura.gg/blackhole/configuration.html#max-connections-per-child
+
+        :returns: The number of connections, ``0`` to never recycle children
+                  because of the connections they have accepted. Default:
+                  ``0``
+        :rtype: :py:obj:`int`
+        """
+        return int(self._max_connections_per_child)
+
+    @max_connections_per_child.setter
+    def max_connections_per_child(self, connections):
+        self._max_connections_per_child = connections
+
+    @property
+    def max_child_rss(self):
+        """
+        Resident memory, in bytes, a child uses before it is recycled.
+
+        https://kura.gg/blackhole/configuration.html#max-child-rss
+
+        :returns: The resident set size, ``0`` to never recycle children
+                  because of the memory they use. Default: ``0``
+        :rtype: :py:obj:`int`
+        """
+        return int(self._max_child_rss)
+
+    @max_child_rss.setter
+    def max_child_rss(self, rss):
+        self._max_child_rss = rss
+
+    @property
+    def tls_ticket_rotation(self):
+        """
+        Seconds between each rotation of the TLS session ticket keys.
+
+        https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+        :returns: The rotation interval, ``0`` to never rotate the keys.
+                  Default: ``3600``
+        :rtype: :py:obj:`int`
+        """
+        return int(self._tls_ticket_rotation)
+
+    @tls_ticket_rotation.setter
+    def tls_ticket_rotation(self, interval):
+        self._tls_ticket_rotation = interval
+
+    @property
+    def tls_handshake_threads(self):
+        """
+        Threads each child performs TLS handshakes for ``tls_listen`` in.
+
+        https://kura.gg/blackhole/configuration.html#tls-handshake-threads
+
+        :returns: The number of threads, ``0`` to perform handshakes on the
+                  child's event loop. Default: ``0``
+        :rtype: :py:obj:`int`
+        """
+        return int(self._tls_handshake_threads)
+
+    @tls_handshake_threads.setter
+    def tls_handshake_threads(self, threads):
+        self._tls_handshake_threads = threads
+
+    @property
+    def tls_sni(self):
+        """
+        Certificates and keys presented to clients asking for a hostname.
+
+        https://kura.gg/blackhole/configuration.html#tls-sni
+
+        :returns: The certificate and key files, keyed by hostname. Default:
+                  ``{}``
+        :rtype: :py:obj:`dict`
+
+        .. note::
+
+           Hostnames are lower case, ``*.example.com`` matches any single
+           label in front of ``example.com``.
+        """
+        return self._tls_sni or {}
+
+    @tls_sni.setter
+    def tls_sni(self, names):
+        self._tls_sni = self._sni_names(names)
+
+    @property
+    def tls_watch_interval(self):
+        """
+        Seconds between each check of the TLS files for changes.
+
+        https://kura.gg/blackhole/configuration.html#tls-watch-interval
+
+        :returns: The interval, ``0`` to only reload the TLS files with the
+                  configuration. Default: ``0``
+        :rtype: :py:obj:`int`
+        """
+        return int(self._tls_watch_interval)
+
+    @tls_watch_interval.setter
+    def tls_watch_interval(self, interval):
+        self._tls_watch_interval = interval
+
+    @property
+    def tls_ktls(self):
+        """
+        Let the kernel encrypt and decrypt the records of TLS connections.
+
+        https://kura.gg/blackhole/configuration.html#tls-ktls
+
+        :returns: Whether kernel TLS is enabled or not. Default: ``False``.
+        :rtype: :py:obj:`bool`
+
+        .. note::
+
+           Allowed values are :py:obj:`True` and :py:obj:`False`.
+           Default: :py:obj:`False`
+        """
+        if self._tls_ktls is None:
+            return False
+        return self._tls_ktls
+
+    @tls_ktls.setter
+    def tls_ktls(self, ktls):
+        if ktls.lower() == "false":
+            self._tls_ktls = False
+        elif ktls.lower() == "true":
+            self._tls_ktls = True
+        else:
+            msg = f"{ktls} is not valid. Options are true or false."
+            raise ConfigException(msg)
+
+    def tls_files(self, flags=None):
+        """
+        Get the TLS certificate and key of a listener.
+
+        :param dict flags: The flags of the listener. Default: ``None``.
+        :returns: The certificate and key set with the listener's flags,
+                  otherwise ``tls_cert`` and ``tls_key``.
+        :rtype: :py:obj:`tuple`
+        """
+        flags = flags or {}
+        if "tls_cert" in flags or "tls_key" in flags:
+            return flags.get("tls_cert"), flags.get("tls_key")
+        return self.tls_cert, self.tls_key
+
     def _convert_port(self, port):
         """
         Convert a port from the configuration files' string to an integer.
@@ -658,6 +1204,63 @@ def _listeners(self, listeners):
             clisteners.append(host)
         return clisteners
 
+    def _sni_names(self, names):
+        """
+        Convert the tls_sni line from the configuration to usable values.
+
+        :param str names: Hostnames, each followed by a certificate and key,
+                          separated by commas. -- e.g.
+                          'mx.example.com tls_cert=/mx.crt tls_key=/mx.key'
+        :returns: The certificate and key files, keyed by hostname.
+        :rtype: :py:obj:`dict`
+        """
+        sni = {}
+        for name in names.split(","):
+            parts = name.split()
+            if len(parts) == 0:
+                continue
+            flags = self.create_flags(parts[1:])
+            sni[parts[0].lower()] = (
+                flags.get("tls_cert"),
+                flags.get("tls_key"),
+            )
+        return sni
+
+    def snapshot(self, addr=None, port=None, starttls=None):
+        """
+        Take a frozen snapshot of the options used to handle a connection.
+
+        :param str addr: The listener host address. Default: ``None``.
+        :param int port: The listener port. Default: ``None``.
+        :param starttls: The TLS context used for STARTTLS. Default:
+                         ``None``.
+        :type starttls: :py:obj:`None` or :py:class:`ssl.SSLContext`
+        :returns: A snapshot of the options, including the flags defined for
+                  the listener when an address and port are provided.
+        :rtype: :class:`ListenerConfig`
+        """
+        flags = {}
+        if addr is not None:
+            flags = self.flags_from_listener(addr, port)
+            flags = {
+                flag: value
+                for flag, value in flags.items()
+                if flag not in self.tls_flags
+            }
+        return ListenerConfig(
+            address=addr,
+            port=port,
+            mailname=self.mailname,
+            timeout=self.timeout,
+            max_message_size=self.max_message_size,
+            mode=self.mode,
+            delay=self.delay,
+            dynamic_switch=self.dynamic_switch,
+            debug_sample=self.debug_sample,
+            flags=types.MappingProxyType(flags),
+            starttls=starttls,
+        )
+
     def flags_from_listener(self, addr, port):
         """
         Get a list of flags defined for the provided listener.
@@ -720,6 +1323,8 @@ def create_flags(self, parts):
                         flags.update(self._flag_mode(flag, value))
                     elif flag == "delay":
                         flags.update(self._flag_delay(flag, value))
+                elif flag in self.tls_flags:
+                    flags[flag] = value
         return flags
 
     def _flag_mode(self, flag, value):
@@ -802,12 +1407,26 @@ def test_workers(self):
         .. note::
 
            Cannot have more workers than number of processors or cores.
+
+           When workers are scaled with load, the minimum must be at least 1
+           and cannot be more than the maximum.
         """
+        try:
+            workers = self.max_workers if self.autoscale else self.workers
+            min_workers = self.min_workers
+        except ValueError:
+            msg = "Workers must be a number or auto."
+            raise ConfigException(msg)
         cpus = multiprocessing.cpu_count()
-        if self.workers > cpus:
+        if workers > cpus:
             msg = (
                 "Cannot have more workers than number of processors or "
-                f"cores. {self.workers} workers > {cpus} processors/cores."
+                f"cores. {workers} workers > {cpus} processors/cores."
+            )
+            raise ConfigException(msg)
+        if self.autoscale and not 1 <= min_workers <= workers:
+            msg = (
+                "min_workers must be at least 1 and no more than max_workers."
             )
             raise ConfigException(msg)
 
@@ -1024,20 +1643,72 @@ def test_tls_settings(self):
         .. note::
 
            Verifies if you provide all TLS settings, not just some.
+
+           A certificate and key without a TLS port is valid, STARTTLS is
+           offered on the ``listen`` ports instead. --
+           https://kura.gg/blackhole/configuration.html#starttls
+
+           A listener with it's own ``tls_cert`` and ``tls_key`` flags does
+           not need ``tls_cert`` and ``tls_key`` to be set. --
+           https://kura.gg/blackhole/configuration.html#listener-certificates
         """
-        port = True
-        if not len(self.tls_listen) > 0:
-            port = False
+        msg = (
+            "To use TLS you must supply a port, certificate file and key file."
+        )
         cert = os.access(self.tls_cert, os.R_OK) if self.tls_cert else False
         key = os.access(self.tls_key, os.R_OK) if self.tls_key else False
-        if (port, cert, key) == (False, False, False):
-            return
-        if not all((port, cert, key)):
-            msg = (
-                "To use TLS you must supply a port, certificate file "
-                "and key file."
-            )
+        if cert != key:
             raise ConfigException(msg)
+        for addr, port, _, flags in self.listen + self.tls_listen:
+            if not any(flag in flags for flag in self.tls_flags):
+                continue
+            if not self._readable(*self.tls_files(flags)):
+                raise ConfigException(
+                    f"{addr}:{port} needs a readable tls_cert and tls_key.",
+                )
+        for _, __, ___, flags in self.tls_listen:
+            if not all(self.tls_files(flags)):
+                raise ConfigException(msg)
+
+    def test_tls_sni(self):
+        """
+        Validate the certificates and keys of each TLS SNI hostname.
+
+        :raises ConfigException: When a hostname does not have a readable
+                                 certificate and key.
+        """
+        for name, files in self.tls_sni.items():
+            if not self._readable(*files):
+                raise ConfigException(
+                    f"TLS SNI hostname {name} needs a readable tls_cert and "
+                    "tls_key.",
+                )
+
+    def test_tls_watch_interval(self):
+        """
+        Validate the interval between checks of the TLS files.
+
+        :raises ConfigException: When the interval is not a number or is
+                                 negative.
+        """
+        try:
+            interval = self.tls_watch_interval
+        except ValueError:
+            msg = f"{self._tls_watch_interval} is not a valid interval."
+            raise ConfigException(msg)
+        if interval < 0:
+            msg = "TLS watch interval cannot be negative."
+            raise ConfigException(msg)
+
+    def _readable(self, *paths):
+        """
+        Check that files are set and can be read.
+
+        :param str paths: The files.
+        :returns: ``True`` if every file is set and readable.
+        :rtype: :py:obj:`bool`
+        """
+        return all(path and os.access(path, os.R_OK) for path in paths)
 
     def test_tls_dhparams(self):
         """
@@ -1128,3 +1799,227 @@ def test_dynamic_switch(self):
         if self._dynamic_switch not in (True, False):
             msg = "Allowed dynamic_switch values are true and false."
             raise ConfigException(msg)
+
+    def test_engine(self):
+        """
+        Validate the protocol engine.
+
+        :raises ConfigException: When an invalid engine is configured.
+
+        .. note::
+
+           Valid options are: 'stream' and 'callback'.
+        """
+        if self.engine not in ("stream", "callback"):
+            msg = "Engine must be stream or callback."
+            raise ConfigException(msg)
+
+    def test_debug_sample(self):
+        """
+        Validate the debug sample is a fraction between 0.0 and 1.0.
+
+        :raises ConfigException: When the debug sample is not a number or is
+                                 outside of the allowed range.
+        """
+        try:
+            sample = self.debug_sample
+        except ValueError:
+            msg = f"{self._debug_sample} is not a valid fraction."
+            raise ConfigException(msg)
+        if not 0.0 <= sample <= 1.0:
+            msg = "Debug sample must be between 0.0 and 1.0."
+            raise ConfigException(msg)
+
+    def test_reuse_port(self):
+        """
+        Validate that SO_REUSEPORT is supported if reuse_port is enabled.
+
+        :raises ConfigException: When reuse_port is enabled and
+                                 :py:obj:`socket.SO_REUSEPORT` is not
+                                 supported, or workers are scaled with load.
+
+        .. note::
+
+           A worker's sockets are bound before privileges are dropped, so
+           sockets cannot be bound for workers that are started later.
+        """
+        if self.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            msg = "reuse_port is enabled but SO_REUSEPORT is not supported."
+            raise ConfigException(msg)
+        if self.reuse_port and self.autoscale:
+            msg = "reuse_port cannot be used with workers = auto."
+            raise ConfigException(msg)
+
+    def test_heartbeat_interval(self):
+        """
+        Validate the heartbeat interval is a positive number of seconds.
+
+        :raises ConfigException: When the heartbeat interval is not a number
+                                 or is less than 1 second.
+        """
+        try:
+            interval = self.heartbeat_interval
+        except ValueError:
+            msg = f"{self._heartbeat_interval} is not a valid interval."
+            raise ConfigException(msg)
+        if interval < 1:
+            msg = "Heartbeat interval must be at least 1 second."
+            raise ConfigException(msg)
+
+    def test_drain_timeout(self):
+        """
+        Validate the drain timeout is a number of seconds.
+
+        :raises ConfigException: When the drain timeout is not a number or is
+                                 negative.
+        """
+        try:
+            timeout = self.drain_timeout
+        except ValueError:
+            msg = f"{self._drain_timeout} is not a valid number of seconds."
+            raise ConfigException(msg)
+        if timeout < 0:
+            msg = "Drain timeout cannot be negative."
+            raise ConfigException(msg)
+
+    def test_worker_cpu_affinity(self):
+        """
+        Validate the CPUs the children are pinned to.
+
+        :raises ConfigException: When the CPUs are invalid or not available,
+                                 or CPU affinity is not supported.
+        """
+        try:
+            affinity = self.worker_cpu_affinity
+        except ValueError:
+            msg = f"{self._worker_cpu_affinity} is not a valid list of CPUs."
+            raise ConfigException(msg)
+        if affinity is None:
+            return
+        if not affinity:
+            msg = "worker_cpu_affinity must be auto or a list of CPUs."
+            raise ConfigException(msg)
+        cpus = () if affinity == "auto" else sum(affinity, ())
+        self._cpus_available("worker_cpu_affinity", cpus)
+
+    def test_supervisor_cpu_affinity(self):
+        """
+        Validate the CPUs the supervisor is pinned to.
+
+        :raises ConfigException: When the CPUs are invalid or not available,
+                                 or CPU affinity is not supported.
+        """
+        try:
+            cpus = self.supervisor_cpu_affinity
+        except ValueError:
+            msg = (
+                f"{self._supervisor_cpu_affinity} is not a valid list of CPUs."
+            )
+            raise ConfigException(msg)
+        if cpus is None:
+            return
+        self._cpus_available("supervisor_cpu_affinity", cpus)
+
+    def test_spare_children(self):
+        """
+        Validate the number of spare children.
+
+        :raises ConfigException: When the number of spare children is not a
+                                 number or is negative.
+        """
+        try:
+            spares = self.spare_children
+        except ValueError:
+            msg = f"{self._spare_children} is not a valid number of children."
+            raise ConfigException(msg)
+        if spares < 0:
+            msg = "Spare children cannot be negative."
+            raise ConfigException(msg)
+
+    def test_max_connections_per_child(self):
+        """
+        Validate the number of connections a child accepts.
+
+        :raises ConfigException: When the number of connections is not a
+                                 number or is negative.
+        """
+        try:
+            connections = self.max_connections_per_child
+        except ValueError:
+            msg = (
+                f"{self._max_connections_per_child} is not a valid number of "
+                "connections."
+            )
+            raise ConfigException(msg)
+        if connections < 0:
+            msg = "Maximum connections per child cannot be negative."
+            raise ConfigException(msg)
+
+    def test_max_child_rss(self):
+        """
+        Validate the resident memory a child uses.
+
+        :raises ConfigException: When the size is not a number or is
+                                 negative.
+        """
+        try:
+            rss = self.max_child_rss
+        except ValueError:
+            msg = f"{self._max_child_rss} is not a valid number of bytes."
+            raise ConfigException(msg)
+        if rss < 0:
+            msg = "Maximum child RSS cannot be negative."
+            raise ConfigException(msg)
+
+    def test_tls_ticket_rotation(self):
+        """
+        Validate the TLS session ticket key rotation interval.
+
+        :raises ConfigException: When the interval is not a number or is
+                                 negative.
+        """
+        try:
+            interval = self.tls_ticket_rotation
+        except ValueError:
+            msg = f"{self._tls_ticket_rotation} is not a valid interval."
+            raise ConfigException(msg)
+        if interval < 0:
+            msg = "TLS ticket rotation interval cannot be negative."
+            raise ConfigException(msg)
+
+    def test_tls_handshake_threads(self):
+        """
+        Validate the number of TLS handshake threads.
+
+        :raises ConfigException: When the number of threads is not a number
+                                 or is negative.
+        """
+        try:
+            threads = self.tls_handshake_threads
+        except ValueError:
+            msg = (
+                f"{self._tls_handshake_threads} is not a valid number of "
+                "threads."
+            )
+            raise ConfigException(msg)
+        if threads < 0:
+            msg = "TLS handshake threads cannot be negative."
+            raise ConfigException(msg)
+
+    def _cpus_available(self, option, cpus):
+        """
+        Validate that CPUs can be pinned to.
+
+        :param str option: The option the CPUs were configured with.
+        :param tuple cpus: The CPUs.
+        :raises ConfigException: When CPU affinity is not supported or a CPU
+                                 is not available.
+        """
+        if not hasattr(os, "sched_setaffinity"):
+            msg = f"{option} is set but CPU affinity is not supported."
+            raise ConfigException(msg)
+        missing = sorted(set(cpus) - available_cpus())
+        if missing:
+            _missing = ", ".join(str(cpu) for cpu in missing)
+            msg = f"{option} uses CPUs that are not available: {_missing}."
+            raise ConfigException(msg)
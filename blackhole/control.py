@@ -29,17 +29,37 @@
 except ImportError:  # pragma: no cover
     ssl = None
 
+try:  # pragma: no cover
+    import ctypes
+except ImportError:  # pragma: no cover
+    ctypes = None
+
+import functools
+import glob
 import grp
 import logging
 import os
 import pwd
 import socket
+import sys
 
 from .config import Config
 from .exceptions import BlackholeRuntimeException
-
-
-__all__ = ("pid_permissions", "server", "setgid", "setuid")
+from .utils import available_cpus, cpu_list, ktls_available
+
+
+__all__ = (
+    "pid_permissions",
+    "server",
+    "set_affinity",
+    "set_ticket_keys",
+    "setgid",
+    "setuid",
+    "sni_contexts",
+    "ticket_keys",
+    "tls_contexts",
+    "worker_cpus",
+)
 """Tuple all the things."""
 
 
@@ -59,12 +79,16 @@
 """Strong default TLS ciphers."""
 
 
-def _context(use_tls=False):
+def _context(use_tls=False, cert=None, key=None, sni=None):
     """
     Create a TLS context using the certificate, key and dhparams file.
 
     :param bool use_tls: Whether to create a TLS context or not.
                          Default: ``False``.
+    :param str cert: The certificate file. Default: ``tls_cert``.
+    :param str key: The key file. Default: ``tls_key``.
+    :param dict sni: TLS contexts to use for the hostnames clients ask for.
+                     Default: ``None``.
     :returns: A TLS context or ``None``.
     :rtype: :py:class:`ssl.SSLContext` or :py:obj:`None`.
 
@@ -85,12 +109,20 @@ def _context(use_tls=False):
        will be omitted from the context. --
        https://kura.gg/blackhole/configuration.html#command-line-options
        -- added in :ref:`2.0.13`
+
+       When ``sni`` is provided, clients asking for one of it's hostnames
+       are switched to that hostname's context. --
+       https://kura.gg/blackhole/configuration.html#tls-sni
+
+       :const:`OP_ENABLE_KTLS` is set when ``tls_ktls`` is enabled and
+       supported. --
+       https://kura.gg/blackhole/configuration.html#tls-ktls
     """
     if use_tls is False:
         return None
     config = Config()
     ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    ctx.load_cert_chain(config.tls_cert, config.tls_key)
+    ctx.load_cert_chain(cert or config.tls_cert, key or config.tls_key)
     ctx.options |= ssl.OP_NO_SSLv2
     ctx.options |= ssl.OP_NO_SSLv3
     ctx.options |= ssl.OP_NO_COMPRESSION
@@ -101,9 +133,86 @@ def _context(use_tls=False):
     ctx.set_ciphers(":".join(ciphers))
     if config.tls_dhparams:
         ctx.load_dh_params(config.tls_dhparams)
+    if sni:
+        ctx.sni_callback = functools.partial(_sni_callback, sni)
+    if config.tls_ktls and ktls_available():
+        ctx.options |= OP_ENABLE_KTLS
     return ctx
 
 
+def _sni_callback(contexts, sslobj, name, ctx):
+    """
+    Switch a connection to the TLS context of the hostname it asked for.
+
+    :param dict contexts: TLS contexts, keyed by hostname.
+    :param ssl.SSLObject sslobj: The TLS connection.
+    :param str name: The hostname the client asked for, or :py:obj:`None`.
+    :param ssl.SSLContext ctx: The TLS context of the listener.
+
+    .. note::
+
+       An exact match is used before a wildcard, ``*.example.com`` matches
+       ``mx.example.com`` but not ``example.com`` or ``a.mx.example.com``.
+       Connections asking for any other hostname keep the listener's
+       context.
+    """
+    if not name:
+        return None
+    name = name.lower()
+    found = contexts.get(name)
+    if found is None and "." in name:
+        found = contexts.get(f"*.{name.split('.', 1)[1]}")
+    if found is not None:
+        sslobj.context = found
+    return None
+
+
+def sni_contexts():
+    """
+    Create a TLS context for each TLS SNI hostname.
+
+    https://kura.gg/blackhole/configuration.html#tls-sni
+
+    :returns: TLS contexts, keyed by hostname.
+    :rtype: :py:obj:`dict`
+    """
+    config = Config()
+    return {
+        name: _context(use_tls=True, cert=cert, key=key)
+        for name, (cert, key) in config.tls_sni.items()
+    }
+
+
+def tls_contexts(use_tls=False, starttls=False, flags=None, sni=None):
+    """
+    Create the TLS and STARTTLS contexts of a listener.
+
+    :param bool use_tls: Whether to create a TLS context or not.
+                         Default: ``False``.
+    :param bool starttls: Whether to create a TLS context for upgrading
+                          connections with STARTTLS or not.
+                          Default: ``False``.
+    :param dict flags: The flags of the listener. Default: ``None``.
+    :param dict sni: TLS contexts to use for the hostnames clients ask for.
+                     Default: created from ``tls_sni``.
+    :returns: A TLS context and a STARTTLS context, either may be
+              :py:obj:`None`.
+    :rtype: :py:obj:`tuple`
+
+    .. note::
+
+       The listener's ``tls_cert`` and ``tls_key`` flags are used if set,
+       otherwise ``tls_cert`` and ``tls_key``. --
+       https://kura.gg/blackhole/configuration.html#listener-certificates
+    """
+    if sni is None and (use_tls or starttls):
+        sni = sni_contexts()
+    cert, key = Config().tls_files(flags)
+    ctx = _context(use_tls=use_tls, cert=cert, key=key, sni=sni)
+    starttls_ctx = _context(use_tls=starttls, cert=cert, key=key, sni=sni)
+    return ctx, starttls_ctx
+
+
 def _socket(addr, port, family):
     """
     Create a socket, bind and listen.
@@ -116,7 +225,9 @@ def _socket(addr, port, family):
     :rtype: :py:func:`socket.socket`
     :raises BlackholeRuntimeException: When a socket cannot be bound.
     """
-    sock = socket.socket(family, socket.SOCK_STREAM)
+    # IPPROTO_TCP is inherited by accepted sockets, allowing asyncio to set
+    # TCP_NODELAY on them.
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
@@ -137,7 +248,7 @@ def _socket(addr, port, family):
     return sock
 
 
-def server(addr, port, family, use_tls=False):
+def server(addr, port, family, use_tls=False, starttls=False, flags=None):
     """
     Socket and possibly a TLS context.
 
@@ -150,12 +261,115 @@ def server(addr, port, family, use_tls=False):
     :type family: :py:obj:`socket.AF_INET` or :py:obj:`socket.AF_INET6`.
     :param bool use_tls: Whether to create a TLS context or not.
                          Default: ``False``.
-    :returns: Bound socket, a TLS context if configured.
+    :param bool starttls: Whether to create a TLS context for upgrading
+                          connections with STARTTLS or not.
+                          Default: ``False``.
+    :param dict flags: The flags of the listener. Default: ``None``.
+    :returns: Bound socket, a TLS context and a STARTTLS context if
+              configured and the listener's flags.
     :rtype: :py:obj:`dict`
     """
     sock = _socket(addr, port, family)
-    ctx = _context(use_tls=use_tls)
-    return {"sock": sock, "ssl": ctx}
+    ctx, starttls_ctx = tls_contexts(use_tls, starttls, flags)
+    return {
+        "sock": sock,
+        "ssl": ctx,
+        "starttls": starttls_ctx,
+        "flags": flags or {},
+    }
+
+
+TICKET_KEYS_SIZE = 80
+"""
+The size of TLS session ticket keys in bytes.
+
+A 16 byte key name, 32 byte HMAC secret and 32 byte AES key, as expected by
+OpenSSL.
+"""
+
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 1 << 3)
+"""
+Let OpenSSL hand a connection's TLS records to the kernel.
+
+Only available in :py:mod:`ssl` from Python 3.12, the value is OpenSSL 3's
+``SSL_OP_ENABLE_KTLS``.
+"""
+
+TLS_CONTEXTS = ("ssl", "starttls")
+"""The TLS contexts in each dictionary returned by :func:`server`."""
+
+_SSL_CTRL_SET_TLSEXT_TICKET_KEYS = 59
+
+
+def ticket_keys():
+    """
+    Generate new TLS session ticket keys.
+
+    https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+    :returns: Random keys, :const:`TICKET_KEYS_SIZE` bytes long.
+    :rtype: :py:obj:`bytes`
+    """
+    return os.urandom(TICKET_KEYS_SIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def _ssl_ctx_ctrl():
+    """
+    Find OpenSSL's ``SSL_CTX_ctrl`` function.
+
+    :returns: The function or :py:obj:`None` if it cannot be called.
+    :rtype: :py:class:`ctypes._CFuncPtr` or :py:obj:`None`
+    """
+    if ssl is None or ctypes is None or sys.implementation.name != "cpython":
+        return None
+    for library in (getattr(ssl._ssl, "__file__", None), None):
+        try:
+            func = ctypes.CDLL(library).SSL_CTX_ctrl
+        except (AttributeError, OSError):
+            continue
+        func.restype = ctypes.c_long
+        func.argtypes = (
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_long,
+            ctypes.c_char_p,
+        )
+        return func
+    return None
+
+
+def set_ticket_keys(contexts, keys):
+    """
+    Set the keys used to encrypt and decrypt TLS session tickets.
+
+    https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+    :param contexts: TLS contexts, anything else is ignored.
+    :type contexts: :py:obj:`list`
+    :param bytes keys: Keys from :func:`ticket_keys`.
+    :returns: ``True`` if the keys were set on every context.
+    :rtype: :py:obj:`bool`
+
+    .. note::
+
+       :py:mod:`ssl` has no way to set the keys, so OpenSSL is called
+       directly. This is only possible with CPython, otherwise each context
+       keeps the keys OpenSSL generated when it was created.
+    """
+    ctrl = _ssl_ctx_ctrl()
+    if ctrl is None:
+        return False
+    for ctx in contexts:
+        if not isinstance(ctx, ssl.SSLContext):
+            continue
+        # The SSL_CTX pointer follows the object header of an SSLContext.
+        address = id(ctx) + object.__basicsize__
+        ssl_ctx = ctypes.c_void_p.from_address(address).value
+        cmd = _SSL_CTRL_SET_TLSEXT_TICKET_KEYS
+        if ctrl(ssl_ctx, cmd, len(keys), keys) != 1:
+            return False
+    return True
 
 
 def pid_permissions():
@@ -235,3 +449,84 @@ def setuid():
             f"You do not have permission to switch to user '{config.user}'.",
         )
         raise SystemExit(os.EX_NOPERM)
+
+
+def _cpu_order():
+    """
+    Order the available CPUs for pinning children to.
+
+    :returns: The CPUs.
+    :rtype: :py:obj:`list`
+
+    .. note::
+
+       One hardware thread of every physical core comes before any of their
+       siblings and CPUs are grouped by NUMA node, so children are spread
+       over physical cores and the children sharing a node are kept
+       together. Topology is read from ``/sys``, if it cannot be read the
+       CPUs are kept in number order.
+    """
+
+    def _key(cpu):
+        path = f"/sys/devices/system/cpu/cpu{cpu}"
+        try:
+            with open(f"{path}/topology/thread_siblings_list") as siblings:
+                thread = cpu_list(siblings.read().strip()).index(cpu)
+        except (OSError, ValueError):
+            thread = 0
+        nodes = glob.glob(f"{path}/node[0-9]*")
+        node = int(os.path.basename(nodes[0])[4:]) if nodes else 0
+        return thread, node, cpu
+
+    return sorted(available_cpus(), key=_key)
+
+
+def worker_cpus(idx):
+    """
+    Get the CPUs a worker's child process is pinned to.
+
+    https://kura.gg/blackhole/configuration.html#worker-cpu-affinity
+
+    :param str idx: The number reference of the worker.
+    :returns: The CPUs or :py:obj:`None` if the child is not pinned.
+    :rtype: :py:obj:`set` or :py:obj:`None`
+
+    .. note::
+
+       Workers are given the configured CPUs in turn, starting again from
+       the first once each has been used. With ``auto``, CPUs the supervisor
+       is pinned to are only used once every other CPU has a child.
+
+       If the supervisor is pinned and children are not, children are
+       allowed to use every available CPU rather than the supervisor's.
+    """
+    config = Config()
+    affinity = config.worker_cpu_affinity
+    if affinity is None:
+        if config.supervisor_cpu_affinity is None:
+            return None
+        return set(available_cpus())
+    if affinity == "auto":
+        reserved = config.supervisor_cpu_affinity or ()
+        cpus = _cpu_order()
+        cpus.sort(key=lambda cpu: cpu in reserved)
+        affinity = [(cpu,) for cpu in cpus]
+    return set(affinity[(int(idx) - 1) % len(affinity)])
+
+
+def set_affinity(cpus):
+    """
+    Pin the current process to a set of CPUs.
+
+    :param cpus: The CPUs or :py:obj:`None` to leave the process unpinned.
+    :type cpus: :py:obj:`set` or :py:obj:`None`
+    """
+    if cpus is None:
+        return
+    try:
+        available_cpus()
+        os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError) as err:
+        logger.warning(f"Unable to pin to CPUs {sorted(cpus)}: {err}")
+        return
+    logger.debug(f"Pinned to CPUs {sorted(cpus)}")
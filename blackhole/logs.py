@@ -26,13 +26,17 @@
 
 
 import logging
+import random
 from logging.config import dictConfig
 
 
-__all__ = ("configure_logs",)
+__all__ = ("Trace", "configure_logs", "trace")
 """Tuple all the things."""
 
 
+logger = logging.getLogger("blackhole.logs")
+
+
 DEBUG_FORMAT = (
     "[%(asctime)s] [%(levelname)s] blackhole.%(module)s: %(message)s"
 )
@@ -81,3 +85,59 @@ def configure_logs(args):
         LOG_CONFIG["handlers"]["default_handler"] = DEFAULT_HANDLER
         logger_handlers.append("default_handler")
     dictConfig(LOG_CONFIG)
+
+
+class Trace:
+    """Log the SMTP conversation of a single connection."""
+
+    __slots__ = ("peer",)
+
+    def __init__(self, peer):
+        """
+        Initialise the trace.
+
+        :param str peer: The client address, used to prefix each message.
+        """
+        self.peer = peer
+
+    def __call__(self, msg, *args):
+        """
+        Log a message about the connection.
+
+        :param str msg: The message, formatted with ``args`` only when it is
+                        written.
+        :param args: Arguments for the message.
+
+        .. note::
+
+           The peer is passed as an argument rather than put in the format
+           string, it can contain a ``%``, i.e. an IPv6 scope id.
+        """
+        logger.debug("[%s] " + msg, self.peer, *args)
+
+
+def trace(peername, sample=1.0):
+    """
+    Create a trace for a new connection, if it is to be traced.
+
+    :param peername: The client address, from the transport.
+    :type peername: :py:obj:`tuple` or :py:obj:`None`
+    :param float sample: The fraction of connections to trace.
+    :returns: A trace when debugging is enabled and the connection is
+              sampled, otherwise :py:obj:`None`.
+    :rtype: :class:`Trace` or :py:obj:`None`
+
+    .. note::
+
+       Protocol code only formats and logs a message when the connection has
+       a trace, so connections that are not traced do no logging work for
+       each line they send. --
+       https://kura.gg/blackhole/configuration.html#debug-sample
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return None
+    if random.random() >= sample:  # nosec
+        return None
+    if isinstance(peername, tuple):
+        return Trace(f"{peername[0]}:{peername[1]}")
+    return Trace(str(peername))
@@ -22,72 +22,462 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+
 """Communication protocols used by the worker and child processes."""
 
 
+import abc
 import asyncio
-import logging
+import collections
+import struct
 
 from .config import Config
+from .logs import trace
 
 
-__all__ = ("StreamReaderProtocol", "PING", "PONG")
+__all__ = (
+    "CallbackProtocol",
+    "ConnectionMixin",
+    "Stats",
+    "StreamReaderProtocol",
+    "DRAIN",
+    "HEADER",
+    "PING",
+    "PONG",
+    "RECYCLE",
+    "SERVE",
+    "STATS",
+    "TICKETS",
+    "frame",
+    "read_frame",
+)
 """Tuple all the things."""
 
 
-logger = logging.getLogger("blackhole.protocols")
+HEADER = struct.Struct("!BH")
+"""
+The header of each message between the worker and child processes.
 
+The message type and the length of the body that follows, in bytes.
+"""
 
-PING = b"x01"
-"""Protocol message used by the worker and child processes to communicate."""
+PING = 1
+"""Sent by a worker to check it's child is alive, with no body."""
 
-PONG = b"x02"
-"""Protocol message used by the worker and child processes to communicate."""
+PONG = 2
+"""Sent by a child in reply to a PING, with no body."""
 
+STATS = 3
+"""Sent by a child every second, with a packed :class:`Stats` body."""
 
-class StreamReaderProtocol(asyncio.StreamReaderProtocol):
-    """The class responsible for handling connections commands."""
+DRAIN = 5
+"""Sent by a worker to make it's child drain it's clients and exit."""
+
+SERVE = 7
+"""Sent by a worker to make a spare child start accepting connections."""
+
+RECYCLE = 8
+"""
+Sent by a child that has reached it's connection or memory limit.
+
+The body is the reason, i.e. ``b"10000 connections"``. The child drains it's
+clients and exits, it's worker replaces it.
+"""
+
+TICKETS = 9
+"""
+Sent by a worker when the supervisor rotates the TLS session ticket keys.
+
+The body is the keys, see :func:`blackhole.control.ticket_keys`.
+"""
+
+
+def frame(kind, body=b""):
+    """
+    Frame a message between the worker and child processes.
+
+    :param int kind: The message type, i.e. :const:`PING`.
+    :param bytes body: The body of the message. Default: ``b""``.
+    :returns: The framed message.
+    :rtype: :py:obj:`bytes`
+    """
+    return HEADER.pack(kind, len(body)) + body
+
+
+async def read_frame(reader):
+    """
+    Read a framed message between the worker and child processes.
+
+    :param asyncio.StreamReader reader: An object for reading data from the
+                                        pipe.
+    :returns: The message type and body.
+    :rtype: :py:obj:`tuple`
+    :raises asyncio.IncompleteReadError: When the pipe is closed.
+    """
+    kind, size = HEADER.unpack(await reader.readexactly(HEADER.size))
+    body = await reader.readexactly(size) if size else b""
+    return kind, body
+
+
+class Stats:
+    """
+    Counters kept by a child process and sent to it's worker.
+
+    Connections share their child's counters, which are packed in to the
+    body of a :const:`STATS` message every second.
+    """
 
-    def __init__(self, clients, loop=None):
+    __slots__ = (
+        "connections",
+        "messages",
+        "bytes",
+        "lag",
+        "cpu",
+        "drained",
+        "cut",
+        "codes",
+    )
+
+    _counters = struct.Struct("!IQQddII")
+    _code = struct.Struct("!HQ")
+
+    def __init__(self):
+        """Initialise the counters."""
+        self.connections = 0
+        self.messages = 0
+        self.bytes = 0
+        self.lag = 0.0
+        self.cpu = 0.0
+        self.drained = 0
+        self.cut = 0
+        self.codes = collections.Counter()
+
+    def pack(self):
         """
-        Initialise the protocol.
+        Pack the counters.
+
+        :returns: The packed counters.
+        :rtype: :py:obj:`bytes`
+
+        .. note::
+
+           The number of connections, messages received and bytes received,
+           the event loop lag and the CPU time used, both in seconds, the
+           number of clients that finished and that were cut off while
+           draining, followed by a count of each response code sent.
+        """
+        counters = self._counters.pack(
+            self.connections,
+            self.messages,
+            self.bytes,
+            self.lag,
+            self.cpu,
+            self.drained,
+            self.cut,
+        )
+        codes = b"".join(
+            self._code.pack(code, count) for code, count in self.codes.items()
+        )
+        return counters + codes
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Unpack counters packed with :meth:`pack`.
+
+        :param bytes data: The packed counters.
+        :returns: The counters.
+        :rtype: :class:`Stats`
+        """
+        stats, offset = cls(), cls._counters.size
+        (
+            stats.connections,
+            stats.messages,
+            stats.bytes,
+            stats.lag,
+            stats.cpu,
+            stats.drained,
+            stats.cut,
+        ) = cls._counters.unpack_from(data)
+        for code, count in cls._code.iter_unpack(data[offset:]):
+            stats.codes[code] = count
+        return stats
 
-        :param list clients: A list of connected clients.
+
+class ConnectionMixin:
+    """
+    Connection handling shared by the protocol engines.
+
+    .. note::
+
+       Connection state is kept in slots rather than an instance dictionary
+       and options are read from a :class:`blackhole.config.ListenerConfig`
+       snapshot shared by every connection to a listener, keeping the memory
+       used by each idle connection low.
+    """
+
+    __slots__ = (
+        "clients",
+        "config",
+        "connection_closed",
+        "loop",
+        "stats",
+        "transport",
+        "_connection_closed",
+        "_disable_dynamic_switching",
+        "_flags",
+        "_idle_handle",
+        "_interrupt",
+        "_last_activity",
+        "_pending",
+        "_read_waiter",
+        "_trace",
+    )
+
+    def _init_connection(self, clients, loop, snapshot, stats):
+        """
+        Initialise the state of a connection.
+
+        :param set clients: A set of connected clients.
         :param loop: The event loop to use.
         :type loop: :py:obj:`None` or
                     :py:class:`syncio.unix_events._UnixSelectorEventLoop`
+        :param snapshot: A snapshot of the options for the listener.
+        :type snapshot: :py:obj:`None` or
+                        :py:class:`blackhole.config.ListenerConfig`
+        :param stats: Counters shared by the connections to a child.
+        :type stats: :py:obj:`None` or :class:`Stats`
         """
-        logger.debug("init")
         self.loop = loop if loop is not None else asyncio.get_event_loop()
-        logger.debug("loop")
-        super().__init__(
-            asyncio.StreamReader(loop=self.loop),
-            client_connected_cb=self._client_connected_cb,
-            loop=self.loop,
-        )
-        logger.debug("super")
         self.clients = clients
-        self.config = Config()
-        logger.debug(self.config)
+        self.stats = stats if stats is not None else Stats()
+        self._pending = []
+        self._idle_handle = None
+        self._read_waiter = None
+        self._interrupt = None
+        self._connection_closed = False
+        self._last_activity = self.loop.time()
+        if snapshot is None:
+            snapshot = Config().snapshot()
+        self.config = snapshot
+        self._flags = snapshot.flags
+        self._disable_dynamic_switching = False
+        self._trace = None
+
+    @property
+    def fqdn(self):
+        """
+        The fully qualified domain name of the server.
+
+        :returns: The server's FQDN.
+        :rtype: :py:obj:`str`
+        """
         # This is not a nice way to do this but, socket.getfqdn silently fails
         # and crashes inbound connections when called after os.fork
-        self.fqdn = self.config.mailname
+        return self.config.mailname
 
     def flags_from_transport(self):
         """Adapt internal flags for the transport in use."""
-        # This has to be done here since passing it as part of init causes
-        # flags to become garbled and mixed up. Artifact of loop.create_server
-        sock = self.transport.get_extra_info("socket")
-        # Ideally this would use transport.get_extra_info('sockname') but that
-        # crashes the child process for some weird reason. Getting the socket
-        # and interacting directly does not cause a crash, hence...
-        sock_name = sock.getsockname()
-        flags = self.config.flags_from_listener(sock_name[0], sock_name[1])
-        if len(flags.keys()) > 0:
-            self._flags = flags
+        if self.config.address is None:
+            # This has to be done here since passing it as part of init causes
+            # flags to become garbled and mixed up. Artifact of
+            # loop.create_server
+            sock = self.transport.get_extra_info("socket")
+            # Ideally this would use transport.get_extra_info('sockname') but
+            # that crashes the child process for some weird reason. Getting
+            # the socket and interacting directly does not cause a crash,
+            # hence...
+            sock_name = sock.getsockname()
+            self.config = Config().snapshot(
+                sock_name[0],
+                sock_name[1],
+                self.config.starttls,
+            )
+            self._flags = self.config.flags
+        if len(self._flags.keys()) > 0:
             self._disable_dynamic_switching = True
-            logger.debug("Flags enabled, disabling dynamic switching")
-            logger.debug(f"Flags for this connection: {self._flags}")
+            if self._trace is not None:
+                self._trace("Flags enabled, disabling dynamic switching")
+                self._trace("Flags for this connection: %s", dict(self._flags))
+
+    @property
+    def tls(self):
+        """
+        Whether the connection is using TLS.
+
+        :returns: ``True`` for TLS listeners and connections upgraded with
+                  STARTTLS.
+        :rtype: :py:obj:`bool`
+        """
+        return self.transport.get_extra_info("sslcontext") is not None
+
+    async def start_tls(self, context):
+        """
+        Upgrade the connection to TLS.
+
+        :param ssl.SSLContext context: The TLS context to use.
+        :returns: ``True`` if the TLS handshake succeeded, otherwise the
+                  connection is closed and ``False`` is returned.
+        :rtype: :py:obj:`bool`
+
+        .. note::
+
+           Reading is paused while queued responses are written, so the
+           client's handshake is not read as plain text. Anything the client
+           sent before the handshake is discarded rather than handled as if
+           it had been sent over TLS. --
+           https://tools.ietf.org/html/rfc3207#section-4.2
+
+           The handshake must complete within the :ref:`timeout`. --
+           https://kura.gg/blackhole/configuration.html#timeout
+        """
+        self.transport.pause_reading()
+        await self.flush()
+        self._discard_buffer()
+        try:
+            transport = await self.loop.start_tls(
+                self.transport,
+                self,
+                context,
+                server_side=True,
+                ssl_handshake_timeout=self.config.timeout,
+            )
+        except OSError as err:
+            transport, exc = None, err
+        else:
+            exc = None
+        if transport is None:
+            if self._trace is not None:
+                self._trace("TLS handshake failed: %s", exc)
+            self.connection_lost(exc)
+            return False
+        if self._trace is not None:
+            self._trace("Upgraded to TLS")
+        self._replace_transport(transport)
+        return True
+
+    def connection_made(self, transport):
+        """
+        Start the idle timer for a new connection.
+
+        :param asyncio.transports.Transport transport: The transport class.
+
+        .. note::
+
+           Whether the connection is traced is decided here, once, using the
+           :ref:`debug_sample` option. --
+           https://kura.gg/blackhole/configuration.html#debug-sample
+        """
+        self._trace = trace(
+            transport.get_extra_info("peername"),
+            self.config.debug_sample,
+        )
+        ktls = transport.get_extra_info("ktls")
+        if self._trace is not None and ktls is not None:
+            self._trace("kTLS send: %s, receive: %s", ktls[0], ktls[1])
+        super().connection_made(transport)
+        self._last_activity = self.loop.time()
+        self._idle_handle = self.loop.call_at(
+            self._last_activity + self.config.timeout,
+            self._idle_timeout,
+        )
+
+    def data_received(self, data):
+        """
+        Record client activity.
+
+        :param bytes data: Data received from the client.
+        """
+        self._last_activity = self.loop.time()
+        super().data_received(data)
+
+    def connection_lost(self, exc):
+        """
+        Client connection is closed or lost.
+
+        :param exc exc: Exception.
+        """
+        if self._trace is not None:
+            self._trace("Peer disconnected")
+        super().connection_lost(exc)
+        self.connection_closed, self._connection_closed = True, True
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _idle_timeout(self):
+        """
+        Time out the client if it has been idle for too long.
+
+        .. note::
+
+           A single timer is kept per connection. Receiving data only
+           records the time, the timer checks that time when it fires and
+           re-arms itself if the client has been active since. --
+           https://kura.gg/blackhole/configuration.html#timeout
+        """
+        self._idle_handle = None
+        if self._connection_closed:
+            return
+        now = self.loop.time()
+        deadline = self._last_activity + self.config.timeout
+        if not self._reading:
+            deadline = now + self.config.timeout
+        elif now >= deadline:
+            self._expire()
+            return
+        self._idle_handle = self.loop.call_at(deadline, self._idle_timeout)
+
+    async def push(self, msg):
+        """
+        Write a response message to the client.
+
+        :param str msg: The message for the SMTP code
+        """
+        await self.send(f"{msg}\r\n".encode("utf-8"))
+
+    async def send(self, response):
+        """
+        Queue encoded response data for the client.
+
+        :param bytes response: One or more complete response lines.
+
+        .. note::
+
+           Responses are not written immediately. They are queued and written
+           together by :meth:`flush`, once every command the client has
+           pipelined has been handled. --
+           https://tools.ietf.org/html/rfc2920
+        """
+        if self._trace is not None:
+            self._trace("SEND %r", response)
+        self.stats.codes[int(response[:3])] += 1
+        self._pending.append(response)
+
+
+class StreamReaderProtocol(ConnectionMixin, asyncio.StreamReaderProtocol):
+    """The class responsible for handling connections commands."""
+
+    def __init__(self, clients, loop=None, snapshot=None, stats=None):
+        """
+        Initialise the protocol.
+
+        :param set clients: A set of connected clients.
+        :param loop: The event loop to use.
+        :type loop: :py:obj:`None` or
+                    :py:class:`syncio.unix_events._UnixSelectorEventLoop`
+        :param snapshot: A snapshot of the options for the listener.
+        :type snapshot: :py:obj:`None` or
+                        :py:class:`blackhole.config.ListenerConfig`
+        :param stats: Counters shared by the connections to a child.
+        :type stats: :py:obj:`None` or :class:`Stats`
+        """
+        self._init_connection(clients, loop, snapshot, stats)
+        super().__init__(
+            asyncio.StreamReader(loop=self.loop),
+            client_connected_cb=self._client_connected_cb,
+            loop=self.loop,
+        )
 
     def _client_connected_cb(self, reader, writer):
         """
@@ -100,7 +490,7 @@ def _client_connected_cb(self, reader, writer):
         """
         self._reader = reader
         self._writer = writer
-        self.clients.append(writer)
+        self.clients.add(writer)
 
     def connection_lost(self, exc):
         """
@@ -108,56 +498,440 @@ def connection_lost(self, exc):
 
         :param exc exc: Exception.
         """
-        logger.debug("Peer disconnected")
         super().connection_lost(exc)
-        self.connection_closed, self._connection_closed = True, True
-        try:
-            self.clients.remove(self._writer)
-        except ValueError:
-            pass
+        self.clients.discard(self._writer)
+
+    def _discard_buffer(self):
+        """Discard data received from the client but not yet read."""
+        self._reader._buffer.clear()
+
+    def _replace_transport(self, transport):
+        """
+        Use a new transport, after upgrading the connection to TLS.
+
+        :param asyncio.transports.Transport transport: The new transport.
+        """
+        self.transport = transport
+        self._transport = transport
+        self._over_ssl = True
+        self._reader._transport = transport
+        self._writer._transport = transport
+
+    @property
+    def _reading(self):
+        """Whether the connection is waiting for data from the client."""
+        return self._read_waiter is not None
+
+    def _expire(self):
+        """Cancel the pending read, timing the client out."""
+        self._interrupt_read(self.timeout)
+
+    def _interrupt_read(self, handler):
+        """
+        Cancel the pending read and run a handler instead.
+
+        :param handler: A coroutine function, i.e. :meth:`timeout`.
+        """
+        self._interrupt = handler
+        self._read_waiter.cancel()
 
     async def wait(self):
         """
         Wait for data from the client.
 
-        :returns: A line of received data.
-        :rtype: :py:obj:`str`
+        :returns: A line of received data or :py:obj:`None` if the client
+                  timed out.
+        :rtype: :py:obj:`bytes` or :py:obj:`None`
 
         .. note::
 
            Also handles client timeouts if they wait too long before sending
            data. -- https://kura.gg/blackhole/configuration.html#timeout
+
+           Queued responses are flushed before waiting, unless the client has
+           already pipelined another complete line. --
+           https://tools.ietf.org/html/rfc2920
         """
-        while not self.connection_closed:
-            try:
-                line = await asyncio.wait_for(
-                    self._reader.readline(),
-                    self.config.timeout,
-                )
-            except asyncio.TimeoutError:
-                await self.timeout()
-                return None
-            return line
+        if self.connection_closed:
+            return None
+        return await self._read(self._reader.readline())
+
+    async def wait_until(self, separator):
+        """
+        Wait for data from the client, up to and including a separator.
+
+        :param bytes separator: The separator to read up to.
+        :returns: Received data ending with `separator`, a partial chunk
+                  that does not contain `separator` or :py:obj:`None` if the
+                  client timed out or disconnected.
+        :rtype: :py:obj:`bytes` or :py:obj:`None`
+
+        .. note::
+
+           If `separator` is not found within the reader's buffer limit, the
+           data that has been searched is returned as a partial chunk rather
+           than raising, allowing large amounts of data to be consumed in
+           chunks. Any part of `separator` at the end of the buffer is kept
+           for the next call.
+        """
+        if self.connection_closed:
+            return None
+        try:
+            return await self._read(self._reader.readuntil(separator))
+        except asyncio.LimitOverrunError as err:
+            return await self._reader.readexactly(err.consumed)
+        except asyncio.IncompleteReadError as err:
+            return err.partial or None
+
+    async def _read(self, coro):
+        """
+        Flush queued responses and wait for a read from the client.
+
+        :param coro: A :py:class:`asyncio.StreamReader` read coroutine.
+        :returns: The result of `coro` or :py:obj:`None` on timeout.
+
+        .. note::
+
+           The idle timer cancels the read if the client does not send any
+           data within the configured timeout. --
+           https://kura.gg/blackhole/configuration.html#timeout
+        """
+        if self._pending and b"\n" not in self._reader._buffer:
+            await self.flush()
+        self._last_activity = self.loop.time()
+        self._read_waiter = asyncio.current_task(loop=self.loop)
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            if self._interrupt is None:
+                raise
+            await self._interrupt()
+            return None
+        finally:
+            self._read_waiter = None
 
     async def close(self):
         """Close the connection from the client."""
-        logger.debug("Closing connection")
+        if self._trace is not None:
+            self._trace("Closing connection")
         if self._writer:
-            try:
-                self.clients.remove(self._writer)
-            except ValueError:
-                pass
+            self.clients.discard(self._writer)
+            if self._pending:
+                self._writer.write(b"".join(self._pending))
+                self._pending.clear()
             self._writer.close()
             await self._writer.drain()
         self._connection_closed = True
 
-    async def push(self, msg):
+    async def flush(self):
+        """Write all queued responses to the client in a single write."""
+        if not self._pending:
+            return
+        self._writer.write(b"".join(self._pending))
+        self._pending.clear()
+        await self._writer.drain()
+
+
+class _Read:
+    """An awaitable used by :class:`CallbackProtocol` to wait for data."""
+
+    __slots__ = ("separator", "chunked")
+
+    def __init__(self, separator, chunked):
         """
-        Write a response message to the client.
+        Initialise a read request.
 
-        :param str msg: The message for the SMTP code
+        :param bytes separator: The separator to read up to.
+        :param bool chunked: Allow data without `separator` to be returned
+                             once more than the buffer limit is buffered.
         """
-        response = f"{msg}\r\n".encode("utf-8")
-        logger.debug(f"SEND {response}")
-        self._writer.write(response)
-        await self._writer.drain()
+        self.separator = separator
+        self.chunked = chunked
+
+    def __await__(self):
+        """Suspend the handler until the requested data is received."""
+        return (yield self)
+
+
+class CallbackProtocol(
+    ConnectionMixin,
+    asyncio.Protocol,
+    metaclass=abc.ABCMeta,
+):
+    """
+    The class responsible for handling connections commands with callbacks.
+
+    Unlike :class:`StreamReaderProtocol`, no stream reader, stream writer or
+    task is created for a connection. Received data is buffered and handled
+    in :meth:`data_received`. Each line is passed to a handler coroutine
+    which is stepped directly, most handlers never suspend and complete
+    without being scheduled at all.
+
+    A handler that waits for more data from the client, an AUTH
+    continuation or the DATA that follows a DATA command for instance, is
+    kept and resumed once that data is received. A handler that waits on a
+    future, such as a delay, is resumed when the future is done. Lines
+    received in the meantime are buffered and handled in order afterwards.
+
+    .. note::
+
+       Handlers are not run in a task, :py:func:`asyncio.current_task`
+       returns :py:obj:`None` while they run. Handlers can await futures,
+       i.e. :py:func:`asyncio.sleep`, but not anything that needs the
+       current task, such as :py:func:`asyncio.timeout` or, from Python
+       3.12, :py:func:`asyncio.wait_for`.
+    """
+
+    __slots__ = ("_blocked_on", "_buffer", "_handler", "_read_request")
+
+    _limit = 2**16
+    """The buffer limit, matching :py:class:`asyncio.StreamReader`."""
+
+    def __init__(self, clients, loop=None, snapshot=None, stats=None):
+        """
+        Initialise the protocol.
+
+        :param set clients: A set of connected clients.
+        :param loop: The event loop to use.
+        :type loop: :py:obj:`None` or
+                    :py:class:`syncio.unix_events._UnixSelectorEventLoop`
+        :param snapshot: A snapshot of the options for the listener.
+        :type snapshot: :py:obj:`None` or
+                        :py:class:`blackhole.config.ListenerConfig`
+        :param stats: Counters shared by the connections to a child.
+        :type stats: :py:obj:`None` or :class:`Stats`
+        """
+        self._init_connection(clients, loop, snapshot, stats)
+        self.transport = None
+        self._buffer = bytearray()
+        self._handler = None
+        self._read_request = None
+        self._blocked_on = None
+
+    def connection_made(self, transport):
+        """
+        Tie a connection to the protocol.
+
+        :param asyncio.transports.Transport transport: The transport class.
+        """
+        super().connection_made(transport)
+        self.transport = transport
+        self.clients.add(transport)
+
+    def data_received(self, data):
+        """
+        Buffer data received from the client and handle it.
+
+        :param bytes data: Data received from the client.
+        """
+        super().data_received(data)
+        self._buffer += data
+        self._process()
+
+    def connection_lost(self, exc):
+        """
+        Client connection is closed or lost.
+
+        :param exc exc: Exception.
+        """
+        super().connection_lost(exc)
+        if self._handler is not None and not self._handler.cr_running:
+            # A running handler, i.e. one whose STARTTLS handshake failed,
+            # can't be closed. It returns on it's own.
+            self._handler.close()
+            self._handler = None
+        self.clients.discard(self.transport)
+
+    def _discard_buffer(self):
+        """Discard data received from the client but not yet handled."""
+        self._buffer.clear()
+
+    def _replace_transport(self, transport):
+        """
+        Use a new transport, after upgrading the connection to TLS.
+
+        :param asyncio.transports.Transport transport: The new transport.
+        """
+        self.clients.discard(self.transport)
+        self.transport = transport
+        self.clients.add(transport)
+
+    def pause_writing(self):
+        """Stop reading from a client that is not reading its responses."""
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        """Resume reading once the client has read its responses."""
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    @property
+    def _reading(self):
+        """Whether the connection is waiting for data from the client."""
+        return self._handler is None or self._read_request is not None
+
+    def _expire(self):
+        """Abandon the current handler and time the client out."""
+        self._interrupt_read(self.timeout)
+
+    def _interrupt_read(self, handler):
+        """
+        Abandon the current handler and run another handler instead.
+
+        :param handler: A coroutine function, i.e. :meth:`timeout`.
+        """
+        if self._handler is not None:
+            self._handler.close()
+        self._read_request = None
+        self._run(handler())
+
+    def _run(self, handler):
+        """
+        Run a handler coroutine until it completes or suspends.
+
+        :param handler: The coroutine to run.
+        """
+        self._handler = handler
+        self._step()
+        self._process()
+
+    def _step(self, value=None):
+        """
+        Resume the current handler.
+
+        :param value: The value to resume the handler with.
+        """
+        try:
+            awaiting = self._handler.send(value)
+        except StopIteration:
+            self._handler = None
+            return
+        except BaseException:
+            self._handler = None
+            self.transport.close()
+            raise
+        if isinstance(awaiting, _Read):
+            self._read_request = awaiting
+        elif awaiting is None:
+            self._blocked_on = self.loop.call_soon(self._wakeup, None)
+        else:
+            awaiting._asyncio_future_blocking = False
+            awaiting.add_done_callback(self._wakeup)
+            self._blocked_on = awaiting
+
+    def _wakeup(self, future):
+        """
+        Resume a handler that was waiting on a future.
+
+        :param future: The future that is done or :py:obj:`None`.
+        """
+        if self._handler is None or self._connection_closed:
+            return
+        self._blocked_on = None
+        self._step()
+        self._process()
+
+    def _process(self):
+        """Hand buffered data to the current handler or dispatch lines."""
+        while not self._connection_closed and self._blocked_on is None:
+            if self._handler is None:
+                data = self._take(b"\n", False)
+            elif self._read_request is not None:
+                request = self._read_request
+                data = self._take(request.separator, request.chunked)
+            else:
+                break
+            if data is None:
+                if len(self._buffer) > self._limit:
+                    if self._trace is not None:
+                        self._trace("Line exceeds buffer limit, closing")
+                    self.transport.close()
+                break
+            if self._handler is None:
+                self._handler = self._handle_line(data)
+                self._step()
+            else:
+                self._read_request = None
+                self._step(data)
+        if self._reading and not self._connection_closed:
+            self._write_pending()
+
+    def _take(self, separator, chunked):
+        """
+        Remove data from the buffer, up to and including a separator.
+
+        :param bytes separator: The separator to read up to.
+        :param bool chunked: Return data without `separator` if more than the
+                             buffer limit is buffered.
+        :returns: The data or :py:obj:`None` if not enough data is buffered.
+        :rtype: :py:obj:`bytes` or :py:obj:`None`
+        """
+        end = self._buffer.find(separator)
+        if end != -1:
+            end += len(separator)
+        elif chunked and len(self._buffer) > self._limit:
+            end = len(self._buffer) - len(separator) + 1
+        else:
+            return None
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    @abc.abstractmethod
+    async def _handle_line(self, line):
+        """
+        Handle a line received from the client.
+
+        :param bytes line: The line, including the line ending.
+        """
+
+    async def wait(self):
+        """
+        Wait for data from the client.
+
+        :returns: A line of received data or :py:obj:`None` if the client
+                  has disconnected.
+        :rtype: :py:obj:`bytes` or :py:obj:`None`
+        """
+        if self._connection_closed:
+            return None
+        line = self._take(b"\n", False)
+        if line is None:
+            line = await _Read(b"\n", False)
+        return line
+
+    async def wait_until(self, separator):
+        """
+        Wait for data from the client, up to and including a separator.
+
+        :param bytes separator: The separator to read up to.
+        :returns: Received data ending with `separator`, a partial chunk
+                  that does not contain `separator` or :py:obj:`None` if the
+                  client has disconnected.
+        :rtype: :py:obj:`bytes` or :py:obj:`None`
+        """
+        if self._connection_closed:
+            return None
+        data = self._take(separator, True)
+        if data is None:
+            data = await _Read(separator, True)
+        return data
+
+    async def close(self):
+        """Close the connection from the client."""
+        if self._trace is not None:
+            self._trace("Closing connection")
+        self.clients.discard(self.transport)
+        self._write_pending()
+        self.transport.close()
+        self._connection_closed = True
+
+    async def flush(self):
+        """Write all queued responses to the client in a single write."""
+        self._write_pending()
+
+    def _write_pending(self):
+        """Write all queued responses to the transport."""
+        if self._pending:
+            self.transport.write(b"".join(self._pending))
+            self._pending.clear()
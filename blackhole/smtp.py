@@ -28,22 +28,28 @@
 import asyncio
 import base64
 import inspect
-import logging
 import random
+import types
 
-from .protocols import StreamReaderProtocol
+from .protocols import CallbackProtocol, StreamReaderProtocol
 from .utils import message_id
 
 
-__all__ = ("Smtp",)
+__all__ = ("CallbackSmtp", "ENGINES", "Smtp", "SmtpMixin")
 """Tuple all the things."""
 
 
-logger = logging.getLogger("blackhole.smtp")
+class SmtpMixin:
+    """
+    SMTP/SMTPS command handling shared by the protocol engines.
 
+    The engine, :class:`Smtp` or :class:`CallbackSmtp`, provides reading
+    from and writing to the client.
 
-class Smtp(StreamReaderProtocol):
-    """The class responsible for handling SMTP/SMTPS commands."""
+    https://kura.gg/blackhole/configuration.html#engine
+    """
+
+    __slots__ = ()
 
     _bounce_responses = {
         450: "Requested mail action not taken: mailbox unavailable",
@@ -59,48 +65,91 @@ class Smtp(StreamReaderProtocol):
     }
     """The response code and message for each bounce type."""
 
-    _delay = None
-    """The delay timer value."""
-
     _max_delay = 60
     """The maximum delay value in seconds. Cannot be more than 60 seconds."""
 
-    _mode = None
-    """The response mode to use."""
+    _verb_handlers = types.MappingProxyType({})
+    """Upper-cased SMTP verbs mapped to ``do_VERB`` handler names."""
 
-    _flags = {}
-    """Flags defined in each listen directive."""
+    _help_handlers = types.MappingProxyType({})
+    """Upper-cased SMTP verbs mapped to ``help_VERB`` handler names."""
 
-    _disable_dynamic_switching = False
-    """
-    This option disabled dynamic switching functionality.
+    _auth_handlers = types.MappingProxyType({})
+    """Upper-cased AUTH mechanisms mapped to ``auth_MECHANISM`` handlers."""
 
-    Dynamic switching will be disabled when mode= and delay= flags are
-    configured.
+    _auth_mechanisms = ()
+    """Available AUTH mechanisms, in the order they are advertised."""
 
-    https://kura.gg/blackhole/configuration.html#listen
-    https://kura.gg/blackhole/configuration.html#tls_listen
-    """
+    _help_verbs = ()
+    """Verbs with a help handler, in the order they are advertised."""
+
+    _response_cache = {}
+    """Pre-rendered responses, keyed by class, FQDN and maximum size."""
 
-    _failed_commands = 0
-    """An internal counter of failed commands for a client."""
+    def __init_subclass__(cls, **kwargs):
+        """Build the handler dispatch tables for a subclass."""
+        super().__init_subclass__(**kwargs)
+        cls._build_handler_tables()
 
-    def __init__(self, clients, loop=None):
+    @classmethod
+    def _build_handler_tables(cls):
+        """
+        Build immutable dispatch tables for verb, help and AUTH handlers.
+
+        The tables are built once when the class is created, rather than
+        introspecting the instance and formatting attribute names for every
+        line a client sends. Handlers are stored by name and resolved with
+        :py:func:`getattr` so subclasses and instances can still override
+        them.
+        """
+        verbs, helps, auths = {}, {}, {}
+        for name, _ in inspect.getmembers(cls, predicate=inspect.isfunction):
+            prefix, _, verb = name.partition("_")
+            if not verb:
+                continue
+            if prefix == "do":
+                verbs[verb] = name
+            elif prefix == "help" and verb != "UNKNOWN":
+                helps[verb] = name
+            elif prefix == "auth" and verb != "UNKNOWN":
+                auths[verb.replace("_", "-")] = name
+        cls._verb_handlers = types.MappingProxyType(verbs)
+        cls._help_handlers = types.MappingProxyType(helps)
+        cls._auth_handlers = types.MappingProxyType(auths)
+        cls._help_verbs = tuple(helps)
+        cls._auth_mechanisms = tuple(auths)
+
+    def __init__(self, clients, loop=None, snapshot=None, stats=None):
         """
         Initialise the SMTP protocol.
 
-        :param list clients: A list of connected clients.
+        :param set clients: A set of connected clients.
         :param loop: The event loop to use.
         :type loop: :py:obj:`None` or
                     :py:class:`syncio.unix_events._UnixSelectorEventLoop`
+        :param snapshot: A snapshot of the options for the listener.
+        :type snapshot: :py:obj:`None` or
+                        :py:class:`blackhole.config.ListenerConfig`
+        :param stats: Counters shared by the connections to a child.
+        :type stats: :py:obj:`None` or :class:`blackhole.protocols.Stats`
 
         .. note::
 
            Loads the configuration, defines the server's FQDN and generates
            an RFC 2822 Message-ID.
+
+           The delay and mode default to the configured values and can be
+           changed with dynamic switches, unless flags are defined for the
+           listener. -- https://kura.gg/blackhole/dynamic-switches.html
         """
-        super().__init__(clients, loop)
+        super().__init__(clients, loop, snapshot, stats)
         self.message_id = message_id(self.fqdn)
+        self._delay = None
+        self._mode = None
+        self._failed_commands = 0
+        self._busy = False
+        self._draining = False
+        self._in_transaction = False
 
     def connection_made(self, transport):
         """
@@ -109,11 +158,11 @@ def connection_made(self, transport):
         :param asyncio.transports.Transport transport: The transport class.
         """
         super().connection_made(transport)
-        logger.debug("Peer connected")
+        if self._trace is not None:
+            self._trace("Peer connected")
         self.transport = transport
         self.flags_from_transport()
         self.connection_closed = False
-        self._handler_coroutine = self.loop.create_task(self._handle_client())
 
     async def push(self, code, msg):
         """
@@ -125,27 +174,28 @@ async def push(self, code, msg):
         n_msg = f"{code} {msg}"
         await super().push(n_msg)
 
-    async def _handle_client(self):
+    async def _handle_line(self, line):
         """
-        Handle a client connection.
+        Handle a line sent by the client, passing off to the verb handler.
 
-        This method greets the client and then accepts and handles each line
-        the client sends, passing off to the correct verb handler.
+        :param bytes line: The line, including the line ending.
         """
-        await self.greet()
-        while not self.connection_closed:
-            line = await self.wait()
-            if line is None:
-                await self.close()
-                return
-            logger.debug(f"RECV {line}")
-            line = line.decode("utf-8").rstrip("\r\n")
-            self._line = line
-            handler = self.lookup_handler(line)
-            if handler:
-                await handler()
-            else:
-                await self.push(502, "5.5.2 Command not recognised")
+        if self._trace is not None:
+            self._trace("RECV %r", line)
+        line = line.decode("utf-8").rstrip("\r\n")
+        self._line = line
+        if self._draining and not self._in_transaction:
+            await self.shutdown()
+            return
+        self._busy = True
+        handler = self.lookup_handler(line)
+        if handler:
+            await handler()
+        else:
+            await self.push(502, "5.5.2 Command not recognised")
+        self._busy = False
+        if self._draining and not self._in_transaction:
+            await self.shutdown()
 
     def get_auth_members(self):
         """
@@ -154,13 +204,7 @@ def get_auth_members(self):
         :returns: A list of available authentication mechanisms.
         :rtype: :py:obj:`list`
         """
-        members = inspect.getmembers(self, predicate=inspect.ismethod)
-        cmds = []
-        for cmd, _ in members:
-            if cmd.startswith("auth_") and cmd != "auth_UNKNOWN":
-                cmd = cmd.replace("auth_", "").replace("_", "-")
-                cmds.append(cmd)
-        return cmds
+        return list(self._auth_mechanisms)
 
     def lookup_auth_handler(self, line):
         """
@@ -180,15 +224,14 @@ def lookup_auth_handler(self, line):
         if len(parts) < 2:
             return self.auth_UNKNOWN
         mechanism = parts[1].upper()
-        if mechanism == "CRAM-MD5":
-            return self.auth_CRAM_MD5
-        if mechanism not in self.get_auth_members():
+        handler = self._auth_handlers.get(mechanism)
+        if handler is None:
             return self.auth_UNKNOWN
         if len(parts) == 3 and mechanism == "PLAIN":
             if "fail=" in line:
                 return self._auth_failure
             return self._auth_success
-        return getattr(self, f"auth_{mechanism.upper()}", self.auth_UNKNOWN)
+        return getattr(self, handler)
 
     async def auth_UNKNOWN(self):
         """Response to an unknown auth mechanism."""
@@ -200,8 +243,7 @@ async def help_AUTH(self):
 
         https://kura.gg/blackhole/communicating-with-blackhole.html#help
         """
-        mechanisms = " ".join(self.get_auth_members())
-        await self.push(250, f"Syntax: AUTH {mechanisms}")
+        await self.send(self.responses["help_auth"])
 
     async def auth_LOGIN(self):
         """
@@ -225,7 +267,8 @@ async def auth_LOGIN(self):
         """
         await self.push(334, "VXNlcm5hbWU6")
         line = await self.wait()
-        logger.debug(f"RECV {line}")
+        if self._trace is not None:
+            self._trace("RECV %r", line)
         if b"fail=" in line.lower():
             await self._auth_failure()
         else:
@@ -254,7 +297,8 @@ async def auth_CRAM_MD5(self):
         emessage_id = base64.b64encode(self.message_id.encode("utf-8"), b"==")
         await self.push(334, emessage_id.decode("utf-8"))
         line = await self.wait()
-        logger.debug(f"RECV {line}")
+        if self._trace is not None:
+            self._trace("RECV %r", line)
         if b"fail=" in line.lower():
             await self._auth_failure()
         else:
@@ -287,7 +331,8 @@ async def auth_PLAIN(self):
         """
         await self.push(334, " ")
         line = await self.wait()
-        logger.debug(f"RECV {line}")
+        if self._trace is not None:
+            self._trace("RECV %r", line)
         if b"fail=" in line.lower():
             await self._auth_failure()
         else:
@@ -309,13 +354,43 @@ async def timeout(self):
 
         https://kura.gg/blackhole/configuration.html#timeout
         """
-        logger.debug(
-            f"Peer timed out, no data received for {self.config.timeout} "
-            "seconds",
-        )
+        if self._trace is not None:
+            self._trace(
+                "Peer timed out, no data received for %s seconds",
+                self.config.timeout,
+            )
         await self.push(421, "Timeout")
         await self.close()
 
+    def drain(self):
+        """
+        Close the connection once the client's current transaction is done.
+
+        .. note::
+
+           A client that is waiting to send a command, and is not part way
+           through a mail transaction, is disconnected straight away. Other
+           clients are disconnected as soon as their current command and
+           transaction are complete.
+        """
+        self._draining = True
+        if self._connection_closed or self._busy or self._in_transaction:
+            return
+        if self._reading:
+            self._interrupt_read(self.shutdown)
+
+    async def shutdown(self):
+        """
+        Close the connection because the server is shutting down.
+
+        Sends a 421 response to the client and closes the connection. --
+        https://tools.ietf.org/html/rfc5321#section-3.8
+        """
+        if self._trace is not None:
+            self._trace("Shutting down, closing connection")
+        await self.push(421, "4.3.2 Service shutting down")
+        await self.close()
+
     def lookup_handler(self, line):
         """
         Look up the SMTP VERB against a handler.
@@ -329,12 +404,12 @@ def lookup_handler(self, line):
         """
         parts = line.split(None, 1)
         if parts:
-            if parts[0].lower() == "help":
+            verb = parts[0].upper()
+            if verb == "HELP":
                 return self.lookup_help_handler(parts)
-            if parts[0].lower() == "auth":
+            if verb == "AUTH":
                 return self.lookup_auth_handler(line)
-            else:
-                return self.lookup_verb_handler(parts[0])
+            return getattr(self, self._verb_handlers.get(verb, "do_UNKNOWN"))
         return self.do_UNKNOWN
 
     def lookup_help_handler(self, parts):
@@ -348,10 +423,10 @@ def lookup_help_handler(self, parts):
         :rtype: `blackhole.smtp.Smtp.help_VERB`
         """
         if len(parts) > 1:
-            cmd = f"help_{parts[1].upper()}"
+            cmd = self._help_handlers.get(parts[1].upper(), "help_UNKNOWN")
         else:
             cmd = "do_HELP"
-        return getattr(self, cmd, self.help_UNKNOWN)
+        return getattr(self, cmd)
 
     def lookup_verb_handler(self, verb):
         """
@@ -361,11 +436,77 @@ def lookup_verb_handler(self, verb):
         :returns: A callable command handler.
         :rtype: `blackhole.smtp.Smtp.do_VERB`
         """
-        return getattr(self, f"do_{verb.upper()}", self.do_UNKNOWN)
+        handler = self._verb_handlers.get(verb.upper(), "do_UNKNOWN")
+        return getattr(self, handler)
+
+    @property
+    def responses(self):
+        """
+        Static responses, rendered once and shared between connections.
+
+        The greeting, EHLO, HELP and AUTH help responses only depend on the
+        handlers available, the FQDN and the maximum message size, so they
+        are rendered to a single :py:obj:`bytes` object the first time they
+        are needed and reused until one of those values changes.
+
+        :returns: Encoded responses, keyed by name.
+        :rtype: :py:obj:`dict`
+        """
+        return self.render_responses(self.fqdn, self.config.max_message_size)
+
+    @classmethod
+    def render_responses(cls, fqdn, max_message_size):
+        """
+        Render the static responses for an FQDN and maximum message size.
+
+        :param str fqdn: The server's FQDN.
+        :param int max_message_size: The maximum message size in bytes.
+        :returns: Encoded responses, keyed by name.
+        :rtype: :py:obj:`dict`
+
+        .. note::
+
+           The supervisor renders the responses for the configured values
+           before forking, so children share them rather than rendering
+           their own copy.
+        """
+        key = (cls, fqdn, max_message_size)
+        try:
+            return cls._response_cache[key]
+        except KeyError:
+            pass
+        auth = " ".join(cls._auth_mechanisms)
+        helps = " ".join(cls._help_verbs)
+        ehlo = (
+            f"250-{fqdn}",
+            "250-HELP",
+            "250-PIPELINING",
+            f"250-AUTH {auth}",
+            f"250-SIZE {max_message_size}",
+            "250-VRFY",
+            "250-ETRN",
+            "250-ENHANCEDSTATUSCODES",
+            "250-8BITMIME",
+            "250-SMTPUTF8",
+            "250-EXPN",
+            "250 DSN",
+        )
+        ehlo_starttls = ehlo[:-1] + ("250-STARTTLS", ehlo[-1])
+        responses = {
+            "greeting": f"220 {fqdn} ESMTP\r\n",
+            "ehlo": "".join(f"{line}\r\n" for line in ehlo),
+            "ehlo_starttls": "".join(f"{line}\r\n" for line in ehlo_starttls),
+            "help": f"250 Supported commands: {helps}\r\n",
+            "help_auth": f"250 Syntax: AUTH {auth}\r\n",
+            "help_unknown": f"501 Supported commands: {helps}\r\n",
+        }
+        responses = {k: v.encode("utf-8") for k, v in responses.items()}
+        cls._response_cache[key] = responses
+        return responses
 
     async def greet(self):
         """Send a greeting to the client."""
-        await self.push(220, f"{self.fqdn} ESMTP")
+        await self.send(self.responses["greeting"])
 
     def get_help_members(self):
         """
@@ -376,12 +517,7 @@ def get_help_members(self):
         :returns: A list of available help handlers.
         :rtype: :py:obj:`list`
         """
-        members = inspect.getmembers(self, predicate=inspect.ismethod)
-        cmds = []
-        for cmd, _ in members:
-            if cmd.startswith("help_") and not cmd == "help_UNKNOWN":
-                cmds.append(cmd.replace("help_", ""))
-        return cmds
+        return list(self._help_verbs)
 
     async def do_HELP(self):
         """
@@ -389,8 +525,7 @@ async def do_HELP(self):
 
         https://kura.gg/blackhole/communicating-with-blackhole.html#help
         """
-        msg = " ".join(self.get_help_members())
-        await self.push(250, f"Supported commands: {msg}")
+        await self.send(self.responses["help"])
 
     async def help_HELO(self):
         """
@@ -413,29 +548,17 @@ async def help_EHLO(self):
         await self.push(250, "Syntax: EHLO domain.tld")
 
     async def do_EHLO(self):
-        """Send response to EHLO verb."""
-        response = f"250-{self.fqdn}\r\n".encode("utf-8")
-        self._writer.write(response)
-        logger.debug(f"SENT {response}")
-        auth = " ".join(self.get_auth_members())
-        responses = (
-            "250-HELP",
-            "250-PIPELINING",
-            f"250-AUTH {auth}",
-            f"250-SIZE {self.config.max_message_size}",
-            "250-VRFY",
-            "250-ETRN",
-            "250-ENHANCEDSTATUSCODES",
-            "250-8BITMIME",
-            "250-SMTPUTF8",
-            "250-EXPN",
-            "250 DSN",
-        )
-        for response in responses:
-            response = f"{response}\r\n".encode("utf-8")
-            logger.debug(f"SENT {response}")
-            self._writer.write(response)
-        await self._writer.drain()
+        """
+        Send response to EHLO verb.
+
+        STARTTLS is only advertised when it is available and the connection
+        is not already using TLS. --
+        https://kura.gg/blackhole/configuration.html#starttls
+        """
+        if self.config.starttls is not None and not self.tls:
+            await self.send(self.responses["ehlo_starttls"])
+            return
+        await self.send(self.responses["ehlo"])
 
     async def help_MAIL(self):
         """
@@ -467,6 +590,7 @@ async def _size_in_mail(self):
                 "Message size exceeds fixed maximum message size",
             )
         else:
+            self._in_transaction = True
             await self.push(250, "2.1.0 OK")
 
     async def do_MAIL(self):
@@ -481,6 +605,7 @@ async def do_MAIL(self):
         if "size=" in self._line.lower():
             await self._size_in_mail()
         else:
+            self._in_transaction = True
             await self.push(250, "2.1.0 OK")
 
     async def help_RCPT(self):
@@ -514,12 +639,15 @@ def process_header(self, line):
 
         :param str line: An email header.
         """
-        logger.debug(f"HEADER RECV: {line}")
+        if self._trace is not None:
+            self._trace("HEADER RECV: %s", line)
         if self.config.dynamic_switch is False:
-            logger.debug("Dynamic switches disabled, ignoring")
+            if self._trace is not None:
+                self._trace("Dynamic switches disabled, ignoring")
             return
         if self._disable_dynamic_switching is True:
-            logger.debug("Dynamic switches are disabled by flags option.")
+            if self._trace is not None:
+                self._trace("Dynamic switches are disabled by flags option.")
             return
         key, value = line.split(":")
         key, value = key.lower().strip(), value.lower().strip()
@@ -538,7 +666,8 @@ async def response_from_mode(self):
         Response mode is configured in configuration file and can be overridden
         by email headers, if enabled.
         """
-        logger.debug(f"MODE: {self.mode}")
+        if self._trace is not None:
+            self._trace("MODE: %s", self.mode)
         if self.mode == "bounce":
             key = random.choice(list(self._bounce_responses.keys()))  # nosec
             await self.push(key, self._bounce_responses[key])
@@ -551,6 +680,46 @@ async def response_from_mode(self):
             msg = f"2.0.0 OK: queued as {self.message_id}"
             await self.push(250, msg)
 
+    async def _read_message(self):
+        r"""
+        Read message data until the terminating '\r\n.\r\n' sequence.
+
+        Headers are read a line at a time so dynamic switch headers can be
+        processed, until the end of the headers or until the message exceeds
+        the maximum message size. --
+        https://kura.gg/blackhole/dynamic-switches.html
+
+        The body is read in chunks, each ending at the next '.\r\n' or at
+        the reader's buffer limit, so the cost of reading a message does not
+        depend on how many lines it contains.
+
+        :returns: The size of the message in bytes, or :py:obj:`None` if the
+                  client timed out or disconnected.
+        :rtype: :py:obj:`int` or :py:obj:`None`
+        """
+        max_size = self.config.max_message_size
+        size, in_headers, line_start = 0, True, True
+        while True:
+            if in_headers:
+                chunk = await self.wait_until(b"\n")
+            else:
+                chunk = await self.wait_until(b".\r\n")
+            if not chunk:
+                return None
+            if self._trace is not None:
+                self._trace("RECV %r", chunk)
+            size += len(chunk)
+            if chunk.endswith(b"\n.\r\n") or (
+                line_start and chunk == b".\r\n"
+            ):
+                return size
+            if in_headers and line_start:
+                if chunk in (b"\r\n", b"\n") or size > max_size:
+                    in_headers = False
+                elif chunk[:11].lower() == b"x-blackhole":
+                    self.process_header(chunk.decode("utf-8").rstrip("\r\n"))
+            line_start = chunk.endswith(b"\n")
+
     async def do_DATA(self):
         r"""
         Send response to DATA verb and wait for mail data.
@@ -565,37 +734,63 @@ async def do_DATA(self):
 
         This method implements restrictions on message sizes. --
         https://kura.gg/blackhole/configuration.html#max-message-size
+
+        .. note::
+
+           Message data is not kept in memory. A running byte count is kept
+           instead and once it exceeds the maximum message size the rest of
+           the message is discarded, until the terminating '.\r\n' line is
+           received and the 552 response can be sent.
         """
         await self.push(354, "End data with <CR><LF>.<CR><LF>")
-        on_body = False
-        msg = []
-        while not self.connection_closed:
-            line = await self.wait()
-            logger.debug(f"RECV {line}")
-            msg.append(line)
-            if line.lower().startswith(b"x-blackhole") and on_body is False:
-                self.process_header(line.decode("utf-8").rstrip("\n"))
-            if line == b"\n":
-                on_body = True
-            if line == b".\r\n":
-                break
-        if len(b"".join(msg)) > self.config.max_message_size:
-            msg = []
+        await self.flush()
+        size = await self._read_message()
+        self._in_transaction = False
+        if size is None:
+            return
+        self.stats.messages += 1
+        self.stats.bytes += size
+        if size > self.config.max_message_size:
             await self.push(
                 552,
                 "Message size exceeds fixed maximum message size",
             )
             return
         if self.delay:
-            logger.debug(f"DELAYING RESPONSE: {self.delay} seconds")
+            if self._trace is not None:
+                self._trace("DELAYING RESPONSE: %s seconds", self.delay)
             await asyncio.sleep(self.delay)
         await self.response_from_mode()
 
     async def do_STARTTLS(self):
-        """STARTTLS is not implemented."""
-        # It's currently not possible to implement STARTTLS due to lack of
-        # support in asyncio. - https://bugs.python.org/review/23749/
-        await self.do_NOT_IMPLEMENTED()
+        """
+        Send response to the STARTTLS verb and upgrade the connection to TLS.
+
+        https://kura.gg/blackhole/configuration.html#starttls
+
+        .. note::
+
+           STARTTLS is not implemented unless a TLS certificate and key are
+           configured. Once the connection is upgraded the SMTP state is
+           reset, the client is expected to send EHLO again. --
+           https://tools.ietf.org/html/rfc3207
+        """
+        if self.config.starttls is None:
+            await self.do_NOT_IMPLEMENTED()
+            return
+        if self.tls:
+            await self.push(503, "5.5.1 TLS already active")
+            return
+        if self._line.partition(" ")[2].strip():
+            await self.push(501, "5.5.4 Syntax error, no parameters allowed")
+            return
+        await self.push(220, "2.0.0 Ready to start TLS")
+        if not await self.start_tls(self.config.starttls):
+            return
+        self._in_transaction = False
+        self._delay = None
+        self._mode = None
+        self.message_id = message_id(self.fqdn)
 
     async def help_NOOP(self):
         """
@@ -623,9 +818,11 @@ async def do_RSET(self):
 
         A new message id is generated and assigned.
         """
+        self._in_transaction = False
         old_msg_id = self.message_id
         self.message_id = message_id(self.fqdn)
-        logger.debug(f"{old_msg_id} is now {self.message_id}")
+        if self._trace is not None:
+            self._trace("%s is now %s", old_msg_id, self.message_id)
         await self.push(250, "2.0.0 OK")
 
     async def help_VRFY(self):
@@ -786,11 +983,8 @@ async def do_EXPN(self):
         if expn not in ("list1", "list2", "list3", "all"):
             await self.push(550, "Not authorised")
             return
-        for response in await self._expn_response():
-            response = f"{response}\r\n".encode("utf-8")
-            logger.debug(f"SENT {response}")
-            self._writer.write(response)
-        await self._writer.drain()
+        response = "".join(f"{r}\r\n" for r in await self._expn_response())
+        await self.send(response.encode("utf-8"))
 
     async def help_ETRN(self):
         """
@@ -819,7 +1013,6 @@ async def do_QUIT(self):
         Closes the client connection.
         """
         await self.push(221, "2.0.0 Goodbye")
-        self._handler_coroutine.cancel()
         await self.close()
 
     async def do_NOT_IMPLEMENTED(self):
@@ -828,8 +1021,7 @@ async def do_NOT_IMPLEMENTED(self):
 
     async def help_UNKNOWN(self):
         """Send available help verbs when an invalid verb is received."""
-        msg = " ".join(self.get_help_members())
-        await self.push(501, f"Supported commands: {msg}")
+        await self.send(self.responses["help_unknown"])
 
     async def do_UNKNOWN(self):
         """Send response to unknown verb."""
@@ -867,14 +1059,16 @@ def delay(self):
 
     @delay.setter
     def delay(self, values):
-        logger.debug("DELAY: Dymanic delay enabled")
+        if self._trace is not None:
+            self._trace("DELAY: Dymanic delay enabled")
         value = values.split(",")
         if len(value) == 2:
             self._delay_range(value)
         elif len(value) == 1:
             self._delay_single(value[0])
         else:
-            logger.debug(f"DELAY: Invalid value(s): {values}. Skipping")
+            if self._trace is not None:
+                self._trace("DELAY: Invalid value(s): %s. Skipping", values)
             return
 
     def _delay_range(self, value):
@@ -897,34 +1091,46 @@ def _delay_range(self, value):
             min_delay = int(min_delay)
             max_delay = int(max_delay)
         except ValueError:
-            logger.debug(
-                f"DELAY: Unable to convert {min_delay}, {max_delay} to "
-                "integers. Skipping",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "DELAY: Unable to convert %s, %s to integers. Skipping",
+                    min_delay,
+                    max_delay,
+                )
             self._delay = None
             return
         if min_delay < 0 or max_delay < 0:
-            logger.debug(
-                f"DELAY: A value is less than 0: {min_delay}, {max_delay}. "
-                "Skipping",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "DELAY: A value is less than 0: %s, %s. Skipping",
+                    min_delay,
+                    max_delay,
+                )
             self._delay = None
             return
         if min_delay > max_delay:
-            logger.debug("Min cannot be greater than max")
+            if self._trace is not None:
+                self._trace("Min cannot be greater than max")
             self._delay = None
             return
         if max_delay > self._max_delay:
-            logger.debug(
-                f"DELAY: {max_delay} is higher than {self._max_delay}. "
-                f"{self._max_delay} is the hard coded maximum delay for "
-                "security.",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "DELAY: %s is higher than %s. %s is the hard coded "
+                    "maximum delay for security.",
+                    max_delay,
+                    self._max_delay,
+                    self._max_delay,
+                )
             max_delay = self._max_delay
         self._delay = random.randint(min_delay, max_delay)  # nosec
-        logger.debug(
-            f"DELAY: Set to {self._delay} from range {min_delay}-{max_delay}",
-        )
+        if self._trace is not None:
+            self._trace(
+                "DELAY: Set to %s from range %s-%s",
+                self._delay,
+                min_delay,
+                max_delay,
+            )
         return
 
     def _delay_single(self, value):
@@ -943,25 +1149,31 @@ def _delay_single(self, value):
         try:
             value = int(value)
         except ValueError:
-            logger.debug(
-                f"DELAY: Unable to convert {value} to an integer. Skipping",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "DELAY: Unable to convert %s to an integer. Skipping",
+                    value,
+                )
             self._delay = None
             return
-        logger.debug(value)
         if value < 0:
-            logger.debug(f"DELAY: {value} is less than 0. Skipping")
+            if self._trace is not None:
+                self._trace("DELAY: %s is less than 0. Skipping", value)
             self._delay = None
             return
         if value > self._max_delay:
-            logger.debug(
-                f"DELAY: {value} is higher than {self._max_delay}. "
-                f"{self._max_delay} is the hard coded maximum delay for "
-                "security.",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "DELAY: %s is higher than %s. %s is the hard coded "
+                    "maximum delay for security.",
+                    value,
+                    self._max_delay,
+                    self._max_delay,
+                )
             self._delay = self._max_delay
             return
-        logger.debug(f"DELAY: Set to {value}")
+        if self._trace is not None:
+            self._trace("DELAY: Set to %s", value)
         self._delay = value
 
     @property
@@ -987,11 +1199,85 @@ def mode(self):
     @mode.setter
     def mode(self, value):
         if value not in ("accept", "bounce", "random"):
-            logger.debug(
-                f"MODE: {value} is an invalid. Allowed modes: (accept, "
-                "bounce, random)",
-            )
+            if self._trace is not None:
+                self._trace(
+                    "MODE: %s is an invalid. Allowed modes: (accept, bounce, "
+                    "random)",
+                    value,
+                )
             self._mode = None
             return
-        logger.debug(f"MODE: Dynamic mode enabled. Mode set to {value}")
+        if self._trace is not None:
+            self._trace("MODE: Dynamic mode enabled. Mode set to %s", value)
         self._mode = value
+
+
+class Smtp(SmtpMixin, StreamReaderProtocol):
+    """The class responsible for handling SMTP/SMTPS commands."""
+
+    def connection_made(self, transport):
+        """
+        Tie a connection to blackhole to the SMTP protocol.
+
+        :param asyncio.transports.Transport transport: The transport class.
+        """
+        super().connection_made(transport)
+        self._handler_coroutine = self.loop.create_task(self._handle_client())
+
+    async def _handle_client(self):
+        """
+        Handle a client connection.
+
+        This method greets the client and then accepts and handles each line
+        the client sends, passing off to the correct verb handler.
+        """
+        await self.greet()
+        while not self._connection_closed:
+            line = await self.wait()
+            if line is None:
+                await self.close()
+                return
+            await self._handle_line(line)
+
+    async def do_QUIT(self):
+        """
+        Send response to the QUIT verb.
+
+        Stops handling the client and closes the client connection.
+        """
+        self._handler_coroutine.cancel()
+        await super().do_QUIT()
+
+
+class CallbackSmtp(SmtpMixin, CallbackProtocol):
+    """
+    The class responsible for handling SMTP/SMTPS commands with callbacks.
+
+    Handles the same commands as :class:`Smtp` without a stream reader,
+    stream writer or task per connection. --
+    https://kura.gg/blackhole/configuration.html#engine
+    """
+
+    __slots__ = (
+        "message_id",
+        "_busy",
+        "_delay",
+        "_draining",
+        "_failed_commands",
+        "_in_transaction",
+        "_line",
+        "_mode",
+    )
+
+    def connection_made(self, transport):
+        """
+        Tie a connection to blackhole to the SMTP protocol.
+
+        :param asyncio.transports.Transport transport: The transport class.
+        """
+        super().connection_made(transport)
+        self._run(self.greet())
+
+
+ENGINES = {"stream": Smtp, "callback": CallbackSmtp}
+"""The protocol engine to use for each value of the ``engine`` option."""
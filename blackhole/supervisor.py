@@ -26,13 +26,25 @@
 
 
 import asyncio
+import gc
 import logging
 import os
 import signal
+import time
 
 from .config import Config
-from .control import server
-from .exceptions import BlackholeRuntimeException
+from .control import (
+    TLS_CONTEXTS,
+    _socket,
+    server,
+    set_affinity,
+    set_ticket_keys,
+    sni_contexts,
+    ticket_keys,
+    tls_contexts,
+)
+from .exceptions import BlackholeRuntimeException, ConfigException
+from .smtp import ENGINES
 from .utils import Singleton
 from .worker import Worker
 
@@ -58,6 +70,21 @@ class Supervisor(metaclass=Singleton):
     internal map of workers and the children they manage.
     """
 
+    scale_interval = 15
+    """Seconds between checks of worker load, when scaling workers."""
+
+    scale_cooldown = 60
+    """Seconds to wait after adding or retiring a worker before scaling."""
+
+    scale_up_cpu = 0.75
+    """Average CPU use of the workers above which a worker is added."""
+
+    scale_up_lag = 0.5
+    """Event loop lag, in seconds, above which a worker is added."""
+
+    scale_down_cpu = 0.25
+    """Average CPU use of the workers below which a worker is retired."""
+
     def __init__(self, loop=None):
         """
         Initialise the supervisor.
@@ -75,7 +102,16 @@ def __init__(self, loop=None):
         self.config = Config()
         self.loop = loop if loop is not None else asyncio.get_event_loop()
         self.socks = []
+        self.worker_socks = [[] for _ in range(self.config.workers)]
         self.workers = []
+        self.draining = []
+        self.worker_count = 0
+        self.scale_task = None
+        self.ticket_task = None
+        self.ticket_keys = None
+        self.watch_task = None
+        self.stop_task = None
+        self._scaled_at = time.monotonic()
         if setproctitle:
             setproctitle.setproctitle("blackhole: master")
         try:
@@ -88,18 +124,54 @@ def generate_servers(self):
         """Spawn all of the required sockets and TLS contexts."""
         logger.debug("Attaching sockets to the supervisor")
         self.create_socket(self.config.listen)
-        tls_conf = (self.config.tls_cert, self.config.tls_key)
-        if len(self.config.tls_listen) > 0 and all(tls_conf):
+        if len(self.config.tls_listen) > 0:
             self.create_socket(self.config.tls_listen, use_tls=True)
 
     def create_socket(self, listeners, use_tls=False):
-        """Create supervisor socket."""
+        """
+        Create supervisor socket.
+
+        :param list listeners: Listeners to create sockets for.
+        :param bool use_tls: Whether to create a TLS context or not.
+                             Default: ``False``.
+
+        .. note::
+
+           Listeners with a certificate and key, from their own flags or
+           ``tls_cert`` and ``tls_key``, offer STARTTLS or, for TLS
+           listeners, TLS. TLS listeners without either are skipped. --
+           https://kura.gg/blackhole/configuration.html#listener-certificates
+
+           When :ref:`reuse_port` is enabled a socket is bound for each
+           worker, using :py:obj:`socket.SO_REUSEPORT`, so the kernel
+           balances new connections between the workers instead of waking
+           every worker for each connection. The sockets are bound here,
+           before privileges are dropped, so privileged ports can be used.
+           -- https://kura.gg/blackhole/configuration.html#reuse-port
+        """
         _tls = ""
         if use_tls:
             _tls = " (TLS)"
         for host, port, family, flags in listeners:
-            aserver = server(host, port, family, use_tls=use_tls)
+            tls_conf = all(self.config.tls_files(flags))
+            if use_tls and not tls_conf:
+                continue
+            aserver = server(
+                host,
+                port,
+                family,
+                use_tls=use_tls,
+                starttls=not use_tls and tls_conf,
+                flags=flags,
+            )
             self.socks.append(aserver)
+            if self.config.reuse_port:
+                self.worker_socks[0].append(aserver)
+                for socks in self.worker_socks[1:]:
+                    asock = _socket(host, port, family)
+                    wserver = dict(aserver, sock=asock)
+                    self.socks.append(wserver)
+                    socks.append(wserver)
             logger.debug(f"Attaching {host}:{port}{_tls} with flags {flags}")
 
     def run(self):
@@ -107,28 +179,361 @@ def run(self):
         Start all workers and their children.
 
         Attaches signals and runs the event loop.
+
+        .. note::
+
+           The supervisor is pinned to it's CPUs, if configured, before any
+           workers are started.
+
+           https://kura.gg/blackhole/configuration.html#supervisor-cpu-affinity
         """
+        cpus = self.config.supervisor_cpu_affinity
+        set_affinity(None if cpus is None else set(cpus))
+        self.loop.add_signal_handler(signal.SIGCHLD, self.reap)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self.prefork()
         self.start_workers()
-        signal.signal(signal.SIGTERM, self.stop)
-        signal.signal(signal.SIGINT, self.stop)
+        if self.config.autoscale:
+            self.scale_task = asyncio.ensure_future(self.autoscale())
+        if self.ticket_keys is not None and self.config.tls_ticket_rotation:
+            self.ticket_task = asyncio.ensure_future(self.ticket_rotation())
+        if self.config.tls_watch_interval and self.tls_files():
+            self.watch_task = asyncio.ensure_future(self.watch_tls())
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.loop.add_signal_handler(signal.SIGINT, self.stop)
         self.loop.run_forever()
 
+    def prefork(self):
+        """
+        Prepare the state children inherit before forking them.
+
+        .. note::
+
+           The static SMTP responses of every engine are rendered and
+           garbage left over from loading the configuration is collected,
+           so that children share one copy of everything they need from the
+           supervisor's memory. Objects are frozen when each child is forked
+           -- :meth:`blackhole.worker.Worker.fork`.
+
+           The first TLS session ticket keys are set on the supervisor's
+           TLS contexts, so every child inherits the same keys. --
+           https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+        """
+        for engine in ENGINES.values():
+            engine.render_responses(
+                self.config.mailname,
+                self.config.max_message_size,
+            )
+        if self.ticket_keys is None:
+            self.rotate_ticket_keys()
+        gc.collect()
+
+    def rotate_ticket_keys(self):
+        """
+        Generate new TLS session ticket keys and give them to each child.
+
+        https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+        .. note::
+
+           The keys are set on the supervisor's TLS contexts, which children
+           forked later inherit, and sent to the children of every worker.
+           A client can resume it's TLS session with any child, until the
+           keys are rotated again.
+        """
+        contexts = [s.get(key) for s in self.socks for key in TLS_CONTEXTS]
+        if not any(contexts):
+            return
+        keys = ticket_keys()
+        if not set_ticket_keys(contexts, keys):
+            logger.warning(
+                "Unable to set TLS session ticket keys, children use the "
+                "keys created with the supervisor's TLS contexts",
+            )
+            return
+        logger.debug("Rotating TLS session ticket keys")
+        self.ticket_keys = keys
+        for worker in self.workers:
+            worker.set_ticket_keys(keys)
+
+    async def ticket_rotation(self):
+        """
+        Rotate the TLS session ticket keys periodically.
+
+        https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+        """
+        while True:
+            await asyncio.sleep(self.config.tls_ticket_rotation)
+            self.rotate_ticket_keys()
+
     def start_workers(self):
         """Start each worker and it's child process."""
         logger.debug("Starting workers")
         for idx in range(self.config.workers):
-            num = f"{idx + 1}"
-            logger.debug(f"Creating worker: {num}")
-            self.workers.append(Worker(num, self.socks, self.loop))
+            socks = self.socks
+            if self.config.reuse_port:
+                socks = self.worker_socks[idx]
+            self.add_worker(socks)
+
+    def add_worker(self, socks=None):
+        """
+        Start a new worker and it's child process.
+
+        :param list socks: Sockets for the worker to listen for connections
+                           on. Default: every socket.
+        """
+        self.worker_count += 1
+        num = f"{self.worker_count}"
+        logger.debug(f"Creating worker: {num}")
+        socks = self.socks if socks is None else socks
+        self.workers.append(Worker(num, socks, self.loop))
+
+    def retire_worker(self):
+        """Drain and stop the worker with the fewest connected clients."""
+        worker = min(reversed(self.workers), key=lambda w: w.connections)
+        logger.debug(f"Retiring worker: {worker.idx}")
+        self.workers.remove(worker)
+        self.drain_worker(worker)
+
+    def drain_worker(self, worker):
+        """
+        Stop a worker once it's child has finished with it's clients.
+
+        :param blackhole.worker.Worker worker: The worker to stop.
+        :returns: The task draining and stopping the worker.
+        :rtype: :py:class:`asyncio.Task`
+        """
+        self.draining.append(worker)
+        return asyncio.ensure_future(self.stop_drained(worker))
+
+    async def stop_drained(self, worker):
+        """
+        Drain a worker's child and stop the worker.
+
+        :param blackhole.worker.Worker worker: The worker to stop.
+        """
+        await worker.drain()
+        logger.debug(f"Stopping drained worker: {worker.idx}")
+        await worker.stop()
+        if worker in self.draining:
+            self.draining.remove(worker)
+
+    def reload(self):
+        """
+        Reload the configuration and replace every worker.
+
+        Called when the supervisor receives :py:obj:`signal.SIGHUP`.
+
+        https://kura.gg/blackhole/configuration.html#reloading
+
+        .. note::
+
+           The TLS certificates and keys are loaded again, then every worker
+           is replaced with :meth:`replace_workers`.
+        """
+        logger.info("Reloading configuration")
+        try:
+            changed = self.config.reload()
+        except ConfigException as err:
+            logger.error(f"Configuration not reloaded: {err}")
+            return
+        for option in changed:
+            logger.warning(f"Changing {option} requires a restart, ignoring")
+        self.reload_tls()
+        self.prefork()
+        self.replace_workers()
+
+    def replace_workers(self):
+        """
+        Replace every worker with a new worker and child.
+
+        .. note::
+
+           A new worker and child is started for each running worker, using
+           the same listening sockets, before the old children stop
+           accepting connections. Old children are stopped once their
+           clients have disconnected.
+        """
+        old = self.workers
+        self.workers = []
+        for worker in old:
+            self.add_worker(worker.socks)
+        for worker in old:
+            self.drain_worker(worker)
+        self._scaled_at = time.monotonic()
+
+    def reload_tls(self):
+        """
+        Reload the TLS certificates and keys of every listener.
+
+        https://kura.gg/blackhole/configuration.html#reloading
+
+        :returns: ``True`` if the TLS contexts were replaced.
+        :rtype: :py:obj:`bool`
+
+        .. note::
+
+           Every context is created before any are replaced, if any
+           certificate or key cannot be loaded the running contexts are all
+           kept. Children forked afterwards use the new contexts, the
+           session ticket keys are carried over so clients can still resume
+           their TLS sessions.
+        """
+        socks = []
+        for sock in self.socks:
+            use_tls, starttls = (bool(sock.get(k)) for k in TLS_CONTEXTS)
+            if use_tls or starttls:
+                files = self.config.tls_files(sock["flags"])
+                socks.append((sock, (use_tls, starttls, files)))
+        if not socks:
+            return False
+        contexts = {}
+        try:
+            sni = sni_contexts()
+            for sock, key in socks:
+                if key not in contexts:
+                    contexts[key] = tls_contexts(
+                        key[0],
+                        key[1],
+                        sock["flags"],
+                        sni=sni,
+                    )
+        except OSError as err:
+            logger.error(f"TLS certificates not reloaded: {err}")
+            return False
+        for sock, key in socks:
+            sock["ssl"], sock["starttls"] = contexts[key]
+        if self.ticket_keys is not None:
+            new = [ctx for pair in contexts.values() for ctx in pair]
+            set_ticket_keys(new, self.ticket_keys)
+        logger.info("Reloaded TLS certificates")
+        return True
+
+    def tls_files(self):
+        """
+        Get the state of every TLS certificate, key and dhparams file.
+
+        https://kura.gg/blackhole/configuration.html#tls-watch-interval
+
+        :returns: The modification time and size of each file, keyed by
+                  path. Files that cannot be found are :py:obj:`None`.
+        :rtype: :py:obj:`dict`
+        """
+        paths = set()
+        for sock in self.socks:
+            if any(sock.get(key) for key in TLS_CONTEXTS):
+                paths.update(self.config.tls_files(sock["flags"]))
+                paths.add(self.config.tls_dhparams)
+        for files in self.config.tls_sni.values():
+            paths.update(files)
+        state = {}
+        for path in filter(None, paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                state[path] = None
+                continue
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    async def watch_tls(self):
+        """
+        Reload the TLS certificates and keys when their files change.
+
+        https://kura.gg/blackhole/configuration.html#tls-watch-interval
+
+        .. note::
 
-    def stop_workers(self):
-        """Stop the workers and their respective child process."""
+           Once the new certificates and keys are loaded every worker is
+           replaced, the same as reloading the configuration. If a file is
+           changed part way through being written, the certificates are
+           loaded again with the next change.
+        """
+        files = self.tls_files()
+        while True:
+            await asyncio.sleep(self.config.tls_watch_interval)
+            current = self.tls_files()
+            if current == files:
+                continue
+            files = current
+            logger.info("TLS certificates changed")
+            if self.reload_tls():
+                self.replace_workers()
+
+    def reap(self):
+        """
+        Reap any child processes that have exited.
+
+        Called when the supervisor receives :py:obj:`signal.SIGCHLD`, each
+        worker restarts it's child process if it has exited.
+        """
+        for worker in list(self.workers):
+            worker.reap()
+
+    async def autoscale(self):
+        """
+        Scale the number of workers with load.
+
+        https://kura.gg/blackhole/configuration.html#workers
+        """
+        while True:
+            await asyncio.sleep(self.scale_interval)
+            self.scale()
+
+    def scale(self):
+        """
+        Add or retire a worker, based on the load reported by each child.
+
+        .. note::
+
+           A worker is added when the average CPU use of the workers is above
+           :attr:`scale_up_cpu` or the event loop of any child lags by more
+           than :attr:`scale_up_lag` seconds, up to ``max_workers``.
+
+           A worker is retired when the average CPU use is below
+           :attr:`scale_down_cpu` and no child is lagging, down to
+           ``min_workers``.
+
+           Nothing is changed until every worker has reported it's load and
+           :attr:`scale_cooldown` seconds have passed since the last change.
+        """
+        if time.monotonic() - self._scaled_at < self.scale_cooldown:
+            return
+        if any(worker.cpu is None for worker in self.workers):
+            return
+        cpu = sum(w.cpu for w in self.workers) / len(self.workers)
+        lag = max(worker.lag for worker in self.workers)
+        count = len(self.workers)
+        logger.debug(f"Load: {count} workers, cpu {cpu:.2f}, lag {lag:.3f}s")
+        if count < self.config.max_workers and (
+            cpu > self.scale_up_cpu or lag > self.scale_up_lag
+        ):
+            self.add_worker()
+        elif (
+            count > self.config.min_workers
+            and cpu < self.scale_down_cpu
+            and lag < self.scale_up_lag
+        ):
+            self.retire_worker()
+        else:
+            return
+        self._scaled_at = time.monotonic()
+
+    async def stop_workers(self):
+        """
+        Stop the workers and their respective child process.
+
+        .. note::
+
+           Every child is told to drain before any are waited on, so the
+           children drain their clients at the same time. --
+           https://kura.gg/blackhole/configuration.html#drain-timeout
+        """
         logger.debug("Stopping workers")
-        worker_num = 1
-        for worker in self.workers:
-            logger.debug(f"Stopping worker: {worker_num}")
-            worker.stop()
-            worker_num += 1
+        workers = self.workers + self.draining
+        for worker in workers:
+            worker.terminate()
+        await asyncio.gather(*(worker.stop() for worker in workers))
 
     def close_socks(self):
         """Close all opened sockets."""
@@ -141,13 +546,24 @@ def stop(self, *args, **kwargs):
 
         Generally should be called by a signal, nothing else.
 
-        :raise SystemExit: With code :py:obj:`os.EX_OK`.
+        .. note::
+
+           The workers are stopped by :meth:`shutdown` on the event loop,
+           which :meth:`run` returns once it has finished.
         """
-        self.stop_workers()
+        if self.stop_task is not None:
+            return
+        if self.scale_task is not None:
+            self.scale_task.cancel()
+        if self.ticket_task is not None:
+            self.ticket_task.cancel()
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+        self.stop_task = asyncio.ensure_future(self.shutdown(), loop=self.loop)
+
+    async def shutdown(self):
+        """Stop the workers, close the sockets and stop the event loop."""
+        await self.stop_workers()
         self.close_socks()
         logger.debug("Stopping supervisor")
-        try:
-            self.loop.stop()
-        except RuntimeError:
-            pass
-        raise SystemExit(os.EX_OK)
+        self.loop.stop()
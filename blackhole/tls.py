@@ -0,0 +1,973 @@
+# -*- coding: utf-8 -*-
+
+# (The MIT License)
+#
+# Copyright (c) 2013-2021 Kura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the 'Software'), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Perform TLS handshakes in a thread pool and hand records to the kernel."""
+
+
+import asyncio
+import os
+import socket
+
+from .logs import trace
+
+
+try:
+    import ssl
+except ImportError:  # pragma: no cover
+    ssl = None
+
+
+__all__ = (
+    "HandshakeProtocol",
+    "SocketHandshakeProtocol",
+    "SocketTLSTransport",
+    "TLSTransport",
+    "handshake",
+    "ktls",
+    "socket_handshake",
+)
+"""Tuple all the things."""
+
+
+_SOL_TLS = getattr(socket, "SOL_TLS", 282)
+_TLS_TX = 1
+_TLS_RX = 2
+
+
+def handshake(sslobj):
+    """
+    Continue the TLS handshake with the data read from the client so far.
+
+    :param ssl.SSLObject sslobj: The TLS connection.
+    :returns: ``True`` once the handshake is complete, ``False`` when more
+              data is needed from the client.
+    :rtype: :py:obj:`bool`
+    :raises ssl.SSLError: When the handshake fails.
+
+    .. note::
+
+       Called from a thread, OpenSSL releases the GIL while it does the
+       cryptography for the handshake.
+    """
+    try:
+        sslobj.do_handshake()
+    except ssl.SSLWantReadError:
+        return False
+    return True
+
+
+def socket_handshake(sslsock):
+    """
+    Continue the TLS handshake of a non-blocking socket.
+
+    :param ssl.SSLSocket sslsock: The TLS connection.
+    :returns: :py:obj:`None` once the handshake is complete, otherwise
+              ``"read"`` or ``"write"``, what the socket must be ready for
+              to continue.
+    :rtype: :py:obj:`str` or :py:obj:`None`
+    :raises ssl.SSLError: When the handshake fails.
+
+    .. note::
+
+       Called from a thread when ``tls_handshake_threads`` is set, the
+       socket is not watched by the event loop while it is.
+    """
+    try:
+        sslsock.do_handshake()
+    except ssl.SSLWantReadError:
+        return "read"
+    except ssl.SSLWantWriteError:
+        return "write"
+    return None
+
+
+def ktls(sock):
+    """
+    Check whether the kernel encrypts and decrypts a connection's records.
+
+    https://kura.gg/blackhole/configuration.html#tls-ktls
+
+    :param socket.socket sock: The connection's socket.
+    :returns: Whether records are sent by the kernel and whether records are
+              received by the kernel.
+    :rtype: :py:obj:`tuple`
+
+    .. note::
+
+       The kernel only answers for a direction once OpenSSL has given it the
+       keys for that direction.
+    """
+    status = []
+    for option in (_TLS_TX, _TLS_RX):
+        try:
+            sock.getsockopt(_SOL_TLS, option, 4)
+        except OSError:
+            status.append(False)
+        else:
+            status.append(True)
+    return tuple(status)
+
+
+class TLSTransport(asyncio.Transport):
+    """
+    A transport that encrypts and decrypts data with a TLS connection.
+
+    Used in place of the transport :py:mod:`asyncio` creates for TLS
+    listeners, the protocol is given the transport once
+    :class:`HandshakeProtocol` has completed the handshake.
+    """
+
+    def __init__(self, transport, context, protocol):
+        """
+        Initialise the transport.
+
+        :param asyncio.transports.Transport transport: The plain transport
+                                                       of the connection.
+        :param ssl.SSLContext context: The TLS context to use.
+        :param asyncio.Protocol protocol: The protocol of the connection.
+        """
+        super().__init__()
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.sslobj = context.wrap_bio(
+            self.incoming,
+            self.outgoing,
+            server_side=True,
+        )
+        self._transport = transport
+        self._protocol = protocol
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        """
+        Get information about the connection.
+
+        :param str name: The name of the information.
+        :param default: Returned if the information is not available.
+        :returns: The information.
+
+        .. note::
+
+           ``sslcontext``, ``ssl_object``, ``peercert``, ``cipher`` and
+           ``compression`` are answered by the TLS connection, as with
+           :py:mod:`asyncio`'s own TLS transport. Anything else is asked of
+           the plain transport.
+
+           ``sslcontext`` is the context the connection is using, which is
+           not the listener's when the client asked for a TLS SNI hostname.
+        """
+        if name == "sslcontext":
+            return self.sslobj.context
+        if name == "ssl_object":
+            return self.sslobj
+        if name == "peercert":
+            return self.sslobj.getpeercert()
+        if name == "cipher":
+            return self.sslobj.cipher()
+        if name == "compression":
+            return self.sslobj.compression()
+        return self._transport.get_extra_info(name, default)
+
+    def get_protocol(self):
+        """
+        Get the protocol of the connection.
+
+        :returns: The protocol.
+        :rtype: :py:class:`asyncio.Protocol`
+        """
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        """
+        Set the protocol of the connection.
+
+        :param asyncio.Protocol protocol: The protocol.
+        """
+        self._protocol = protocol
+
+    def is_closing(self):
+        """
+        Whether the connection is closing or closed.
+
+        :returns: ``True`` once :meth:`close` or :meth:`abort` is called or
+                  the plain transport is closing.
+        :rtype: :py:obj:`bool`
+        """
+        return self._closing or self._transport.is_closing()
+
+    def is_reading(self):
+        """
+        Whether data is being read from the client.
+
+        :returns: ``True`` unless reading is paused.
+        :rtype: :py:obj:`bool`
+        """
+        return self._transport.is_reading()
+
+    def pause_reading(self):
+        """Stop reading data from the client."""
+        self._transport.pause_reading()
+
+    def resume_reading(self):
+        """Start reading data from the client again."""
+        self._transport.resume_reading()
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        """
+        Set the write buffer limits of the plain transport.
+
+        :param int high: The high-water limit.
+        :param int low: The low-water limit.
+        """
+        self._transport.set_write_buffer_limits(high, low)
+
+    def get_write_buffer_size(self):
+        """
+        Get the amount of encrypted data waiting to be written.
+
+        :returns: The number of bytes.
+        :rtype: :py:obj:`int`
+        """
+        return self._transport.get_write_buffer_size()
+
+    def can_write_eof(self):
+        """
+        TLS connections can only be closed, not half closed.
+
+        :returns: ``False``.
+        :rtype: :py:obj:`bool`
+        """
+        return False
+
+    def write(self, data):
+        """
+        Encrypt data and write it to the client.
+
+        :param bytes data: The data to write.
+        """
+        if not data or self.is_closing():
+            return
+        view = memoryview(data)
+        offset = 0
+        try:
+            while offset < len(view):
+                offset += self.sslobj.write(view[offset:])
+        except ssl.SSLError:
+            self.abort()
+            return
+        self.flush()
+
+    def flush(self):
+        """Write encrypted data waiting in the TLS connection to the client."""
+        data = self.outgoing.read()
+        if data and not self._transport.is_closing():
+            self._transport.write(data)
+
+    def close(self):
+        """Send a TLS close_notify alert and close the connection."""
+        if self._closing:
+            return
+        self._closing = True
+        try:
+            self.sslobj.unwrap()
+        except ssl.SSLError:
+            pass
+        self.flush()
+        self._transport.close()
+
+    def abort(self):
+        """Close the connection without writing any waiting data."""
+        self._closing = True
+        self._transport.abort()
+
+
+class HandshakeProtocol(asyncio.Protocol):
+    """
+    Complete the TLS handshake of a new connection in a thread pool.
+
+    The connection is only handed to it's protocol once the handshake is
+    complete, using a :class:`TLSTransport`.
+    """
+
+    def __init__(self, protocol, context, executor, timeout, loop=None):
+        """
+        Initialise the protocol.
+
+        :param asyncio.Protocol protocol: The protocol to hand the connection
+                                          to.
+        :param ssl.SSLContext context: The TLS context to use.
+        :param concurrent.futures.ThreadPoolExecutor executor: The threads
+                                                               handshakes are
+                                                               done in.
+        :param int timeout: Seconds the handshake must complete in, including
+                            time waiting for a thread.
+        :param loop: The event loop to use.
+        :type loop: :py:class:`asyncio.AbstractEventLoop` or :py:obj:`None`
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.protocol = protocol
+        self.context = context
+        self.executor = executor
+        self.timeout = timeout
+        self.transport = None
+        self.tls_transport = None
+        self.connected = False
+        self._pending = []
+        self._step = None
+        self._timeout_handle = None
+
+    def connection_made(self, transport):
+        """
+        Wait for the client to start the handshake.
+
+        :param asyncio.transports.Transport transport: The plain transport.
+        """
+        self.transport = transport
+        self.tls_transport = TLSTransport(
+            transport, self.context, self.protocol
+        )
+        self._timeout_handle = self.loop.call_later(
+            self.timeout,
+            self._handshake_failed,
+            "timed out",
+        )
+
+    def _handshake_step(self):
+        """
+        Pass the data read from the client to the handshake, in a thread.
+
+        .. note::
+
+           Reading is paused while the thread has the TLS connection, so only
+           one thread uses it at a time. The event loop reads and writes the
+           socket, the thread only does the cryptography.
+        """
+        self.tls_transport.incoming.write(b"".join(self._pending))
+        self._pending.clear()
+        self.transport.pause_reading()
+        self._step = self.loop.run_in_executor(
+            self.executor,
+            handshake,
+            self.tls_transport.sslobj,
+        )
+        self._step.add_done_callback(self._handshake_done)
+
+    def _handshake_done(self, future):
+        """
+        Write the handshake's reply, hand over the connection once complete.
+
+        :param asyncio.Future future: The handshake step.
+        """
+        self._step = None
+        if future.cancelled() or self.transport.is_closing():
+            return
+        try:
+            complete = future.result()
+        except Exception as err:
+            self._handshake_failed(err)
+            return
+        self.tls_transport.flush()
+        if not complete:
+            self.transport.resume_reading()
+            if self._pending:
+                self._handshake_step()
+            return
+        self._timeout_handle.cancel()
+        self.connected = True
+        self.protocol.connection_made(self.tls_transport)
+        # The client may have sent data straight after it's handshake.
+        data = b"".join(self._pending)
+        self._pending.clear()
+        self.data_received(data)
+        if not self.tls_transport.is_closing():
+            self.transport.resume_reading()
+
+    def _handshake_failed(self, exc):
+        """
+        Close a connection when it's handshake fails or times out.
+
+        :param exc: Why the handshake failed.
+        :type exc: :py:obj:`Exception` or :py:obj:`str`
+        """
+        _trace = trace(
+            self.transport.get_extra_info("peername"),
+            self.protocol.config.debug_sample,
+        )
+        if _trace is not None:
+            _trace("TLS handshake failed: %s", exc)
+        self.transport.abort()
+
+    def data_received(self, data):
+        """
+        Decrypt data from the client and pass it to the protocol.
+
+        :param bytes data: Encrypted data.
+
+        .. note::
+
+           Before the handshake is complete data is kept until the thread
+           handling the previous step of the handshake is finished.
+        """
+        if not self.connected:
+            self._pending.append(data)
+            if self._step is None:
+                self._handshake_step()
+            return
+        sslobj = self.tls_transport.sslobj
+        if data:
+            self.tls_transport.incoming.write(data)
+        chunks = []
+        eof = False
+        while True:
+            try:
+                chunk = sslobj.read(65536)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLZeroReturnError:
+                eof = True
+                break
+            except ssl.SSLError:
+                self.tls_transport.abort()
+                return
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+        # Replies to post handshake messages, like TLSv1.3 key updates.
+        self.tls_transport.flush()
+        if chunks:
+            self.protocol.data_received(b"".join(chunks))
+        if eof:
+            self.eof_received()
+            self.tls_transport.close()
+
+    def eof_received(self):
+        """
+        The client closed it's side of the connection.
+
+        :returns: ``False``, the connection is closed.
+        :rtype: :py:obj:`bool`
+        """
+        if self.connected:
+            self.protocol.eof_received()
+        return False
+
+    def connection_lost(self, exc):
+        """
+        The connection is closed or lost.
+
+        :param exc: The error, or :py:obj:`None` if the connection was closed.
+        :type exc: :py:obj:`Exception` or :py:obj:`None`
+        """
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+        if self.connected:
+            self.tls_transport._closing = True
+            self.protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        """Stop the protocol writing, the write buffer is full."""
+        if self.connected:
+            self.protocol.pause_writing()
+
+    def resume_writing(self):
+        """Let the protocol write again."""
+        if self.connected:
+            self.protocol.resume_writing()
+
+
+class SocketTLSTransport(asyncio.Transport):
+    """
+    A transport that reads and writes a TLS socket.
+
+    Used for connections :class:`SocketHandshakeProtocol` completed the
+    handshake of. OpenSSL reads and writes the socket itself, so the kernel
+    can encrypt and decrypt the connection's records. --
+    https://kura.gg/blackhole/configuration.html#tls-ktls
+    """
+
+    max_size = 256 * 1024
+    """Bytes read or written at once, before other connections are served."""
+
+    def __init__(self, sock, protocol, loop):
+        """
+        Initialise the transport.
+
+        :param ssl.SSLSocket sock: The TLS connection, once it's handshake is
+                                   complete.
+        :param asyncio.Protocol protocol: The protocol of the connection.
+        :param asyncio.AbstractEventLoop loop: The event loop to use.
+        """
+        super().__init__()
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._protocol = protocol
+        self._loop = loop
+        self._buffer = bytearray()
+        self._reading = False
+        self._writing = False
+        self._closing = False
+        self._closed = False
+        self._paused = False
+        self.set_write_buffer_limits()
+        self.ktls = ktls(sock)
+        self._extra = {
+            "socket": sock,
+            "sslcontext": sock.context,
+            "ssl_object": sock,
+            "peercert": sock.getpeercert(),
+            "cipher": sock.cipher(),
+            "compression": sock.compression(),
+            "ktls": self.ktls,
+        }
+        for name, func in (
+            ("peername", sock.getpeername),
+            ("sockname", sock.getsockname),
+        ):
+            try:
+                self._extra[name] = func()
+            except OSError:
+                self._extra[name] = None
+
+    def start(self):
+        """Hand the connection to the protocol and start reading."""
+        self._protocol.connection_made(self)
+        self.resume_reading()
+
+    def get_extra_info(self, name, default=None):
+        """
+        Get information about the connection.
+
+        :param str name: The name of the information.
+        :param default: Returned if the information is not available.
+        :returns: The information.
+
+        .. note::
+
+           ``ktls`` is the result of :func:`ktls` for the connection.
+        """
+        return self._extra.get(name, default)
+
+    def get_protocol(self):
+        """
+        Get the protocol of the connection.
+
+        :returns: The protocol.
+        :rtype: :py:class:`asyncio.Protocol`
+        """
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        """
+        Set the protocol of the connection.
+
+        :param asyncio.Protocol protocol: The protocol.
+        """
+        self._protocol = protocol
+
+    def is_closing(self):
+        """
+        Whether the connection is closing or closed.
+
+        :returns: ``True`` once :meth:`close` or :meth:`abort` is called.
+        :rtype: :py:obj:`bool`
+        """
+        return self._closing
+
+    def is_reading(self):
+        """
+        Whether data is being read from the client.
+
+        :returns: ``True`` unless reading is paused or the connection is
+                  closing.
+        :rtype: :py:obj:`bool`
+        """
+        return self._reading and not self._closing
+
+    def pause_reading(self):
+        """Stop reading data from the client."""
+        if not self.is_reading():
+            return
+        self._reading = False
+        self._loop.remove_reader(self._fd)
+
+    def resume_reading(self):
+        """
+        Start reading data from the client again.
+
+        .. note::
+
+           Data OpenSSL has already read from the socket does not make the
+           socket readable, so it is read straight away.
+        """
+        if self._reading or self._closing:
+            return
+        self._reading = True
+        self._loop.add_reader(self._fd, self._read_ready)
+        self._loop.call_soon(self._read_ready)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        """
+        Set the limits the protocol is paused and resumed writing at.
+
+        :param int high: The high-water limit. Default: ``65536``.
+        :param int low: The low-water limit. Default: a quarter of ``high``.
+        """
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high_water, self._low_water = high, low
+
+    def get_write_buffer_limits(self):
+        """
+        Get the limits the protocol is paused and resumed writing at.
+
+        :returns: The low-water and high-water limits.
+        :rtype: :py:obj:`tuple`
+        """
+        return self._low_water, self._high_water
+
+    def get_write_buffer_size(self):
+        """
+        Get the amount of data waiting to be written.
+
+        :returns: The number of bytes.
+        :rtype: :py:obj:`int`
+        """
+        return len(self._buffer)
+
+    def can_write_eof(self):
+        """
+        TLS connections can only be closed, not half closed.
+
+        :returns: ``False``.
+        :rtype: :py:obj:`bool`
+        """
+        return False
+
+    def _read_ready(self):
+        """Read data from the client and pass it to the protocol."""
+        if not self.is_reading():
+            return
+        chunks = []
+        size = 0
+        eof = False
+        while size < self.max_size:
+            try:
+                chunk = self._sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except (BlockingIOError, InterruptedError):
+                break
+            except ssl.SSLZeroReturnError:
+                eof = True
+                break
+            except OSError as exc:
+                self._force_close(exc)
+                return
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if size >= self.max_size:
+            # There may be more waiting in OpenSSL, let others run first.
+            self._loop.call_soon(self._read_ready)
+        if chunks:
+            self._protocol.data_received(b"".join(chunks))
+        if eof:
+            self._protocol.eof_received()
+            self.close()
+
+    def write(self, data):
+        """
+        Write data to the client.
+
+        :param bytes data: The data to write.
+        """
+        if not data or self._closing:
+            return
+        self._buffer.extend(data)
+        if not self._writing:
+            self._write_ready()
+        if not self._paused and len(self._buffer) > self._high_water:
+            self._paused = True
+            self._protocol.pause_writing()
+
+    def _write_ready(self):
+        """
+        Write data waiting in the buffer to the client.
+
+        .. note::
+
+           OpenSSL must be given at least the data it was given the last
+           time it could not finish writing, the buffer only shrinks once
+           it has.
+        """
+        while self._buffer:
+            try:
+                sent = self._sock.send(self._buffer[: self.max_size])
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                break
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as exc:
+                self._force_close(exc)
+                return
+            del self._buffer[:sent]
+        if self._buffer:
+            if not self._writing:
+                self._writing = True
+                self._loop.add_writer(self._fd, self._write_ready)
+            return
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._fd)
+        if self._paused and len(self._buffer) <= self._low_water:
+            self._paused = False
+            self._protocol.resume_writing()
+        if self._closing:
+            self._shutdown()
+
+    def close(self):
+        """Close the connection once waiting data has been written."""
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        if not self._buffer:
+            self._loop.call_soon(self._shutdown)
+
+    def _shutdown(self):
+        """Send a TLS close_notify alert and close the connection."""
+        if self._closed:
+            return
+        try:
+            self._sock.unwrap()
+        except (OSError, ValueError):
+            # The alert is sent, the client's reply is not waited for.
+            pass
+        self._call_connection_lost(None)
+
+    def abort(self):
+        """Close the connection without writing any waiting data."""
+        self._force_close(None)
+
+    def _force_close(self, exc):
+        """
+        Close the connection straight away.
+
+        :param exc: The error, or :py:obj:`None` if the connection was
+                    aborted.
+        :type exc: :py:obj:`Exception` or :py:obj:`None`
+        """
+        if self._closed:
+            return
+        self._closing = True
+        self._buffer.clear()
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc):
+        """
+        Close the socket and tell the protocol.
+
+        :param exc: The error, or :py:obj:`None` if the connection was
+                    closed.
+        :type exc: :py:obj:`Exception` or :py:obj:`None`
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+
+
+class SocketHandshakeProtocol(asyncio.Protocol):
+    """
+    Complete the TLS handshake of a new connection on it's socket.
+
+    The connection's socket is taken from the plain transport before it is
+    read from, so OpenSSL reads and writes the socket itself instead of
+    memory buffers and can hand the connection's records to the kernel once
+    the handshake is complete. The connection is then handed to it's
+    protocol using a :class:`SocketTLSTransport`. --
+    https://kura.gg/blackhole/configuration.html#tls-ktls
+    """
+
+    def __init__(self, protocol, context, executor, timeout, loop=None):
+        """
+        Initialise the protocol.
+
+        :param asyncio.Protocol protocol: The protocol to hand the connection
+                                          to.
+        :param ssl.SSLContext context: The TLS context to use.
+        :param executor: The threads handshakes are done in, or
+                         :py:obj:`None` to do them on the event loop.
+        :type executor: :py:class:`concurrent.futures.ThreadPoolExecutor` or
+                        :py:obj:`None`
+        :param int timeout: Seconds the handshake must complete in.
+        :param loop: The event loop to use.
+        :type loop: :py:class:`asyncio.AbstractEventLoop` or :py:obj:`None`
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.protocol = protocol
+        self.context = context
+        self.executor = executor
+        self.timeout = timeout
+        self.sslsock = None
+        self.tls_transport = None
+        self.peername = None
+        self._closed = False
+        self._timeout_handle = None
+
+    def connection_made(self, transport):
+        """
+        Take the socket from the plain transport and start the handshake.
+
+        :param asyncio.transports.Transport transport: The plain transport.
+
+        .. note::
+
+           The socket is duplicated and the plain transport aborted, it has
+           not read from the socket yet and closes only it's own copy.
+        """
+        self.peername = transport.get_extra_info("peername")
+        raw = transport.get_extra_info("socket")
+        sock = socket.socket(
+            raw.family,
+            raw.type,
+            raw.proto,
+            fileno=os.dup(raw.fileno()),
+        )
+        transport.abort()
+        sock.setblocking(False)
+        self.sslsock = self.context.wrap_socket(
+            sock,
+            server_side=True,
+            do_handshake_on_connect=False,
+        )
+        self._timeout_handle = self.loop.call_later(
+            self.timeout,
+            self._handshake_failed,
+            "timed out",
+        )
+        self._handshake_step()
+
+    def connection_lost(self, exc):
+        """
+        The plain transport has let go of the socket.
+
+        :param exc: The error, or :py:obj:`None`.
+        :type exc: :py:obj:`Exception` or :py:obj:`None`
+        """
+
+    def _handshake_step(self):
+        """Continue the handshake, in a thread if there is a thread pool."""
+        if self.executor is None:
+            try:
+                want = socket_handshake(self.sslsock)
+            except OSError as err:
+                self._handshake_failed(err)
+                return
+            self._handshake_continue(want)
+            return
+        step = self.loop.run_in_executor(
+            self.executor,
+            socket_handshake,
+            self.sslsock,
+        )
+        step.add_done_callback(self._handshake_done)
+
+    def _handshake_done(self, future):
+        """
+        Continue once a step of the handshake in a thread is finished.
+
+        :param asyncio.Future future: The handshake step.
+        """
+        if future.cancelled() or self._closed:
+            return
+        try:
+            want = future.result()
+        except Exception as err:
+            self._handshake_failed(err)
+            return
+        self._handshake_continue(want)
+
+    def _handshake_continue(self, want):
+        """
+        Wait for the socket or hand over the connection once complete.
+
+        :param want: What the socket must be ready for, :py:obj:`None` once
+                     the handshake is complete.
+        :type want: :py:obj:`str` or :py:obj:`None`
+        """
+        if self._closed:
+            return
+        fd = self.sslsock.fileno()
+        if want == "read":
+            self.loop.add_reader(fd, self._handshake_ready)
+            return
+        if want == "write":
+            self.loop.add_writer(fd, self._handshake_ready)
+            return
+        self._timeout_handle.cancel()
+        self.tls_transport = SocketTLSTransport(
+            self.sslsock,
+            self.protocol,
+            self.loop,
+        )
+        self.tls_transport.start()
+
+    def _handshake_ready(self):
+        """The socket is ready, continue the handshake."""
+        fd = self.sslsock.fileno()
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self._handshake_step()
+
+    def _handshake_failed(self, exc):
+        """
+        Close a connection when it's handshake fails or times out.
+
+        :param exc: Why the handshake failed.
+        :type exc: :py:obj:`Exception` or :py:obj:`str`
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._timeout_handle.cancel()
+        _trace = trace(self.peername, self.protocol.config.debug_sample)
+        if _trace is not None:
+            _trace("TLS handshake failed: %s", exc)
+        fd = self.sslsock.fileno()
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self.sslsock.close()
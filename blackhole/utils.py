@@ -25,13 +25,31 @@
 """Provides utility functionality."""
 
 import codecs
+import functools
 import os
 import random
+import resource
 import socket
+import sys
 import time
 
 
-__all__ = ("blackhole_config_help", "mailname", "message_id", "get_version")
+try:
+    import ssl
+except ImportError:  # pragma: no cover
+    ssl = None
+
+
+__all__ = (
+    "available_cpus",
+    "blackhole_config_help",
+    "cpu_list",
+    "mailname",
+    "message_id",
+    "get_version",
+    "ktls_available",
+    "rss",
+)
 
 
 class Singleton(type):
@@ -89,6 +107,88 @@ def message_id(domain):
     return f"<{timeval}.{pid}.{randint}@{domain}>"
 
 
+def cpu_list(value):
+    """
+    Parse a list of CPUs in the Linux cpulist format, i.e. ``0-3,8``.
+
+    :param str value: A list of CPUs.
+    :returns: The CPUs, in the order they are listed.
+    :rtype: :py:obj:`tuple`
+    :raises ValueError: When the list of CPUs is invalid.
+    """
+    cpus = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first:
+            raise ValueError(f"{part} is not a valid range of CPUs")
+        cpus.extend(range(first, last + 1))
+    return tuple(cpus)
+
+
+@functools.lru_cache(maxsize=None)
+def available_cpus():
+    """
+    The CPUs Blackhole is allowed to run on.
+
+    :returns: The CPUs.
+    :rtype: :py:obj:`frozenset`
+
+    .. note::
+
+       Read once and cached, before the supervisor pins itself to it's own
+       CPUs, so that children forked later know every CPU they may use.
+    """
+    return frozenset(os.sched_getaffinity(0))
+
+
+def ktls_available():
+    """
+    Whether TLS records can be encrypted and decrypted by the kernel.
+
+    https://kura.gg/blackhole/configuration.html#tls-ktls
+
+    :returns: ``True`` when OpenSSL 3 is linked and the kernel's ``tls``
+              module is loaded.
+    :rtype: :py:obj:`bool`
+
+    .. note::
+
+       The ``tls`` module registers it's upper layer protocol in
+       ``/proc/sys/net/ipv4/tcp_available_ulp`` once it is loaded.
+    """
+    if ssl is None or ssl.OPENSSL_VERSION_INFO < (3,):
+        return False
+    try:
+        with open("/proc/sys/net/ipv4/tcp_available_ulp") as ulp:
+            return "tls" in ulp.read().split()
+    except OSError:
+        return False
+
+
+def rss():
+    """
+    The resident set size of the current process.
+
+    :returns: Resident set size in bytes.
+    :rtype: :py:obj:`int`
+
+    .. note::
+
+       Read from ``/proc/self/statm`` where available. Otherwise the peak
+       resident set size is used, which is never lower than the current size.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports the peak in bytes, everywhere else in kilobytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
 def get_version():
     """
     Extract the __version__ from a file without importing it.
@@ -161,7 +261,7 @@ class Formatter:
 
     {f.bold}listen{f.reset}
         {f.bold}Syntax{f.reset}
-            {f.bold}listen{f.reset} = {f.under}[address]:port [mode=MODE] [delay=DELAY]{f.reset}
+            {f.bold}listen{f.reset} = {f.under}[address]:port [mode=MODE] [delay=DELAY] [tls_cert=FILE tls_key=FILE]{f.reset}
 
         {f.bold}Default{f.reset}
             127.0.0.1:25,  127.0.0.1:587, :::25, :::587
@@ -170,6 +270,8 @@ class Formatter:
         {f.bold}Optional{f.reset}
             {f.under}mode={f.reset} and {f.under}delay={f.reset} -- allows setting a response mode and delay per
             listener.
+            {f.under}tls_cert={f.reset} and {f.under}tls_key={f.reset} -- allows setting a certificate and key per
+            listener, in place of tls_cert and tls_key.
 
         The {f.under}mode={f.reset} and {f.under}delay={f.reset} flags allow specific ports to act in different ways.
         i.e. you could accept all mail on 10.0.0.1:25 and bounce it all on
@@ -188,7 +290,7 @@ class Formatter:
 
     {f.bold}tls_listen{f.reset}
         {f.bold}Syntax{f.reset}
-            {f.bold}tls_listen{f.reset} = {f.under}[address]:port [mode=MODE] [delay=DELAY]{f.reset}
+            {f.bold}tls_listen{f.reset} = {f.under}[address]:port [mode=MODE] [delay=DELAY] [tls_cert=FILE tls_key=FILE]{f.reset}
 
         {f.bold}Default{f.reset}
             None
@@ -196,6 +298,8 @@ class Formatter:
         {f.bold}Optional{f.reset}
             {f.under}mode={f.reset} and {f.under}delay={f.reset} -- allows setting a response mode and delay per
             listener.
+            {f.under}tls_cert={f.reset} and {f.under}tls_key={f.reset} -- allows setting a certificate and key per
+            listener, in place of tls_cert and tls_key.
 
 
         :465 is equivalent to listening on port 465 on all IPv4 addresses and
@@ -355,7 +459,7 @@ class Formatter:
 
     {f.bold}workers{f.reset}
         {f.bold}Syntax{f.reset}
-            {f.bold}workers{f.reset} = {f.under}number{f.reset}
+            {f.bold}workers{f.reset} = {f.under}number | auto{f.reset}
 
         {f.bold}Default{f.reset}
             1
@@ -364,5 +468,219 @@ class Formatter:
         spawn to handle incoming mail. The absolute minimum is actually 2. Even
         by setting the workers value to 1, a supervisor process will always
         exist meaning that you would have 1 worker and a supervisor.
+
+        When set to auto, the number of workers is scaled with load, between
+        min_workers and max_workers.
+
+                                            ----
+
+    {f.bold}min_workers{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}min_workers{f.reset} = {f.under}number{f.reset}
+
+        {f.bold}Default{f.reset}
+            1
+
+        The minimum number of workers when workers = auto.
+
+                                            ----
+
+    {f.bold}max_workers{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}max_workers{f.reset} = {f.under}number{f.reset}
+
+        {f.bold}Default{f.reset}
+            The number of processors or cores.
+
+        The maximum number of workers when workers = auto.
+
+                                            ----
+
+    {f.bold}engine{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}engine{f.reset} = {f.under}stream | callback{f.reset}
+
+        {f.bold}Default{f.reset}
+            stream
+
+        The engine option allows you to choose how connections are handled.
+        The callback engine handles data as it is received, without a task
+        per connection, using less memory for each connection.
+
+                                            ----
+
+    {f.bold}debug_sample{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}debug_sample{f.reset} = {f.under}fraction{f.reset}
+
+        {f.bold}Default{f.reset}
+            1.0
+
+        The debug_sample option sets the fraction of connections that are
+        traced when debugging is enabled.
+
+                                            ----
+
+    {f.bold}reuse_port{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}reuse_port{f.reset} = {f.under}true | false{f.reset}
+
+        {f.bold}Default{f.reset}
+            false
+
+        The reuse_port option gives each worker it's own listening socket for
+        each listener, using SO_REUSEPORT, so the kernel balances new
+        connections between workers instead of waking every worker for each
+        connection.
+
+                                            ----
+
+    {f.bold}heartbeat_interval{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}heartbeat_interval{f.reset} = {f.under}seconds{f.reset}
+
+        {f.bold}Default{f.reset}
+            15
+
+        The heartbeat_interval option sets how often a worker pings it's
+        child. A child that has not responded for twice this interval is
+        restarted. A child that exits is restarted straight away.
+
+                                            ----
+
+    {f.bold}drain_timeout{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}drain_timeout{f.reset} = {f.under}seconds{f.reset}
+
+        {f.bold}Default{f.reset}
+            60
+
+        The drain_timeout option sets how long a child that is shutting down
+        waits for it's clients to finish their current mail transaction,
+        before disconnecting any that are left.
+
+                                            ----
+
+    {f.bold}worker_cpu_affinity{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}worker_cpu_affinity{f.reset} = {f.under}auto{f.reset} or {f.under}cpus [cpus]{f.reset}
+
+        {f.bold}Default{f.reset}
+            None -- children are not pinned
+
+        The worker_cpu_affinity option pins each worker's child to a set of
+        CPUs. Each space separated entry is a list of CPUs, i.e. 0-3,8, and
+        workers are given an entry each in turn. auto pins each child to a
+        single CPU, spreading children over physical cores and NUMA nodes.
+
+                                            ----
+
+    {f.bold}supervisor_cpu_affinity{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}supervisor_cpu_affinity{f.reset} = {f.under}cpus{f.reset}
+
+        {f.bold}Default{f.reset}
+            None -- the supervisor is not pinned
+
+        The supervisor_cpu_affinity option pins the supervisor and workers to
+        a list of CPUs, i.e. 0 or 0-1, keeping housekeeping off the CPUs
+        children are pinned to.
+
+                                            ----
+
+    {f.bold}spare_children{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}spare_children{f.reset} = {f.under}number{f.reset}
+
+        {f.bold}Default{f.reset}
+            0
+
+        The spare_children option sets how many standby children each worker
+        keeps, with their servers created but not accepting connections. When
+        a child exits or is restarted a spare takes over straight away.
+
+                                            ----
+
+    {f.bold}max_connections_per_child{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}max_connections_per_child{f.reset} = {f.under}number{f.reset}
+
+        {f.bold}Default{f.reset}
+            0 -- children are not recycled
+
+        The max_connections_per_child option sets how many connections a
+        child accepts before it drains it's clients and is replaced. Each
+        child's limit is raised by up to 10% at random so children are not
+        all replaced at once.
+
+                                            ----
+
+    {f.bold}max_child_rss{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}max_child_rss{f.reset} = {f.under}bytes{f.reset}
+
+        {f.bold}Default{f.reset}
+            0 -- children are not recycled
+
+        The max_child_rss option sets the resident memory a child can use
+        before it drains it's clients and is replaced. Each child's limit is
+        raised by up to 10% at random.
+
+    {f.bold}tls_ticket_rotation{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}tls_ticket_rotation{f.reset} = {f.under}seconds{f.reset}
+
+        {f.bold}Default{f.reset}
+            3600 -- 1 hour
+
+        The tls_ticket_rotation option sets the seconds between each rotation
+        of the TLS session ticket keys shared by every child. 0 keeps the
+        same keys until blackhole is restarted.
+
+    {f.bold}tls_handshake_threads{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}tls_handshake_threads{f.reset} = {f.under}threads{f.reset}
+
+        {f.bold}Default{f.reset}
+            0 -- handshakes are performed on the event loop
+
+        The tls_handshake_threads option sets the number of threads each
+        child performs the TLS handshakes of tls_listen connections in.
+
+    {f.bold}tls_sni{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}tls_sni{f.reset} = {f.under}hostname tls_cert=FILE tls_key=FILE{f.reset}
+
+        {f.bold}Default{f.reset}
+            None
+
+        The tls_sni option sets the certificate and key presented to clients
+        asking for a hostname with TLS Server Name Indication. A hostname of
+        *.example.com matches any single label in front of example.com.
+
+            tls_sni = mx.example.com tls_cert=/mx.crt tls_key=/mx.key
+
+    {f.bold}tls_watch_interval{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}tls_watch_interval{f.reset} = {f.under}seconds{f.reset}
+
+        {f.bold}Default{f.reset}
+            0 -- certificates are only loaded again when reloading
+
+        The tls_watch_interval option sets the seconds between each check of
+        the TLS certificate and key files for changes. Changed certificates
+        are loaded and every child is replaced, without refusing
+        connections.
+
+    {f.bold}tls_ktls{f.reset}
+        {f.bold}Syntax{f.reset}
+            {f.bold}tls_ktls{f.reset} = {f.under}true | false{f.reset}
+
+        {f.bold}Default{f.reset}
+            false
+
+        The tls_ktls option hands the encryption and decryption of TLS
+        records on tls_listen ports to the kernel, with OpenSSL's kernel TLS
+        support. Requires Linux, OpenSSL 3 and the kernel's tls module.
 '''.format(f=formatting)  # noqa
 # fmt: on
@@ -26,6 +26,7 @@
 
 
 import asyncio
+import gc
 import logging
 import os
 import signal
@@ -33,7 +34,8 @@
 
 from . import protocols
 from .child import Child
-from .control import setgid, setuid
+from .config import Config
+from .control import set_affinity, setgid, setuid, worker_cpus
 from .streams import StreamProtocol
 
 
@@ -61,6 +63,20 @@ class Worker:
 
     _started = False
     ping_count = 0
+    connections = 0
+    lag = 0.0
+    cpu = None
+    stats = None
+    writer = None
+    _cpu_time = None
+    _pidfd = None
+    spares = ()
+    recycling = ()
+    recycled = 0
+    ticket_keys = None
+
+    kill_interval = 0.05
+    """Seconds between checks of whether a killed child has exited."""
 
     def __init__(self, idx, socks, loop=None):
         """
@@ -87,40 +103,314 @@ def start(self):
         self.up_read, self.up_write = os.pipe()
         self.down_read, self.down_write = os.pipe()
 
-        self.pid = os.fork()
+        self.pid = self.fork()
         if self.pid > 0:  # Parent
+            self.watch_child()
             asyncio.ensure_future(self.connect())
+            self.spares = []
+            self.recycling = []
+            for _ in range(Config().spare_children):
+                self.spawn_spare()
         else:  # Child
             self.setup_child()
 
-    def setup_child(self):
-        """Set the gid, uid and start the child process.."""
+    def setup_child(self, spare=False):
+        """
+        Set the gid, uid and start the child process.
+
+        :param bool spare: Start a spare child. Default: ``False``.
+        """
         setgid()
         setuid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        set_affinity(worker_cpus(self.idx))
         asyncio.set_event_loop(None)
         if setproctitle:
             setproctitle.setproctitle("blackhole: worker")
-        process = Child(self.up_read, self.down_write, self.socks, self.idx)
+        process = Child(
+            self.up_read,
+            self.down_write,
+            self.socks,
+            self.idx,
+            spare=spare,
+        )
         process.start()
 
     def restart_child(self):
-        """Restart the child process."""
-        self.kill_child()
-        self.pid = os.fork()
+        """
+        Restart the child process.
+
+        .. note::
+
+           The child is sent :py:obj:`signal.SIGKILL` and replaced straight
+           away, it is reaped with the recycled children once it has exited
+           rather than waited for.
+        """
+        self.unwatch_child()
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        else:
+            self.recycling.append(self.pid)
+        self.replace_child()
+
+    def replace_child(self):
+        """Replace the child process with a spare child or a new child."""
+        if self.spares:
+            self.promote_spare()
+        else:
+            self.spawn_child()
+
+    def spawn_spare(self):
+        """
+        Fork off a spare child process for the current worker.
+
+        .. note::
+
+           Each spare child has it's own pipes, the worker connects to them
+           when the spare is promoted. --
+           https://kura.gg/blackhole/configuration.html#spare-children
+        """
+        up_read, up_write = os.pipe()
+        down_read, down_write = os.pipe()
+        pid = self.fork()
+        if pid > 0:
+            self.spares.append((pid, up_read, up_write, down_read, down_write))
+            return
+        self.up_read, self.down_write = up_read, down_write
+        self.setup_child(spare=True)
+
+    def promote_spare(self):
+        """
+        Replace the child process with a spare child.
+
+        .. note::
+
+           The worker stops communicating with the old child, which must have
+           exited, been killed or be draining it's clients, and connects to
+           the spare which is told to start accepting connections. A new
+           spare is forked once it has, if the worker needs one.
+        """
+        self.unwatch_child()
+        self.disconnect()
+        os.close(self.up_read)
+        os.close(self.down_write)
+        pid, *pipes = self.spares.pop(0)
+        logger.debug(f"worker.{self.idx}: Promoting spare child {pid}")
+        self.pid = pid
+        self.up_read, self.up_write, self.down_read, self.down_write = pipes
+        self.ping_count = 0
+        self.cpu, self._cpu_time = None, None
+        self.watch_child()
+        asyncio.ensure_future(self.serve_spare())
+
+    async def serve_spare(self):
+        """Connect to a promoted spare child and tell it to start serving."""
+        await self.connect()
+        self.send(protocols.SERVE)
+        if self._started and len(self.spares) < Config().spare_children:
+            self.spawn_spare()
+
+    def recycle_child(self, reason):
+        """
+        Replace a child that has reached it's connection or memory limit.
+
+        :param str reason: Why the child is being recycled.
+
+        .. note::
+
+           The child drains it's clients while it is replaced by a spare
+           child or, if the worker has no spares, a new child. It is reaped
+           once it exits. --
+           https://kura.gg/blackhole/configuration.html#max-connections-per-child
+        """
+        logger.info(
+            f"worker.{self.idx}: Recycling child {self.pid} after {reason}",
+        )
+        self.recycled += 1
+        self.recycling.append(self.pid)
+        if not self.spares:
+            self.spawn_spare()
+        self.promote_spare()
+
+    def reap_recycled(self):
+        """Reap any recycled child processes that have finished draining."""
+        for pid in list(self.recycling):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            logger.debug(f"worker.{self.idx}: Recycled child {pid} exited")
+            self.recycling.remove(pid)
+
+    def stop_spares(self):
+        """Kill every spare child and wait for them to exit."""
+        for pid, *pipes in self.spares:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ChildProcessError, ProcessLookupError):
+                pass
+            for fd in pipes:
+                os.close(fd)
+        self.spares = []
+
+    def reap_spares(self):
+        """Reap any spare child processes that have exited and replace them."""
+        for spare in list(self.spares):
+            pid, *pipes = spare
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            logger.error(f"worker.{self.idx}: Spare child {pid} exited")
+            self.spares.remove(spare)
+            for fd in pipes:
+                os.close(fd)
+            if self._started:
+                self.spawn_spare()
+
+    def spawn_child(self):
+        """Fork off a new child process for the current worker."""
+        self.pid = self.fork()
         if self.pid > 0:
             self.ping_count = 0
             self.ping = time.monotonic()
+            self.cpu, self._cpu_time = None, None
+            self.watch_child()
         else:
             self.setup_child()
 
-    def kill_child(self):
-        """Kill the child process."""
+    def fork(self):
+        """
+        Fork, keeping the garbage collector away from inherited objects.
+
+        :returns: The child's pid in the parent and ``0`` in the child.
+        :rtype: :py:obj:`int`
+
+        .. note::
+
+           Every object is moved in to the permanent generation with
+           :py:func:`gc.freeze` before forking, so the child's garbage
+           collector never touches, and un-shares, the memory pages it
+           inherited from the supervisor. The supervisor unfreezes it's
+           objects once the child has been forked.
+        """
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        pid = os.fork()
+        if pid > 0 and hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+        return pid
+
+    def terminate(self):
+        """Tell the child process to drain it's clients and exit."""
+        for pid in [self.pid, *self.recycling]:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    async def kill_child(self, sig=signal.SIGTERM):
+        """
+        Kill the child process and wait for it to exit.
+
+        :param int sig: The signal to send to the child. Default:
+                        :py:obj:`signal.SIGTERM`.
+
+        .. note::
+
+           A child sent :py:obj:`signal.SIGTERM` drains it's clients before
+           exiting. It is sent :py:obj:`signal.SIGKILL` if it has not exited
+           after ``drain_timeout`` seconds. --
+           https://kura.gg/blackhole/configuration.html#drain-timeout
+        """
+        self.unwatch_child()
+        await self.kill(self.pid, sig)
+
+    async def kill(self, pid, sig=signal.SIGTERM):
+        """
+        Send a signal to a child process and wait for it to exit.
+
+        :param int pid: The child process.
+        :param int sig: The signal to send to the child. Default:
+                        :py:obj:`signal.SIGTERM`.
+
+        .. note::
+
+           The child is polled without blocking, so the event loop carries
+           on serving the other workers while it drains. It is sent
+           :py:obj:`signal.SIGKILL` after ``drain_timeout`` seconds.
+        """
+        deadline = time.monotonic() + Config().drain_timeout + 1
+        killed = sig == signal.SIGKILL
         try:
-            os.kill(self.pid, signal.SIGTERM)
-            os.wait()
-        except ProcessLookupError:
+            os.kill(pid, sig)
+            while os.waitpid(pid, os.WNOHANG)[0] == 0:
+                if not killed and time.monotonic() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    killed = True
+                await asyncio.sleep(self.kill_interval)
+        except (ChildProcessError, ProcessLookupError):
             pass
 
+    def watch_child(self):
+        """
+        Watch for the child process exiting.
+
+        .. note::
+
+           Uses a process file descriptor, where supported, so the event loop
+           calls :meth:`reap` as soon as the child exits. The supervisor also
+           calls :meth:`reap` for every worker when it receives
+           :py:obj:`signal.SIGCHLD`.
+        """
+        try:
+            self._pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            return
+        self.loop.add_reader(self._pidfd, self.reap)
+
+    def unwatch_child(self):
+        """Stop watching for the child process exiting."""
+        if self._pidfd is None:
+            return
+        self.loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self._pidfd = None
+
+    def reap(self):
+        """
+        Reap the child process if it has exited and start a new one.
+
+        .. note::
+
+           Does not block, :py:func:`os.waitpid` is called with
+           :py:obj:`os.WNOHANG` for this worker's child and spares only.
+           The child is replaced with a spare child, if there is one.
+        """
+        self.reap_spares()
+        self.reap_recycled()
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        self.unwatch_child()
+        if not self._started:
+            return
+        logger.error(
+            f"worker.{self.idx}: Child {pid} exited with status {status}. "
+            "Restarting child",
+        )
+        self.replace_child()
+
     async def heartbeat(self, writer):
         """
         Handle heartbeat between a worker and child.
@@ -134,23 +424,28 @@ async def heartbeat(self, writer):
 
         .. note::
 
-           3 bytes are used in the communication channel.
+           Messages are framed with :const:`blackhole.protocols.HEADER`.
+
+           - :const:`blackhole.protocols.PING`
+           - :const:`blackhole.protocols.PONG`
 
-           - b'x01' -- :const:`blackhole.protocols.PING`
-           - b'x02' -- :const:`blackhole.protocols.PONG`
+           The worker will sleep for ``heartbeat_interval`` seconds, 15 by
+           default, before requesting a ping from the child. If we go for
+           over twice that waiting for a ping, the child is considered hung
+           and the worker will restart the child bound to it. --
+           https://kura.gg/blackhole/configuration.html#heartbeat-interval
 
-           The worker will sleep for 15 seconds, before requesting a ping from
-           the child. If we go for over 30 seconds waiting for a ping, the
-           worker will restart itself and the child bound to it.
+           A child that exits is restarted straight away by :meth:`reap`.
 
            These message values are defined in the :mod:`blackhole.protocols`
            schema. Documentation is available at --
            https://kura.gg/blackhole/api-protocols.html
         """
+        interval = Config().heartbeat_interval
         while self._started:
-            await asyncio.sleep(15)
-            if (time.monotonic() - self.ping) < 30:
-                writer.write(protocols.PING)
+            await asyncio.sleep(interval)
+            if (time.monotonic() - self.ping) < interval * 2:
+                writer.write(protocols.frame(protocols.PING))
             else:
                 if self._started:
                     logger.debug(
@@ -171,13 +466,17 @@ async def chat(self, reader):
 
         .. note::
 
-           3 bytes are used in the communication channel.
+           Messages are framed with :const:`blackhole.protocols.HEADER`.
 
-           - b'x01' -- :const:`blackhole.protocols.PING`
-           - b'x02' -- :const:`blackhole.protocols.PONG`
+           - :const:`blackhole.protocols.PONG`
+           - :const:`blackhole.protocols.STATS`
+           - :const:`blackhole.protocols.RECYCLE`
 
            Read data coming in from the child. If a PONG is received, we'll
            update the worker, setting this PONG as a 'PING' from the child.
+           If STATS are received, we'll record them with
+           :meth:`update_stats`. If the child asks to be recycled it is
+           replaced with :meth:`recycle_child`.
 
            These message values are defined in the :mod:`blackhole.protocols`
            schema. Documentation is available at --
@@ -185,16 +484,79 @@ async def chat(self, reader):
         """
         while self._started:
             try:
-                msg = await reader.read(3)
-                if msg == protocols.PONG:
+                kind, body = await protocols.read_frame(reader)
+                if kind == protocols.PONG:
                     logger.debug(
                         f"worker.{self.idx}.chat: Pong received from child",
                     )
                     self.ping = time.monotonic()
                     self.ping_count += 1
+                elif kind == protocols.STATS:
+                    self.update_stats(protocols.Stats.unpack(body))
+                elif kind == protocols.RECYCLE:
+                    self.recycle_child(body.decode("utf-8"))
+            except asyncio.CancelledError:
+                raise
             except:  # noqa
-                self.stop()
-            await asyncio.sleep(5)
+                if self._started:
+                    await self.stop()
+
+    def update_stats(self, stats):
+        """
+        Record the stats reported by the child.
+
+        :param blackhole.protocols.Stats stats: The child's stats.
+
+        .. note::
+
+           :attr:`cpu` is the fraction of a CPU used by the child, averaged
+           over the last few reports. It is :py:obj:`None` until two reports
+           have been received from the same child.
+        """
+        now = time.monotonic()
+        if self._cpu_time is not None:
+            used, since = self._cpu_time
+            cpu = (stats.cpu - used) / max(now - since, 0.001)
+            self.cpu = cpu if self.cpu is None else self.cpu * 0.8 + cpu * 0.2
+        self._cpu_time = (stats.cpu, now)
+        self.stats = stats
+        self.connections = stats.connections
+        self.lag = stats.lag
+
+    def send(self, kind, body=b""):
+        """
+        Send a control message to the child.
+
+        :param int kind: The message type, i.e.
+                         :const:`blackhole.protocols.DRAIN`.
+        :param bytes body: The body of the message. Default: ``b""``.
+
+        .. note::
+
+           - :const:`blackhole.protocols.DRAIN` -- stop accepting
+             connections.
+           - :const:`blackhole.protocols.TICKETS` -- the body is the TLS
+             session ticket keys.
+        """
+        self.writer.write(protocols.frame(kind, body))
+
+    def set_ticket_keys(self, keys):
+        """
+        Give the child new TLS session ticket keys.
+
+        https://kura.gg/blackhole/configuration.html#tls-ticket-rotation
+
+        :param bytes keys: The keys generated by the supervisor.
+
+        .. note::
+
+           The keys are kept and sent again each time the worker connects to
+           a child, so a spare child forked before the keys were rotated is
+           given them when it is promoted.
+        """
+        self.ticket_keys = keys
+        if self.writer is not None:
+            self.send(protocols.TICKETS, keys)
 
     async def connect(self):
         """
@@ -218,14 +580,55 @@ async def connect(self):
         self.ping = time.monotonic()
         self.rtransport = r_trans
         self.wtransport = w_trans
+        self.writer = writer
         self.chat_task = asyncio.ensure_future(self.chat(reader))
         self.heartbeat_task = asyncio.ensure_future(self.heartbeat(writer))
+        if self.ticket_keys is not None:
+            self.send(protocols.TICKETS, self.ticket_keys)
 
-    def stop(self):
-        """Terminate the worker and it's respective child process."""
-        self.kill_child()
-        self._started = False
+    async def drain(self):
+        """
+        Stop the child accepting new connections and wait for it's clients.
+
+        .. note::
+
+           Returns once the child reports that it has no connected clients or
+           after ``drain_timeout`` seconds. The child is no longer monitored
+           or restarted and spare children are stopped, the worker should be
+           stopped with :meth:`stop` afterwards. --
+           https://kura.gg/blackhole/configuration.html#drain-timeout
+        """
+        self.heartbeat_task.cancel()
+        self.unwatch_child()
+        self.stop_spares()
+        self.send(protocols.DRAIN)
+        deadline = time.monotonic() + Config().drain_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(1)
+            if not self.connections:
+                break
+
+    def disconnect(self):
+        """Stop communicating with the child process."""
         self.chat_task.cancel()
         self.heartbeat_task.cancel()
         self.rtransport.close()
         self.wtransport.close()
+
+    async def stop(self):
+        """
+        Terminate the worker, it's child and spare child processes.
+
+        .. note::
+
+           The worker is marked as stopped before waiting for it's children
+           to exit, so a child that exits in the meantime is not replaced.
+        """
+        self._started = False
+        self.stop_spares()
+        recycling, self.recycling = self.recycling, []
+        await asyncio.gather(
+            self.kill_child(),
+            *(self.kill(pid) for pid in recycling),
+        )
+        self.disconnect()
@@ -0,0 +1,1125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (The MIT License)
+#
+# Copyright (c) 2013-2021 Kura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the 'Software'), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Micro benchmarks for the blackhole SMTP engine.
+
+Each benchmark runs an in-process server on an ephemeral port in a background
+thread and drives it from the calling thread, so results can be compared
+between two checkouts of the code base.
+
+    python scripts/benchmark.py dispatch
+    python scripts/benchmark.py flood --commands 20000
+    python scripts/benchmark.py connect --connections 2000
+    python scripts/benchmark.py data --megabytes 50
+    python scripts/benchmark.py --engine callback idle --connections 10000
+    python scripts/benchmark.py churn --connections 50000 --churn 20000
+    python scripts/benchmark.py accept --workers 8 --reuse-port
+    python scripts/benchmark.py placement --worker-cpu-affinity auto
+    python scripts/benchmark.py starttls --tls-cert crt.pem --tls-key key.pem
+    python scripts/benchmark.py resume --tls-cert crt.pem --tls-key key.pem
+    python scripts/benchmark.py storm --tls-cert crt.pem --tls-key key.pem
+    python scripts/benchmark.py ktls --tls-cert crt.pem --tls-key key.pem
+
+The SMTP protocol engine can be chosen with ``--engine``, as with the
+``engine`` configuration option. ``--debug-sample`` enables debug logging,
+written to /dev/null, for a fraction of connections, as with the
+``debug_sample`` configuration option.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import gc
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import ssl
+import statistics
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from blackhole.config import Config  # noqa: E402
+from blackhole.control import (  # noqa: E402
+    _context,
+    _socket,
+    set_affinity,
+    set_ticket_keys,
+    ticket_keys,
+    worker_cpus,
+)
+from blackhole.protocols import Stats  # noqa: E402
+from blackhole.smtp import ENGINES, Smtp  # noqa: E402
+from blackhole.tls import (  # noqa: E402
+    HandshakeProtocol,
+    SocketHandshakeProtocol,
+)
+from blackhole.utils import available_cpus, ktls_available  # noqa: E402
+
+
+class Server:
+    """An SMTP server running on it's own event loop in a thread."""
+
+    def __init__(self, factory=None):
+        """
+        Initialise the server.
+
+        :param factory: A callable returning a protocol instance.
+        """
+        config = Config()
+        self.sock = _socket("127.0.0.1", 0, socket.AF_INET)
+        self.factory = factory or functools.partial(
+            ENGINES[config.engine],
+            set(),
+            snapshot=config.snapshot(*self.sock.getsockname()),
+            stats=Stats(),
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            self.loop.create_server(self.factory, sock=self.sock),
+        )
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+        server.close()
+        self.loop.close()
+
+    def __enter__(self):
+        """Start the server."""
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        return self.sock.getsockname()
+
+    def __exit__(self, *args):
+        """Stop the server."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def connect(addr):
+    """
+    Connect to the server and consume the greeting.
+
+    :param tuple addr: The address and port to connect to.
+    :returns: A connected socket.
+    :rtype: :py:func:`socket.socket`
+    """
+    client = socket.create_connection(addr)
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    read_responses(client, 1)
+    return client
+
+
+def read_responses(client, count):
+    """
+    Read a number of final response lines from the server.
+
+    :param socket.socket client: A connected socket.
+    :param int count: The number of final (non-continuation) responses.
+    """
+    buf = b""
+    seen = 0
+    while seen < count:
+        data = client.recv(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        buf += data
+        lines = buf.split(b"\r\n")
+        buf = lines.pop()
+        seen += sum(1 for line in lines if line[3:4] == b" ")
+
+
+def rss():
+    """
+    Get the resident set size of this process, only supported on Linux.
+
+    :returns: Resident set size in bytes.
+    :rtype: :py:obj:`int`
+    """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def raise_fd_limit(sockets):
+    """
+    Raise the open file limit to allow a number of sockets.
+
+    :param int sockets: The number of sockets to open.
+    """
+    needed = sockets + 64
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < needed:
+        raise SystemExit(
+            f"{sockets} sockets need {needed} open files, the hard limit is "
+            f"{hard}",
+        )
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def hold_connections(addr, count, ready, done):
+    """
+    Open idle connections and hold them open until told to close them.
+
+    :param tuple addr: The address and port to connect to.
+    :param int count: The number of connections to open.
+    :param multiprocessing.Event ready: Set once the connections are open.
+    :param multiprocessing.Event done: Set to close the connections.
+    """
+    raise_fd_limit(count)
+    clients = [connect(addr) for _ in range(count)]
+    ready.set()
+    done.wait()
+    for client in clients:
+        client.close()
+
+
+def serve_accepts(sock, accepts, idx, done):
+    """
+    Serve connections in a worker process, counting the connections accepted.
+
+    :param socket.socket sock: The listening socket.
+    :param multiprocessing.Array accepts: Connections accepted by each worker.
+    :param int idx: The index of this worker in ``accepts``.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    config = Config()
+    protocol = ENGINES[config.engine]
+    snapshot = config.snapshot(*sock.getsockname())
+    loop = asyncio.new_event_loop()
+
+    def factory():
+        accepts[idx] += 1
+        return protocol(set(), loop=loop, snapshot=snapshot)
+
+    loop.run_until_complete(loop.create_server(factory, sock=sock))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+
+
+def open_sessions(addr, count):
+    """
+    Open connections, send QUIT and wait for the server to close them.
+
+    :param tuple addr: The address and port to connect to.
+    :param int count: The number of connections to open.
+    """
+    for _ in range(count):
+        client = connect(addr)
+        client.sendall(b"QUIT\r\n")
+        read_responses(client, 1)
+        client.close()
+
+
+def bench_accept(args):
+    """Spread connections over worker processes, report the distribution."""
+    context = multiprocessing.get_context("fork")
+    accepts = context.Array("l", args.workers, lock=False)
+    done = context.Event()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    addr = sock.getsockname()
+    # Without --reuse-port every worker accepts from the same socket, as
+    # children do by default. With it each worker has it's own socket.
+    socks = [sock] * args.workers
+    if args.reuse_port:
+        socks = [sock] + [
+            _socket(*addr, socket.AF_INET) for _ in range(args.workers - 1)
+        ]
+    workers = [
+        context.Process(target=serve_accepts, args=(s, accepts, idx, done))
+        for idx, s in enumerate(socks)
+    ]
+    for worker in workers:
+        worker.start()
+    clients = [
+        context.Process(
+            target=open_sessions,
+            args=(addr, args.connections // args.clients),
+        )
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    took = time.perf_counter() - start
+    done.set()
+    for worker in workers:
+        worker.join()
+    counts = list(accepts)
+    total = sum(counts)
+    mode = "own sockets" if args.reuse_port else "shared socket"
+    print(
+        f"{total} sessions over {args.workers} workers ({mode}) in "
+        f"{took:.3f}s -- {total / took:,.0f} conn/sec",
+    )
+    print(
+        f"accepted per worker: min {min(counts)}, max {max(counts)}, "
+        f"stdev {statistics.pstdev(counts):.1f} -- {counts}",
+    )
+
+
+def serve_pinned(sock, idx, results, done):
+    """
+    Serve connections in a worker process pinned as a child would be.
+
+    :param socket.socket sock: The listening socket.
+    :param int idx: The index of this worker.
+    :param multiprocessing.Array results: Messages received and CPU seconds
+                                          used by each worker.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    set_affinity(worker_cpus(str(idx + 1)))
+    config = Config()
+    protocol = ENGINES[config.engine]
+    snapshot = config.snapshot(*sock.getsockname())
+    stats = Stats()
+    loop = asyncio.new_event_loop()
+
+    def factory():
+        return protocol(set(), loop=loop, snapshot=snapshot, stats=stats)
+
+    loop.run_until_complete(loop.create_server(factory, sock=sock))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results[idx * 2] = stats.messages
+    results[idx * 2 + 1] = usage.ru_utime + usage.ru_stime
+
+
+def send_messages(addr, sessions, messages):
+    """
+    Open sessions and send a number of messages in each of them.
+
+    :param tuple addr: The address and port to connect to.
+    :param int sessions: The number of sessions to open.
+    :param int messages: The number of messages to send in each session.
+    """
+    # Clients may use any CPU, not the CPUs the benchmark was pinned to.
+    set_affinity(set(available_cpus()))
+    message = (
+        b"MAIL FROM: <kura@example.com>\r\nRCPT TO: <kura@example.com>\r\n"
+        b"DATA\r\nSubject: benchmark\r\nX-Blackhole-Mode: accept\r\n\r\n"
+        + b"x" * 76
+        + b"\r\n.\r\n"
+    )
+    for _ in range(sessions):
+        client = connect(addr)
+        for _ in range(messages):
+            client.sendall(message)
+            read_responses(client, 4)
+        client.sendall(b"QUIT\r\n")
+        read_responses(client, 1)
+        client.close()
+
+
+def bench_placement(args):
+    """Send messages to pinned worker processes, report per worker rates."""
+    config = Config()
+    config.worker_cpu_affinity = args.worker_cpu_affinity
+    config.supervisor_cpu_affinity = args.supervisor_cpu_affinity
+    config.test_worker_cpu_affinity()
+    config.test_supervisor_cpu_affinity()
+    available_cpus()
+    context = multiprocessing.get_context("fork")
+    results = context.Array("d", args.workers * 2, lock=False)
+    done = context.Event()
+    # Each worker has it's own socket, as with reuse_port, so the kernel
+    # spreads connections evenly and differences are down to placement.
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    addr = sock.getsockname()
+    socks = [sock] + [
+        _socket(*addr, socket.AF_INET) for _ in range(args.workers - 1)
+    ]
+    workers = [
+        context.Process(target=serve_pinned, args=(s, idx, results, done))
+        for idx, s in enumerate(socks)
+    ]
+    for worker in workers:
+        worker.start()
+    # This process stands in for the supervisor.
+    cpus = config.supervisor_cpu_affinity
+    set_affinity(None if cpus is None else set(cpus))
+    sessions = max(args.messages // args.per_session // args.clients, 1)
+    clients = [
+        context.Process(
+            target=send_messages,
+            args=(addr, sessions, args.per_session),
+        )
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    took = time.perf_counter() - start
+    done.set()
+    for worker in workers:
+        worker.join()
+    total = sum(results[::2])
+    print(
+        f"{total:.0f} messages over {args.workers} workers in {took:.3f}s -- "
+        f"{total / took:,.0f} msgs/sec",
+    )
+    for idx in range(args.workers):
+        messages, cpu = results[idx * 2], results[idx * 2 + 1]
+        pinned = worker_cpus(str(idx + 1))
+        pinned = (
+            "any" if pinned is None else ",".join(map(str, sorted(pinned)))
+        )
+        print(
+            f"worker {idx + 1:<3} cpus {pinned:<12} {messages:>8.0f} messages "
+            f"{messages / took:>10,.0f} msgs/sec {cpu:>7.2f} cpu secs "
+            f"{messages / max(cpu, 0.001):>10,.0f} msgs/cpu sec",
+        )
+
+
+def serve_starttls(sock, results, done):
+    """
+    Serve connections offering STARTTLS in a worker process.
+
+    :param socket.socket sock: The listening socket.
+    :param multiprocessing.Array results: CPU seconds used by the worker.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    config = Config()
+    protocol = ENGINES[config.engine]
+    starttls = _context(use_tls=True)
+    snapshot = config.snapshot(*sock.getsockname(), starttls)
+    loop = asyncio.new_event_loop()
+
+    def factory():
+        return protocol(set(), loop=loop, snapshot=snapshot)
+
+    loop.run_until_complete(loop.create_server(factory, sock=sock))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results[0] = usage.ru_utime + usage.ru_stime
+
+
+def upgrade_sessions(addr, count):
+    """
+    Open connections, upgrade them with STARTTLS and send QUIT.
+
+    :param tuple addr: The address and port to connect to.
+    :param int count: The number of connections to open.
+    """
+    # Sessions are not resumed, every upgrade is a full handshake.
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    for _ in range(count):
+        client = connect(addr)
+        client.sendall(b"STARTTLS\r\n")
+        read_responses(client, 1)
+        client = context.wrap_socket(client)
+        client.sendall(b"QUIT\r\n")
+        read_responses(client, 1)
+        client.close()
+
+
+def bench_starttls(args):
+    """Upgrade connections with STARTTLS, report handshakes per second."""
+    config = Config()
+    config.tls_cert, config.tls_key = args.tls_cert, args.tls_key
+    config.args = args
+    context = multiprocessing.get_context("fork")
+    results = context.Array("d", 1, lock=False)
+    done = context.Event()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    addr = sock.getsockname()
+    worker = context.Process(target=serve_starttls, args=(sock, results, done))
+    worker.start()
+    sessions = max(args.connections // args.clients, 1)
+    clients = [
+        context.Process(target=upgrade_sessions, args=(addr, sessions))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    took = time.perf_counter() - start
+    done.set()
+    worker.join()
+    total = sessions * args.clients
+    cpu = results[0]
+    print(
+        f"{total} STARTTLS sessions in {took:.3f}s -- "
+        f"{total / took:,.0f} handshakes/sec",
+    )
+    print(
+        f"worker used {cpu:.2f} cpu secs -- "
+        f"{total / max(cpu, 0.001):,.0f} handshakes/cpu sec per worker",
+    )
+
+
+def serve_tls(sock, tls, results, idx, done):
+    """
+    Serve TLS connections in a worker process.
+
+    :param socket.socket sock: The listening socket.
+    :param tls: The TLS context or :py:obj:`None` to create one.
+    :type tls: :py:class:`ssl.SSLContext` or :py:obj:`None`
+    :param multiprocessing.Array results: CPU seconds used by each worker.
+    :param int idx: The index of this worker in ``results``.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    config = Config()
+    protocol = ENGINES[config.engine]
+    snapshot = config.snapshot(*sock.getsockname())
+    if tls is None:
+        tls = _context(use_tls=True)
+    loop = asyncio.new_event_loop()
+
+    def factory():
+        return protocol(set(), loop=loop, snapshot=snapshot)
+
+    loop.run_until_complete(loop.create_server(factory, sock=sock, ssl=tls))
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results[idx] = usage.ru_utime + usage.ru_stime
+
+
+def tls_sessions(addr, count, resume, reused):
+    """
+    Open TLS connections and send QUIT, optionally resuming the TLS session.
+
+    :param tuple addr: The address and port to connect to.
+    :param int count: The number of connections to open.
+    :param bool resume: Resume the session of the previous connection.
+    :param multiprocessing.Value reused: Incremented for each resumption.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    session = None
+    for _ in range(count):
+        client = context.wrap_socket(
+            socket.create_connection(addr),
+            session=session,
+        )
+        read_responses(client, 1)
+        client.sendall(b"QUIT\r\n")
+        read_responses(client, 1)
+        if client.session_reused:
+            with reused.get_lock():
+                reused.value += 1
+        # TLSv1.3 tickets arrive after the handshake, take the session once
+        # the greeting has been read.
+        if resume:
+            session = client.session
+        client.close()
+
+
+def bench_resume(args):
+    """Compare full and resumed TLS handshakes per second over workers."""
+    config = Config()
+    config.tls_cert, config.tls_key = args.tls_cert, args.tls_key
+    config.args = args
+    context = multiprocessing.get_context("fork")
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    addr = sock.getsockname()
+    # Each worker has it's own socket, so a client reconnecting is as likely
+    # to reach another worker as it was with a child per CPU.
+    socks = [sock] + [
+        _socket(*addr, socket.AF_INET) for _ in range(args.workers - 1)
+    ]
+    tls = None
+    if not args.per_worker_keys:
+        tls = _context(use_tls=True)
+        if not set_ticket_keys([tls], ticket_keys()):
+            raise SystemExit("Unable to set TLS session ticket keys")
+    sessions = max(args.connections // args.clients, 1)
+    for resume in (False, True):
+        results = context.Array("d", args.workers, lock=False)
+        reused = context.Value("l", 0)
+        done = context.Event()
+        workers = [
+            context.Process(
+                target=serve_tls,
+                args=(s, tls, results, idx, done),
+            )
+            for idx, s in enumerate(socks)
+        ]
+        for worker in workers:
+            worker.start()
+        clients = [
+            context.Process(
+                target=tls_sessions,
+                args=(addr, sessions, resume, reused),
+            )
+            for _ in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        took = time.perf_counter() - start
+        done.set()
+        for worker in workers:
+            worker.join()
+        total = sessions * args.clients
+        cpu = sum(results)
+        mode = "resumed" if resume else "full"
+        print(
+            f"{mode:>8}: {total} sessions ({reused.value} resumed) in "
+            f"{took:.3f}s -- {total / took:,.0f} handshakes/sec, "
+            f"{total / max(cpu, 0.001):,.0f} handshakes/cpu sec",
+        )
+    for s in socks:
+        s.close()
+
+
+def serve_storm(plain, tls, threads, results, done):
+    """
+    Serve a plain and a TLS listener, recording the event loop's lag.
+
+    :param socket.socket plain: The plain listening socket.
+    :param socket.socket tls: The TLS listening socket.
+    :param int threads: Threads to do TLS handshakes in, ``0`` to do them on
+                        the event loop.
+    :param multiprocessing.Array results: The median, 99th percentile and
+                                          maximum lag, and CPU seconds used.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    config = Config()
+    protocol = ENGINES[config.engine]
+    context = _context(use_tls=True)
+    loop = asyncio.new_event_loop()
+    executor = None
+    if threads:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def factory(sock):
+        snapshot = config.snapshot(*sock.getsockname())
+        return protocol(set(), loop=loop, snapshot=snapshot)
+
+    def handshake_factory():
+        return HandshakeProtocol(
+            factory(tls),
+            context,
+            executor,
+            config.timeout,
+            loop=loop,
+        )
+
+    lags = []
+
+    async def measure():
+        while True:
+            slept = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append(time.monotonic() - slept - 0.01)
+
+    loop.run_until_complete(
+        loop.create_server(functools.partial(factory, plain), sock=plain),
+    )
+    if executor is None:
+        server = loop.create_server(
+            functools.partial(factory, tls),
+            sock=tls,
+            ssl=context,
+        )
+    else:
+        server = loop.create_server(handshake_factory, sock=tls)
+    loop.run_until_complete(server)
+    task = loop.create_task(measure())
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+    task.cancel()
+    lags.sort()
+    results[0] = lags[len(lags) // 2]
+    results[1] = lags[int(len(lags) * 0.99)]
+    results[2] = lags[-1]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results[3] = usage.ru_utime + usage.ru_stime
+
+
+def probe_latency(addr, results, done):
+    """
+    Send NOOP over a plain session until told to stop, recording latency.
+
+    :param tuple addr: The address and port to connect to.
+    :param multiprocessing.Array results: The median, 99th percentile and
+                                          maximum latency.
+    :param multiprocessing.Event done: Set to stop probing.
+    """
+    client = connect(addr)
+    latencies = []
+    while not done.is_set():
+        start = time.perf_counter()
+        client.sendall(b"NOOP\r\n")
+        read_responses(client, 1)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    client.close()
+    latencies.sort()
+    results[0] = latencies[len(latencies) // 2]
+    results[1] = latencies[int(len(latencies) * 0.99)]
+    results[2] = latencies[-1]
+
+
+def bench_storm(args):
+    """Measure loop lag and plain session latency during a TLS storm."""
+    config = Config()
+    config.tls_cert, config.tls_key = args.tls_cert, args.tls_key
+    config.args = args
+    context = multiprocessing.get_context("fork")
+    plain = _socket("127.0.0.1", 0, socket.AF_INET)
+    tls = _socket("127.0.0.1", 0, socket.AF_INET)
+    sessions = max(args.connections // args.clients, 1)
+    for threads in (0, args.threads):
+        lag = context.Array("d", 4, lock=False)
+        latency = context.Array("d", 3, lock=False)
+        reused = context.Value("l", 0)
+        done, probed = context.Event(), context.Event()
+        worker = context.Process(
+            target=serve_storm,
+            args=(plain, tls, threads, lag, done),
+        )
+        worker.start()
+        probe = context.Process(
+            target=probe_latency,
+            args=(plain.getsockname(), latency, probed),
+        )
+        probe.start()
+        clients = [
+            context.Process(
+                target=tls_sessions,
+                args=(tls.getsockname(), sessions, False, reused),
+            )
+            for _ in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        took = time.perf_counter() - start
+        probed.set()
+        probe.join()
+        done.set()
+        worker.join()
+        total = sessions * args.clients
+        mode = f"{threads} threads" if threads else "event loop"
+        print(
+            f"{mode:>10}: {total} handshakes in {took:.3f}s -- "
+            f"{total / took:,.0f} handshakes/sec, {lag[3]:.2f} cpu secs",
+        )
+        print(
+            f"{'':>10}  loop lag ms p50 {lag[0] * 1000:.2f}, "
+            f"p99 {lag[1] * 1000:.2f}, max {lag[2] * 1000:.2f} -- "
+            f"NOOP ms p50 {latency[0] * 1000:.2f}, "
+            f"p99 {latency[1] * 1000:.2f}, max {latency[2] * 1000:.2f}",
+        )
+    plain.close()
+    tls.close()
+
+
+def serve_ktls(sock, ktls, results, done):
+    """
+    Serve a TLS listener with asyncio's TLS or on the socket with kTLS.
+
+    :param socket.socket sock: The TLS listening socket.
+    :param bool ktls: Serve connections from the socket with ``tls_ktls``,
+                      otherwise with asyncio's TLS transport.
+    :param multiprocessing.Array results: CPU seconds used and the number of
+                                          connections sending and receiving
+                                          with kTLS.
+    :param multiprocessing.Event done: Set to stop serving.
+    """
+    config = Config()
+    config.tls_ktls = str(ktls).lower()
+    context = _context(use_tls=True)
+    loop = asyncio.new_event_loop()
+    snapshot = config.snapshot(*sock.getsockname())
+
+    class Recorder(ENGINES[config.engine]):
+        def connection_made(self, transport):
+            super().connection_made(transport)
+            engaged = transport.get_extra_info("ktls")
+            if engaged is not None:
+                results[1] += engaged[0]
+                results[2] += engaged[1]
+
+    def factory():
+        client = Recorder(set(), loop=loop, snapshot=snapshot)
+        if ktls:
+            client = SocketHandshakeProtocol(
+                client,
+                context,
+                None,
+                config.timeout,
+                loop=loop,
+            )
+        return client
+
+    if ktls:
+        server = loop.create_server(factory, sock=sock)
+    else:
+        server = loop.create_server(factory, sock=sock, ssl=context)
+    loop.run_until_complete(server)
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    loop.run_until_complete(loop.run_in_executor(None, done.wait))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results[0] = (
+        usage.ru_utime - start.ru_utime + usage.ru_stime - start.ru_stime
+    )
+
+
+def send_tls_messages(addr, sessions, messages, body):
+    """
+    Send messages over SMTPS sessions.
+
+    :param tuple addr: The address and port to connect to.
+    :param int sessions: The number of sessions to open.
+    :param int messages: The number of messages to send per session.
+    :param bytes body: The message to send.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    for _ in range(sessions):
+        client = context.wrap_socket(socket.create_connection(addr))
+        read_responses(client, 1)
+        for _ in range(messages):
+            client.sendall(b"MAIL FROM: <kura@example.com>\r\n")
+            client.sendall(b"RCPT TO: <kura@example.com>\r\nDATA\r\n")
+            read_responses(client, 3)
+            client.sendall(body)
+            client.sendall(b".\r\n")
+            read_responses(client, 1)
+        client.sendall(b"QUIT\r\n")
+        read_responses(client, 1)
+        client.close()
+
+
+def bench_ktls(args):
+    """Measure the throughput of large messages over TLS with kTLS."""
+    config = Config()
+    config.tls_cert, config.tls_key = args.tls_cert, args.tls_key
+    config.max_message_size = args.megabytes * 1024 * 1024 * 2
+    config.args = args
+    context = multiprocessing.get_context("fork")
+    line = b"x" * 76 + b"\r\n"
+    headers = b"Subject: benchmark\r\nX-Blackhole-Mode: accept\r\n\r\n"
+    body = headers + line * (args.megabytes * 1024 * 1024 // len(line))
+    sessions = max(args.sessions // args.clients, 1)
+    print(f"kernel TLS available: {ktls_available()}")
+    for ktls in (False, True):
+        sock = _socket("127.0.0.1", 0, socket.AF_INET)
+        results = context.Array("d", 3, lock=False)
+        done = context.Event()
+        worker = context.Process(
+            target=serve_ktls,
+            args=(sock, ktls, results, done),
+        )
+        worker.start()
+        clients = [
+            context.Process(
+                target=send_tls_messages,
+                args=(sock.getsockname(), sessions, args.messages, body),
+            )
+            for _ in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        took = time.perf_counter() - start
+        done.set()
+        worker.join()
+        sock.close()
+        total = sessions * args.clients * args.messages
+        megabytes = total * len(body) / 1024 / 1024
+        mode = "socket" if ktls else "asyncio"
+        print(
+            f"{mode:>7}: {total} x {args.megabytes} MB messages in "
+            f"{took:.3f}s -- {megabytes / took:,.1f} MB/sec, "
+            f"{results[0]:.2f} server cpu secs, "
+            f"{megabytes / max(results[0], 0.001):,.1f} MB/cpu sec",
+        )
+        if ktls:
+            print(
+                f"{'':>7}  kTLS send on {results[1]:.0f}, receive on "
+                f"{results[2]:.0f} of {sessions * args.clients} connections",
+            )
+
+
+def bench_dispatch(args):
+    """Time :py:meth:`blackhole.smtp.Smtp.lookup_handler` per command."""
+    smtp = Smtp(set())
+    lines = (
+        "NOOP",
+        "RCPT TO: <kura@example.com>",
+        "MAIL FROM: <kura@example.com>",
+        "HELP DATA",
+        "AUTH PLAIN",
+        "KURA",
+    )
+    for line in lines:
+        took = timeit.timeit(
+            lambda: smtp.lookup_handler(line),
+            number=args.iterations,
+        )
+        rate = args.iterations / took
+        print(f"{line[:24]:<26}{rate:>14,.0f} lookups/sec")
+
+
+def bench_flood(args):
+    """Pipeline NOOP/RCPT commands and report commands per second."""
+    cmds = (b"NOOP\r\n", b"RCPT TO: <kura@example.com>\r\n")
+    payload = b"".join(cmds[i % 2] for i in range(args.batch))
+    batches = max(args.commands // args.batch, 1)
+    with Server() as addr:
+        client = connect(addr)
+        start = time.perf_counter()
+        for _ in range(batches):
+            client.sendall(payload)
+            read_responses(client, args.batch)
+        took = time.perf_counter() - start
+        client.close()
+    total = batches * args.batch
+    print(f"{total} commands in {took:.3f}s -- {total / took:,.0f} cmds/sec")
+
+
+def bench_connect(args):
+    """Open connections, send EHLO and QUIT, report connections per second."""
+    with Server() as addr:
+        start = time.perf_counter()
+        for _ in range(args.connections):
+            client = connect(addr)
+            client.sendall(b"EHLO blackhole.io\r\nQUIT\r\n")
+            read_responses(client, 2)
+            client.close()
+        took = time.perf_counter() - start
+    total = args.connections
+    print(f"{total} sessions in {took:.3f}s -- {total / took:,.0f} conn/sec")
+
+
+def bench_idle(args):
+    """Hold idle connections open and report the memory used by each."""
+    raise_fd_limit(args.connections)
+    context = multiprocessing.get_context("fork")
+    ready, done = context.Event(), context.Event()
+    with Server() as addr:
+        if args.traced:
+            tracemalloc.start()
+        gc.collect()
+        before, traced = rss(), tracemalloc.get_traced_memory()[0]
+        # The clients run in another process so only the server's memory is
+        # measured.
+        clients = context.Process(
+            target=hold_connections,
+            args=(addr, args.connections, ready, done),
+        )
+        clients.start()
+        ready.wait()
+        gc.collect()
+        used = (rss() - before) / args.connections
+        traced = (
+            tracemalloc.get_traced_memory()[0] - traced
+        ) / args.connections
+        tracemalloc.stop()
+        done.set()
+        clients.join()
+    result = (
+        f"{args.connections} idle connections -- {used:,.0f} bytes RSS per "
+        f"connection, {used * 10000 / 1024 / 1024:.2f} MB per 10k"
+    )
+    if args.traced:
+        result += f", {traced:,.0f} bytes traced per connection"
+    print(result)
+
+
+def bench_churn(args):
+    """Replace random connections from a large pool, report churn/sec."""
+    raise_fd_limit(args.connections * 2)
+    with Server() as addr:
+        clients = [connect(addr) for _ in range(args.connections)]
+        start = time.perf_counter()
+        for _ in range(args.churn):
+            idx = random.randrange(len(clients))
+            clients[idx].close()
+            clients[idx] = connect(addr)
+        took = time.perf_counter() - start
+        for client in clients:
+            client.close()
+    print(
+        f"{args.churn} connections replaced in a pool of "
+        f"{args.connections} in {took:.3f}s -- "
+        f"{args.churn / took:,.0f} conn/sec",
+    )
+
+
+def bench_data(args):
+    """Send one large message and report peak memory used to receive it."""
+    line = b"x" * 76 + b"\r\n"
+    headers = b"Subject: benchmark\r\nX-Blackhole-Mode: accept\r\n\r\n"
+    body = headers + line * (args.megabytes * 1024 * 1024 // len(line))
+    Config().max_message_size = args.max_message_size
+    with Server() as addr:
+        client = connect(addr)
+        tracemalloc.start()
+        start = time.perf_counter()
+        client.sendall(b"MAIL FROM: <kura@example.com>\r\n")
+        client.sendall(b"RCPT TO: <kura@example.com>\r\nDATA\r\n")
+        read_responses(client, 3)
+        client.sendall(body)
+        client.sendall(b".\r\n")
+        code = client.recv(1024)[:3].decode("utf-8")
+        took = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+        client.close()
+    print(
+        f"{args.megabytes} MB message -- {code} in {took:.3f}s, "
+        f"peak traced memory {peak:.2f} MB",
+    )
+
+
+def main():
+    """Parse arguments and run the requested benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--engine", choices=ENGINES, default="stream")
+    parser.add_argument("--debug-sample", type=float, default=None)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    dispatch = subparsers.add_parser("dispatch", help=bench_dispatch.__doc__)
+    dispatch.add_argument("--iterations", type=int, default=200000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    flood = subparsers.add_parser("flood", help=bench_flood.__doc__)
+    flood.add_argument("--commands", type=int, default=20000)
+    flood.add_argument("--batch", type=int, default=100)
+    flood.set_defaults(func=bench_flood)
+
+    sessions = subparsers.add_parser("connect", help=bench_connect.__doc__)
+    sessions.add_argument("--connections", type=int, default=2000)
+    sessions.set_defaults(func=bench_connect)
+
+    idle = subparsers.add_parser("idle", help=bench_idle.__doc__)
+    idle.add_argument("--connections", type=int, default=10000)
+    idle.add_argument("--traced", action="store_true")
+    idle.set_defaults(func=bench_idle)
+
+    churn = subparsers.add_parser("churn", help=bench_churn.__doc__)
+    churn.add_argument("--connections", type=int, default=50000)
+    churn.add_argument("--churn", type=int, default=20000)
+    churn.set_defaults(func=bench_churn)
+
+    accept = subparsers.add_parser("accept", help=bench_accept.__doc__)
+    accept.add_argument("--workers", type=int, default=8)
+    accept.add_argument("--connections", type=int, default=8000)
+    accept.add_argument("--clients", type=int, default=4)
+    accept.add_argument("--reuse-port", action="store_true")
+    accept.set_defaults(func=bench_accept)
+
+    placement = subparsers.add_parser(
+        "placement",
+        help=bench_placement.__doc__,
+    )
+    placement.add_argument("--workers", type=int, default=4)
+    placement.add_argument("--messages", type=int, default=40000)
+    placement.add_argument("--per-session", type=int, default=100)
+    placement.add_argument("--clients", type=int, default=4)
+    placement.add_argument("--worker-cpu-affinity", default=None)
+    placement.add_argument("--supervisor-cpu-affinity", default=None)
+    placement.set_defaults(func=bench_placement)
+
+    starttls = subparsers.add_parser("starttls", help=bench_starttls.__doc__)
+    starttls.add_argument("--tls-cert", required=True)
+    starttls.add_argument("--tls-key", required=True)
+    starttls.add_argument("--less-secure", action="store_true")
+    starttls.add_argument("--connections", type=int, default=2000)
+    starttls.add_argument("--clients", type=int, default=4)
+    starttls.set_defaults(func=bench_starttls)
+
+    resume = subparsers.add_parser("resume", help=bench_resume.__doc__)
+    resume.add_argument("--tls-cert", required=True)
+    resume.add_argument("--tls-key", required=True)
+    resume.add_argument("--less-secure", action="store_true")
+    resume.add_argument("--workers", type=int, default=2)
+    resume.add_argument("--connections", type=int, default=2000)
+    resume.add_argument("--clients", type=int, default=4)
+    resume.add_argument("--per-worker-keys", action="store_true")
+    resume.set_defaults(func=bench_resume)
+
+    storm = subparsers.add_parser("storm", help=bench_storm.__doc__)
+    storm.add_argument("--tls-cert", required=True)
+    storm.add_argument("--tls-key", required=True)
+    storm.add_argument("--less-secure", action="store_true")
+    storm.add_argument("--threads", type=int, default=2)
+    storm.add_argument("--connections", type=int, default=2000)
+    storm.add_argument("--clients", type=int, default=4)
+    storm.set_defaults(func=bench_storm)
+
+    ktls = subparsers.add_parser("ktls", help=bench_ktls.__doc__)
+    ktls.add_argument("--tls-cert", required=True)
+    ktls.add_argument("--tls-key", required=True)
+    ktls.add_argument("--less-secure", action="store_true")
+    ktls.add_argument("--megabytes", type=int, default=1)
+    ktls.add_argument("--messages", type=int, default=50)
+    ktls.add_argument("--sessions", type=int, default=8)
+    ktls.add_argument("--clients", type=int, default=4)
+    ktls.set_defaults(func=bench_ktls)
+
+    data = subparsers.add_parser("data", help=bench_data.__doc__)
+    data.add_argument("--megabytes", type=int, default=50)
+    data.add_argument("--max-message-size", type=int, default=512000)
+    data.set_defaults(func=bench_data)
+
+    args = parser.parse_args()
+    config = Config(None)
+    config.mailname = "blackhole.io"
+    config.engine = args.engine
+    if args.debug_sample is not None:
+        config.debug_sample = args.debug_sample
+        logger = logging.getLogger("blackhole")
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.FileHandler(os.devnull))
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (The MIT License)
+#
+# Copyright (c) 2013-2021 Kura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the 'Software'), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Report the memory shared between a running blackhole supervisor and children.
+
+Reads ``/proc/<pid>/smaps_rollup``, so is only supported on Linux 4.14 and
+above, and needs permission to read the memory maps of the processes.
+
+    python scripts/memory.py --pidfile /tmp/blackhole.pid
+    python scripts/memory.py 1234
+
+RSS counts every page a process has mapped, including pages shared with the
+supervisor and other children. PSS divides each shared page between the
+processes sharing it, so the PSS of every process adds up to the memory
+actually used. Private memory is what a child costs on it's own.
+"""
+
+import argparse
+import os
+
+
+FIELDS = (
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+)
+
+
+def children(pid):
+    """
+    Find the child processes of a process.
+
+    :param int pid: The parent process.
+    :returns: The child processes.
+    :rtype: :py:obj:`list`
+    """
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # The process name can contain spaces, the parent pid is the
+                # second field after it.
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def memory(pid):
+    """
+    Read the memory use of a process.
+
+    :param int pid: The process.
+    :returns: Memory use in kB, keyed by field name.
+    :rtype: :py:obj:`dict`
+    """
+    usage = dict.fromkeys(FIELDS, 0)
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            field, _, value = line.partition(":")
+            if field in usage:
+                usage[field] = int(value.split()[0])
+    return usage
+
+
+def name(pid):
+    """
+    Get the title of a process, as set by setproctitle.
+
+    :param int pid: The process.
+    :returns: The process title.
+    :rtype: :py:obj:`str`
+    """
+    with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+        return cmdline.read().replace(b"\0", b" ").decode("utf-8").strip()
+
+
+def report(pid):
+    """
+    Print the memory use of a supervisor and each of it's children.
+
+    :param int pid: The supervisor process.
+    """
+    header = (
+        f"{'pid':>8} {'process':<24} {'rss':>9} {'pss':>9} {'shared':>9} "
+        f"{'private':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    totals = dict.fromkeys(FIELDS, 0)
+    for process in [pid] + children(pid):
+        usage = memory(process)
+        for field in FIELDS:
+            totals[field] += usage[field]
+        print(row(process, name(process)[:24], usage))
+    print("-" * len(header))
+    print(row("", "total", totals))
+    print(
+        "MB, shared is Shared_Clean + Shared_Dirty, private is "
+        "Private_Clean + Private_Dirty",
+    )
+
+
+def row(pid, title, usage):
+    """
+    Format a line of the report.
+
+    :param pid: The process.
+    :type pid: :py:obj:`int` or :py:obj:`str`
+    :param str title: The process title.
+    :param dict usage: Memory use in kB, keyed by field name.
+    :returns: The line.
+    :rtype: :py:obj:`str`
+    """
+    shared = usage["Shared_Clean"] + usage["Shared_Dirty"]
+    private = usage["Private_Clean"] + usage["Private_Dirty"]
+    values = (usage["Rss"], usage["Pss"], shared, private)
+    columns = " ".join(f"{value / 1024:>9.2f}" for value in values)
+    return f"{pid:>8} {title:<24} {columns}"
+
+
+def main():
+    """Parse arguments and print the report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("pid", type=int, nargs="?", default=None)
+    parser.add_argument("--pidfile", default="/tmp/blackhole.pid")
+    args = parser.parse_args()
+    pid = args.pid
+    if pid is None:
+        with open(args.pidfile) as pidfile:
+            pid = int(pidfile.read().strip())
+    report(pid)
+
+
+if __name__ == "__main__":
+    main()
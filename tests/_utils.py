@@ -35,6 +35,12 @@
 logging.getLogger("blackhole").addHandler(logging.NullHandler())
 
 
+TLS_CERT = os.path.join(os.path.dirname(__file__), "tls.crt")
+TLS_KEY = os.path.join(os.path.dirname(__file__), "tls.key")
+SNI_CERT = os.path.join(os.path.dirname(__file__), "sni.crt")
+SNI_KEY = os.path.join(os.path.dirname(__file__), "sni.key")
+
+
 @pytest.fixture()
 def cleandir():
     newpath = tempfile.mkdtemp()
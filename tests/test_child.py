@@ -25,6 +25,7 @@
 
 import asyncio
 import os
+import signal
 import socket
 from unittest import mock
 
@@ -32,8 +33,10 @@
 
 from blackhole import protocols
 from blackhole.child import Child
+from blackhole.config import Config
 from blackhole.control import _socket
 from blackhole.streams import StreamProtocol
+from blackhole.tls import HandshakeProtocol, SocketHandshakeProtocol
 
 
 from ._utils import (  # noqa: F401; isort:skip
@@ -65,12 +68,18 @@ def test_start():
     with mock.patch("asyncio.Task"), mock.patch(
         "blackhole.child.Child.heartbeat",
     ), mock.patch("{0}.run_forever".format(_LOOP)), mock.patch(
+        "{0}.add_signal_handler".format(_LOOP),
+    ) as mock_signal, mock.patch(
         "blackhole.child.Child.stop",
     ), mock.patch(
+        "gc.set_threshold",
+    ) as mock_threshold, mock.patch(
         "os._exit",
     ) as mock_exit:
         child.start()
     assert mock_exit.called is True
+    mock_signal.assert_called_once_with(signal.SIGTERM, child.drain)
+    mock_threshold.assert_called_once_with(*Child.gc_thresholds)
 
 
 @pytest.mark.usefixtures("reset", "cleandir")
@@ -78,16 +87,20 @@ def test_stop():
     socks = [{"sock": None, "ssl": None}, {"sock": None, "ssl": "abc"}]
     child = Child("", "", socks, "1")
     child.loop = mock.MagicMock()
-    child.clients.append(mock.MagicMock())
+    client = mock.MagicMock()
+    child.clients.add(client)
     child.servers.append(mock.MagicMock())
     child.heartbeat_task = mock.MagicMock()
     child.server_task = mock.MagicMock()
+    assert child.connections == 1
 
     with mock.patch("os._exit") as mock_exit, mock.patch(
         "{0}.run_until_complete".format(_LOOP),
     ):
         child.stop()
     assert mock_exit.called is True
+    assert client.close.called is True
+    assert child.connections == 0
 
 
 @pytest.mark.usefixtures("reset", "cleandir")
@@ -95,7 +108,7 @@ def test_stop_runtime_exception():
     socks = [{"sock": None, "ssl": None}, {"sock": None, "ssl": "abc"}]
     child = Child("", "", socks, "1")
     child.loop = mock.MagicMock()
-    child.clients.append(mock.MagicMock())
+    child.clients.add(mock.MagicMock())
     child.servers.append(mock.MagicMock())
     child.heartbeat_task = mock.MagicMock()
     child.server_task = mock.MagicMock()
@@ -121,6 +134,173 @@ async def test_start_child_loop(event_loop):
         server.close()
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_start_child_handshake_threads(event_loop):
+    cfile = create_config(("tls_handshake_threads=2",))
+    Config(cfile).load()
+    plain = _socket("127.0.0.1", 0, socket.AF_INET)
+    tls = _socket("127.0.0.1", 0, socket.AF_INET)
+    context = mock.Mock()
+    socks = ({"sock": plain, "ssl": None}, {"sock": tls, "ssl": context})
+    child = Child("", "", socks, "1")
+    child.loop = event_loop
+    child.engine = mock.Mock()
+
+    async def create_server(*args, **kwargs):
+        return mock.Mock()
+
+    with mock.patch.object(
+        event_loop,
+        "create_server",
+        side_effect=create_server,
+    ) as mock_server:
+        await child._start()
+    assert child.executor._max_workers == 2
+    first, second = mock_server.call_args_list
+    assert first[1]["ssl"] is None
+    assert second[1]["ssl"] is None
+    protocol = second[0][0]()
+    assert type(protocol) is HandshakeProtocol
+    assert protocol.context is context
+    assert protocol.executor is child.executor
+    assert protocol.timeout == child.snapshots[1].timeout
+    child.executor.shutdown()
+    plain.close()
+    tls.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "available, cls",
+    ((True, SocketHandshakeProtocol), (False, None)),
+)
+async def test_start_child_ktls(event_loop, available, cls):
+    cfile = create_config(("tls_ktls=true",))
+    Config(cfile).load()
+    tls = _socket("127.0.0.1", 0, socket.AF_INET)
+    context = mock.Mock()
+    child = Child("", "", ({"sock": tls, "ssl": context},), "1")
+    child.loop = event_loop
+    child.engine = mock.Mock()
+
+    async def create_server(*args, **kwargs):
+        return mock.Mock()
+
+    with mock.patch(
+        "blackhole.child.ktls_available",
+        return_value=available,
+    ), mock.patch.object(
+        event_loop,
+        "create_server",
+        side_effect=create_server,
+    ) as mock_server:
+        await child._start()
+    assert child.ktls is available
+    assert child.executor is None
+    if cls is None:
+        assert mock_server.call_args[1]["ssl"] is context
+    else:
+        assert mock_server.call_args[1]["ssl"] is None
+        protocol = mock_server.call_args[0][0]()
+        assert type(protocol) is cls
+        assert protocol.context is context
+        assert protocol.executor is None
+    tls.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_start_child_no_handshake_threads(event_loop):
+    cfile = create_config(("tls_handshake_threads=2",))
+    Config(cfile).load()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    child = Child("", "", ({"sock": sock, "ssl": None},), "1")
+    child.loop = event_loop
+    await child._start()
+    assert child.executor is None
+    for server in child.servers:
+        server.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_spare_child_serve(event_loop):
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    socks = ({"sock": sock, "ssl": None},)
+    child = Child("", "", socks, "1", spare=True)
+    child.loop = event_loop
+    child.server_task = asyncio.ensure_future(child._start())
+    await child.server_task
+    assert child.servers[0].is_serving() is False
+    with mock.patch(
+        "blackhole.child.Child.report",
+        new_callable=mock.Mock,
+    ), mock.patch("asyncio.Task") as mock_task:
+        await child.serve()
+    assert child.servers[0].is_serving() is True
+    assert child.spare is False
+    assert mock_task.called is True
+    for server in child.servers:
+        server.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_child_control(event_loop):
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    starttls = mock.Mock()
+    socks = ({"sock": sock, "ssl": None, "starttls": starttls},)
+    child = Child("", "", socks, "1")
+    child.loop = event_loop
+    await child._start()
+    smtp = child.protocol(0)
+    assert smtp.stats is child.stats
+    assert smtp.config.starttls is starttls
+    assert smtp.config.mode == "accept"
+    with mock.patch("blackhole.child.Child.finish") as mock_finish:
+        child.drain()
+        child.drain()
+        await asyncio.sleep(0)
+    assert child.servers == []
+    assert mock_finish.call_count == 1
+    sock.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_child_finish(event_loop):
+    child = Child("", "", [], "1")
+    child.loop = event_loop
+    child.writer = mock.Mock()
+    client = mock.Mock()
+    child.clients.add(client)
+    client.transport.get_protocol.return_value.drain.side_effect = (
+        child.clients.clear
+    )
+    with mock.patch("blackhole.child.Child.stop") as mock_stop:
+        await child.finish()
+    assert mock_stop.called is True
+    assert (child.stats.drained, child.stats.cut) == (1, 0)
+    frame = child.writer.write.call_args[0][0]
+    assert frame[0] == protocols.STATS
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_child_finish_cut(event_loop):
+    cfile = create_config(("drain_timeout=0",))
+    Config(cfile).load()
+    child = Child("", "", [], "1")
+    child.loop = event_loop
+    child.clients.add(mock.Mock())
+    with mock.patch("blackhole.child.Child.stop") as mock_stop:
+        await child.finish()
+    assert mock_stop.called is True
+    assert (child.stats.drained, child.stats.cut) == (0, 1)
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 @pytest.mark.asyncio
 async def test_child_heartbeat_not_started(event_loop):
@@ -133,7 +313,9 @@ async def test_child_heartbeat_not_started(event_loop):
     child._started = False
     with mock.patch("asyncio.Task") as mock_task, mock.patch(
         "blackhole.child.Child._start",
-    ) as mock_start, mock.patch("blackhole.child.Child.stop") as mock_stop:
+    ) as mock_start, mock.patch("blackhole.child.Child.report"), mock.patch(
+        "blackhole.child.Child.stop",
+    ) as mock_stop:
         await child.heartbeat()
     assert mock_task.called is True
     assert mock_start.called is True
@@ -154,7 +336,7 @@ async def test_child_heartbeat_started(event_loop):
     sp.reader = asyncio.StreamReader()
 
     async def _reset():
-        sp.reader.feed_data(protocols.PING)
+        sp.reader.feed_data(protocols.frame(protocols.PING))
         child._started = False
 
     reset_task = asyncio.Task(_reset())
@@ -164,6 +346,8 @@ async def _reset():
     ), mock.patch("asyncio.Task") as mock_task, mock.patch(
         "blackhole.child.Child._start",
     ) as mock_start, mock.patch(
+        "blackhole.child.Child.report",
+    ), mock.patch(
         "blackhole.child.Child.stop",
     ) as mock_stop:
         await child.heartbeat()
@@ -171,3 +355,103 @@ async def _reset():
     assert mock_task.called is True
     assert mock_start.called is True
     assert mock_stop.called is True
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle_limits():
+    cfile = create_config(
+        ("max_connections_per_child=1000", "max_child_rss=1000000"),
+    )
+    Config(cfile).load()
+    with mock.patch("random.uniform", return_value=0.05):
+        child = Child("", "", [], "1")
+    assert child.max_connections == 1050
+    assert child.max_rss == 1050000
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle_limits_disabled():
+    child = Child("", "", [], "1")
+    assert (child.max_connections, child.max_rss) == (0, 0)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle_after_connections():
+    child = Child("", "", [], "1")
+    child.loop = mock.Mock()
+    child.engine = mock.Mock()
+    child.snapshots = [None]
+    child.max_connections = 2
+    child.protocol(0)
+    assert child.loop.call_soon.called is False
+    child.protocol(0)
+    child.protocol(0)
+    child.loop.call_soon.assert_called_once_with(
+        child.recycle,
+        "2 connections",
+    )
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle():
+    child = Child("", "", [], "1")
+    child.writer = mock.Mock()
+    with mock.patch("blackhole.child.Child.drain") as mock_drain:
+        child.recycle("2 connections")
+    assert mock_drain.called is True
+    child.writer.write.assert_called_once_with(
+        protocols.frame(protocols.RECYCLE, b"2 connections"),
+    )
+    child.drain_task = mock.Mock()
+    child.recycle("2 connections")
+    assert child.writer.write.call_count == 1
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_recycle_after_rss(event_loop):
+    child = Child("", "", [], "1")
+    child._started = True
+    child.writer = mock.Mock()
+    child.stats_interval = 0
+    child.max_rss = 1000
+
+    def recycle(reason):
+        child._started = False
+
+    with mock.patch("blackhole.child.rss", return_value=2000), mock.patch(
+        "blackhole.child.Child.recycle",
+        side_effect=recycle,
+    ) as mock_recycle:
+        await child.report()
+    mock_recycle.assert_called_once_with("reaching 2000 bytes RSS")
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys():
+    socks = [
+        {"sock": None, "ssl": "tls", "starttls": None},
+        {"sock": None, "ssl": None, "starttls": "starttls"},
+    ]
+    child = Child("", "", socks, "1")
+    with mock.patch(
+        "blackhole.child.set_ticket_keys",
+        return_value=True,
+    ) as mock_keys, mock.patch("blackhole.child.logger.warning") as mock_log:
+        child.set_ticket_keys(b"keys")
+    mock_keys.assert_called_once_with(
+        ["tls", None, None, "starttls"],
+        b"keys",
+    )
+    assert mock_log.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys_fails():
+    child = Child("", "", [], "1")
+    with mock.patch(
+        "blackhole.child.set_ticket_keys",
+        return_value=False,
+    ), mock.patch("blackhole.child.logger.warning") as mock_log:
+        child.set_ticket_keys(b"keys")
+    assert mock_log.called is True
@@ -111,6 +111,7 @@ def test_warnings():
         ("tls_dhparams", None),
         ("user", "root"),
         ("group", "root"),
+        ("tls_ktls", False),
     )
     conf = Args(settings)
     args = Args()
@@ -125,6 +126,26 @@ def test_warnings():
     assert mmock.warning.call_count == 3
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_warnings_ktls_unavailable():
+    conf = Config(create_config(("tls_ktls=true",))).load()
+    conf.args = Args((("less_secure", False),))
+    mmock = mock.MagicMock(spec=logging)
+    with mock.patch(
+        "blackhole.config.ktls_available",
+        return_value=False,
+    ), mock.patch("logging.getLogger", return_value=mmock):
+        warn_options(conf)
+    assert "tls_ktls" in mmock.warning.call_args_list[0][0][0]
+    mmock.reset_mock()
+    with mock.patch(
+        "blackhole.config.ktls_available",
+        return_value=True,
+    ), mock.patch("logging.getLogger", return_value=mmock):
+        warn_options(conf)
+    assert not any("tls_ktls" in c[0][0] for c in mmock.warning.call_args_list)
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_invalid_options():
     cfile = create_config(("workers=2", "delay=10", "test=option"))
@@ -288,6 +309,14 @@ def test_listen_flags_special_ipv6(self):
         conf = Config(cfile).load()
         assert conf.flags_from_listener("::1", 25) == {"mode": "bounce"}
 
+    def test_tls_flags(self):
+        cfile = create_config(("listen=:25 tls_cert=/a.crt tls_key=/a.key",))
+        conf = Config(cfile).load()
+        flags = {"tls_cert": "/a.crt", "tls_key": "/a.key"}
+        assert conf.listen == [("", 25, socket.AF_INET, flags)]
+        assert conf.tls_files(flags) == ("/a.crt", "/a.key")
+        assert conf.tls_files({"mode": "bounce"}) == (None, None)
+
 
 @pytest.mark.usefixtures("reset", "cleandir")
 class TestPort(unittest.TestCase):
@@ -632,8 +661,7 @@ def test_cert_key_no_port(self):
         settings = ("tls_cert={}".format(cert), "tls_key={}".format(key))
         cfile = create_config(settings)
         conf = Config(cfile).load()
-        with pytest.raises(ConfigException):
-            conf.test_tls_settings()
+        conf.test_tls_settings()
         assert conf.tls_listen == []
         assert conf.tls_cert == cert
         assert conf.tls_key == key
@@ -675,6 +703,53 @@ def test_port_cert_key(self):
         assert conf.tls_cert == cert
         assert conf.tls_key == key
 
+    def test_listener_cert_key_no_global(self):
+        key = create_file("key.key")
+        cert = create_file("crt.crt")
+        settings = (
+            "listen=:25",
+            "tls_listen=:123 tls_cert={} tls_key={}".format(cert, key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        conf.test_tls_settings()
+        assert conf.tls_cert is None
+        assert conf.tls_files(conf.tls_listen[0][3]) == (cert, key)
+
+    def test_listener_cert_no_key(self):
+        key = create_file("key.key")
+        cert = create_file("crt.crt")
+        settings = (
+            "listen=:25 tls_cert={}".format(cert),
+            "tls_cert={}".format(cert),
+            "tls_key={}".format(key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_settings()
+
+    def test_listener_cert_not_readable(self):
+        key = create_file("key.key")
+        settings = (
+            "listen=:25 tls_cert=/fake/crt.crt tls_key={}".format(key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_settings()
+
+    def test_port_without_listener_cert_key(self):
+        key = create_file("key.key")
+        cert = create_file("crt.crt")
+        settings = (
+            "tls_listen=:123 tls_cert={} tls_key={}, :124".format(cert, key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_settings()
+
     def test_default_dhparam(self):
         cfile = create_config(("",))
         conf = Config(cfile).load()
@@ -901,6 +976,543 @@ def test_dynamic_switch_invalid(self):
             conf.test_dynamic_switch()
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot_default(self):
+        cfile = create_config(("timeout=30", "mode=bounce"))
+        conf = Config(cfile).load()
+        snapshot = conf.snapshot()
+        assert snapshot.address is None
+        assert snapshot.timeout == 30
+        assert snapshot.mode == "bounce"
+        assert snapshot.delay is None
+        assert snapshot.max_message_size == 512000
+        assert snapshot.dynamic_switch is True
+        assert snapshot.flags == {}
+        assert snapshot.starttls is None
+
+    def test_snapshot_starttls(self):
+        ctx = object()
+        snapshot = Config(None).snapshot("0.0.0.0", 25, ctx)
+        assert snapshot.starttls is ctx
+
+    def test_snapshot_listener_flags(self):
+        cfile = create_config(("listen=:25 mode=random delay=10",))
+        conf = Config(cfile).load()
+        snapshot = conf.snapshot("0.0.0.0", 25)
+        assert snapshot.flags == {"mode": "random", "delay": "10"}
+        assert conf.snapshot("0.0.0.0", 587).flags == {}
+
+    def test_snapshot_tls_flags(self):
+        settings = ("listen=:25 mode=random tls_cert=/a.crt tls_key=/a.key",)
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        assert conf.snapshot("0.0.0.0", 25).flags == {"mode": "random"}
+        settings = ("listen=:25 tls_cert=/a.crt tls_key=/a.key",)
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        assert conf.snapshot("0.0.0.0", 25).flags == {}
+
+    def test_snapshot_frozen(self):
+        snapshot = Config(None).snapshot()
+        with pytest.raises(AttributeError):
+            snapshot.timeout = 10
+        with pytest.raises(TypeError):
+            snapshot.flags["mode"] = "bounce"
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestEngine(unittest.TestCase):
+    def test_engine_default(self):
+        conf = Config(None).load()
+        assert conf.engine == "stream"
+
+    def test_engine_callback(self):
+        cfile = create_config(("engine=Callback",))
+        conf = Config(cfile).load()
+        assert conf.engine == "callback"
+        conf.test_engine()
+
+    def test_engine_invalid(self):
+        cfile = create_config(("engine=threads",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_engine()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestDebugSample(unittest.TestCase):
+    def test_debug_sample_default(self):
+        conf = Config(None).load()
+        assert conf.debug_sample == 1.0
+        assert conf.snapshot().debug_sample == 1.0
+
+    def test_debug_sample(self):
+        cfile = create_config(("debug_sample=0.01",))
+        conf = Config(cfile).load()
+        assert conf.debug_sample == 0.01
+        conf.test_debug_sample()
+
+    def test_debug_sample_not_a_number(self):
+        cfile = create_config(("debug_sample=some",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_debug_sample()
+
+    def test_debug_sample_out_of_range(self):
+        cfile = create_config(("debug_sample=1.5",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_debug_sample()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestAutoscale(unittest.TestCase):
+    def test_autoscale_default(self):
+        conf = Config(None).load()
+        assert conf.autoscale is False
+
+    def test_autoscale(self):
+        cfile = create_config(
+            ("workers=auto", "min_workers=2", "max_workers=4"),
+        )
+        conf = Config(cfile).load()
+        assert conf.autoscale is True
+        assert conf.workers == 2
+        with mock.patch("multiprocessing.cpu_count", return_value=4):
+            conf.test_workers()
+
+    def test_max_workers_default(self):
+        cfile = create_config(("workers=auto",))
+        conf = Config(cfile).load()
+        with mock.patch("multiprocessing.cpu_count", return_value=4):
+            assert conf.max_workers == 4
+            conf.test_workers()
+
+    def test_max_workers_more_than_cpus(self):
+        cfile = create_config(("workers=auto", "max_workers=8"))
+        conf = Config(cfile).load()
+        with mock.patch(
+            "multiprocessing.cpu_count",
+            return_value=4,
+        ), pytest.raises(ConfigException):
+            conf.test_workers()
+
+    def test_min_workers_more_than_max(self):
+        cfile = create_config(
+            ("workers=auto", "min_workers=3", "max_workers=2"),
+        )
+        conf = Config(cfile).load()
+        with mock.patch(
+            "multiprocessing.cpu_count",
+            return_value=4,
+        ), pytest.raises(ConfigException):
+            conf.test_workers()
+
+    def test_workers_invalid(self):
+        cfile = create_config(("workers=some",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_workers()
+
+    def test_autoscale_reuse_port(self):
+        cfile = create_config(("workers=auto", "reuse_port=true"))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_reuse_port()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestReusePort(unittest.TestCase):
+    def test_reuse_port_default(self):
+        conf = Config(None).load()
+        assert conf.reuse_port is False
+
+    def test_reuse_port_true(self):
+        cfile = create_config(("reuse_port=true",))
+        conf = Config(cfile).load()
+        assert conf.reuse_port is True
+        conf.test_reuse_port()
+
+    def test_reuse_port_invalid(self):
+        cfile = create_config(("reuse_port=abc",))
+        with pytest.raises(ConfigException):
+            Config(cfile).load()
+
+    def test_reuse_port_not_supported(self):
+        cfile = create_config(("reuse_port=true",))
+        conf = Config(cfile).load()
+        with mock.patch("blackhole.config.socket") as mock_socket:
+            del mock_socket.SO_REUSEPORT
+            with pytest.raises(ConfigException):
+                conf.test_reuse_port()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestHeartbeatInterval(unittest.TestCase):
+    def test_heartbeat_interval_default(self):
+        conf = Config(None).load()
+        assert conf.heartbeat_interval == 15
+
+    def test_heartbeat_interval(self):
+        cfile = create_config(("heartbeat_interval=2",))
+        conf = Config(cfile).load()
+        assert conf.heartbeat_interval == 2
+        conf.test_heartbeat_interval()
+
+    def test_heartbeat_interval_invalid(self):
+        cfile = create_config(("heartbeat_interval=abc",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_heartbeat_interval()
+
+    def test_heartbeat_interval_zero(self):
+        cfile = create_config(("heartbeat_interval=0",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_heartbeat_interval()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestDrainTimeout(unittest.TestCase):
+    def test_drain_timeout_default(self):
+        conf = Config(None).load()
+        assert conf.drain_timeout == 60
+
+    def test_drain_timeout(self):
+        cfile = create_config(("drain_timeout=0",))
+        conf = Config(cfile).load()
+        assert conf.drain_timeout == 0
+        conf.test_drain_timeout()
+
+    def test_drain_timeout_invalid(self):
+        cfile = create_config(("drain_timeout=abc",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_drain_timeout()
+
+    def test_drain_timeout_negative(self):
+        cfile = create_config(("drain_timeout=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_drain_timeout()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestCpuAffinity(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch(
+            "blackhole.config.available_cpus",
+            return_value=frozenset(range(4)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cpu_affinity_default(self):
+        conf = Config(None).load()
+        assert conf.worker_cpu_affinity is None
+        assert conf.supervisor_cpu_affinity is None
+        conf.test_worker_cpu_affinity()
+        conf.test_supervisor_cpu_affinity()
+
+    def test_worker_cpu_affinity(self):
+        cfile = create_config(("worker_cpu_affinity=0-1 2,3",))
+        conf = Config(cfile).load()
+        assert conf.worker_cpu_affinity == ((0, 1), (2, 3))
+        conf.test_worker_cpu_affinity()
+
+    def test_worker_cpu_affinity_auto(self):
+        cfile = create_config(("worker_cpu_affinity=AUTO",))
+        conf = Config(cfile).load()
+        assert conf.worker_cpu_affinity == "auto"
+        conf.test_worker_cpu_affinity()
+
+    def test_worker_cpu_affinity_invalid(self):
+        cfile = create_config(("worker_cpu_affinity=0-1 a",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_worker_cpu_affinity()
+
+    def test_worker_cpu_affinity_unavailable(self):
+        cfile = create_config(("worker_cpu_affinity=0 4",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException) as err:
+            conf.test_worker_cpu_affinity()
+        assert str(err.value).endswith("not available: 4.")
+
+    def test_supervisor_cpu_affinity(self):
+        cfile = create_config(("supervisor_cpu_affinity=3",))
+        conf = Config(cfile).load()
+        assert conf.supervisor_cpu_affinity == (3,)
+        conf.test_supervisor_cpu_affinity()
+
+    def test_supervisor_cpu_affinity_invalid(self):
+        cfile = create_config(("supervisor_cpu_affinity=2-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_supervisor_cpu_affinity()
+
+    def test_cpu_affinity_not_supported(self):
+        cfile = create_config(("supervisor_cpu_affinity=0",))
+        conf = Config(cfile).load()
+        with mock.patch("blackhole.config.os") as mock_os, pytest.raises(
+            ConfigException,
+        ):
+            del mock_os.sched_setaffinity
+            conf.test_supervisor_cpu_affinity()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestSpareChildren(unittest.TestCase):
+    def test_spare_children_default(self):
+        conf = Config(None).load()
+        assert conf.spare_children == 0
+
+    def test_spare_children(self):
+        cfile = create_config(("spare_children=2",))
+        conf = Config(cfile).load()
+        assert conf.spare_children == 2
+        conf.test_spare_children()
+
+    def test_spare_children_invalid(self):
+        cfile = create_config(("spare_children=abc",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_spare_children()
+
+    def test_spare_children_negative(self):
+        cfile = create_config(("spare_children=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_spare_children()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestRecycling(unittest.TestCase):
+    def test_recycling_default(self):
+        conf = Config(None).load()
+        assert conf.max_connections_per_child == 0
+        assert conf.max_child_rss == 0
+
+    def test_max_connections_per_child(self):
+        cfile = create_config(("max_connections_per_child=10000",))
+        conf = Config(cfile).load()
+        assert conf.max_connections_per_child == 10000
+        conf.test_max_connections_per_child()
+
+    def test_max_connections_per_child_invalid(self):
+        cfile = create_config(("max_connections_per_child=abc",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_max_connections_per_child()
+
+    def test_max_connections_per_child_negative(self):
+        cfile = create_config(("max_connections_per_child=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_max_connections_per_child()
+
+    def test_max_child_rss(self):
+        cfile = create_config(("max_child_rss=268435456",))
+        conf = Config(cfile).load()
+        assert conf.max_child_rss == 268435456
+        conf.test_max_child_rss()
+
+    def test_max_child_rss_invalid(self):
+        cfile = create_config(("max_child_rss=256M",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_max_child_rss()
+
+    def test_max_child_rss_negative(self):
+        cfile = create_config(("max_child_rss=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_max_child_rss()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestTlsTicketRotation(unittest.TestCase):
+    def test_tls_ticket_rotation_default(self):
+        conf = Config(None).load()
+        assert conf.tls_ticket_rotation == 3600
+
+    def test_tls_ticket_rotation(self):
+        cfile = create_config(("tls_ticket_rotation=600",))
+        conf = Config(cfile).load()
+        assert conf.tls_ticket_rotation == 600
+        conf.test_tls_ticket_rotation()
+
+    def test_tls_ticket_rotation_disabled(self):
+        cfile = create_config(("tls_ticket_rotation=0",))
+        conf = Config(cfile).load()
+        assert conf.tls_ticket_rotation == 0
+        conf.test_tls_ticket_rotation()
+
+    def test_tls_ticket_rotation_invalid(self):
+        cfile = create_config(("tls_ticket_rotation=1h",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_ticket_rotation()
+
+    def test_tls_ticket_rotation_negative(self):
+        cfile = create_config(("tls_ticket_rotation=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_ticket_rotation()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestTlsHandshakeThreads(unittest.TestCase):
+    def test_tls_handshake_threads_default(self):
+        conf = Config(None).load()
+        assert conf.tls_handshake_threads == 0
+
+    def test_tls_handshake_threads(self):
+        cfile = create_config(("tls_handshake_threads=4",))
+        conf = Config(cfile).load()
+        assert conf.tls_handshake_threads == 4
+        conf.test_tls_handshake_threads()
+
+    def test_tls_handshake_threads_invalid(self):
+        cfile = create_config(("tls_handshake_threads=four",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_handshake_threads()
+
+    def test_tls_handshake_threads_negative(self):
+        cfile = create_config(("tls_handshake_threads=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_handshake_threads()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestTlsSni(unittest.TestCase):
+    def test_tls_sni_default(self):
+        conf = Config(None).load()
+        assert conf.tls_sni == {}
+        conf.test_tls_sni()
+
+    def test_tls_sni(self):
+        key = create_file("key.key")
+        cert = create_file("crt.crt")
+        settings = (
+            "tls_sni=MX.example.com tls_cert={0} tls_key={1}, "
+            "*.example.org tls_cert={0} tls_key={1}".format(cert, key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        assert conf.tls_sni == {
+            "mx.example.com": (cert, key),
+            "*.example.org": (cert, key),
+        }
+        conf.test_tls_sni()
+
+    def test_tls_sni_no_key(self):
+        cert = create_file("crt.crt")
+        settings = ("tls_sni=mx.example.com tls_cert={}".format(cert),)
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_sni()
+
+    def test_tls_sni_not_readable(self):
+        key = create_file("key.key")
+        settings = (
+            "tls_sni=mx.example.com tls_cert=/fake/crt.crt "
+            "tls_key={}".format(key),
+        )
+        cfile = create_config(settings)
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_sni()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestTlsWatchInterval(unittest.TestCase):
+    def test_tls_watch_interval_default(self):
+        conf = Config(None).load()
+        assert conf.tls_watch_interval == 0
+
+    def test_tls_watch_interval(self):
+        cfile = create_config(("tls_watch_interval=60",))
+        conf = Config(cfile).load()
+        assert conf.tls_watch_interval == 60
+        conf.test_tls_watch_interval()
+
+    def test_tls_watch_interval_invalid(self):
+        cfile = create_config(("tls_watch_interval=sixty",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_watch_interval()
+
+    def test_tls_watch_interval_negative(self):
+        cfile = create_config(("tls_watch_interval=-1",))
+        conf = Config(cfile).load()
+        with pytest.raises(ConfigException):
+            conf.test_tls_watch_interval()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestTlsKtls(unittest.TestCase):
+    def test_tls_ktls_default(self):
+        conf = Config(None).load()
+        assert conf.tls_ktls is False
+
+    def test_tls_ktls_true(self):
+        cfile = create_config(("tls_ktls=True",))
+        conf = Config(cfile).load()
+        assert conf.tls_ktls is True
+
+    def test_tls_ktls_false(self):
+        cfile = create_config(("tls_ktls=false",))
+        conf = Config(cfile).load()
+        assert conf.tls_ktls is False
+
+    def test_tls_ktls_invalid(self):
+        cfile = create_config(("tls_ktls=abc",))
+        with pytest.raises(ConfigException):
+            Config(cfile).load()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestReload(unittest.TestCase):
+    def test_reload(self):
+        cfile = create_config(("mode=bounce", "delay=5", "timeout=30"))
+        conf = Config(cfile).load()
+        create_config(("mode=random", "timeout=45"))
+        assert conf.reload() == []
+        assert conf.mode == "random"
+        assert conf.timeout == 45
+        assert conf.delay is None
+
+    def test_reload_restart_options(self):
+        cfile = create_config(("listen=:9999", "mode=bounce"))
+        conf = Config(cfile).load()
+        create_config(("listen=:9998", "mode=random"))
+        assert conf.reload() == ["listen"]
+        assert conf.listen[0][1] == 9999
+        assert conf.mode == "random"
+
+    def test_reload_invalid(self):
+        cfile = create_config(("mode=bounce", "timeout=30"))
+        conf = Config(cfile).load()
+        create_config(("mode=random", "timeout=500"))
+        with pytest.raises(ConfigException):
+            conf.reload()
+        assert conf.mode == "bounce"
+        assert conf.timeout == 30
+
+    def test_reload_invalid_option(self):
+        cfile = create_config(("mode=bounce",))
+        conf = Config(cfile).load()
+        create_config(("mode=random", "abc=1"))
+        with pytest.raises(ConfigException):
+            conf.reload()
+        assert conf.mode == "bounce"
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 class TestWorkers(unittest.TestCase):
     def test_default(self):
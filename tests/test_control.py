@@ -32,17 +32,29 @@
 
 from blackhole.config import Config
 from blackhole.control import (
+    OP_ENABLE_KTLS,
+    TICKET_KEYS_SIZE,
     _context,
     _socket,
     pid_permissions,
     server,
+    set_affinity,
+    set_ticket_keys,
     setgid,
     setuid,
+    sni_contexts,
+    ticket_keys,
+    tls_contexts,
+    worker_cpus,
 )
 from blackhole.exceptions import BlackholeRuntimeException
 
 
 from ._utils import (  # noqa: F401; isort:skip
+    SNI_CERT,
+    SNI_KEY,
+    TLS_CERT,
+    TLS_KEY,
     Args,
     cleandir,
     create_config,
@@ -125,6 +137,31 @@ def test_tls_context_dhparams():
     assert dh.called is True
 
 
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.parametrize(
+    "enabled, available, expected",
+    ((True, True, True), (True, False, False), (False, True, False)),
+)
+def test_tls_context_ktls(enabled, available, expected):
+    cfile = create_config(
+        (
+            "tls_listen=127.0.0.1:9000",
+            "tls_cert={}".format(TLS_CERT),
+            "tls_key={}".format(TLS_KEY),
+            "tls_ktls={}".format(str(enabled).lower()),
+        ),
+    )
+    conf = Config(cfile).load()
+    conf.args = Args((("less_secure", False),))
+    with mock.patch(
+        "blackhole.control.ktls_available",
+        return_value=available,
+    ):
+        ctx = _context(use_tls=True)
+    assert bool(ctx.options & OP_ENABLE_KTLS) is expected
+
+
 @unittest.skipIf(socket.has_ipv6 is False, "No IPv6 support")
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_create_ipv6_socket_fails():
@@ -239,6 +276,43 @@ def test_create_server_tls_ipv4_bind_works():
     assert mock_ssl.call_count == 1
 
 
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_create_server_starttls():
+    cfile = create_config(("listen=127.0.0.1:25",))
+    conf = Config(cfile).load()
+    conf.args = Args((("less_secure", False),))
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "ssl.create_default_context",
+    ) as mock_ssl:
+        _server = server("127.0.0.1", 25, socket.AF_INET, starttls=True)
+        _server["sock"].close()
+    assert _server["ssl"] is None
+    assert _server["starttls"] is mock_ssl.return_value
+    assert mock_ssl.call_count == 1
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_create_server_flags():
+    cfile = create_config(("listen=127.0.0.1:25",))
+    conf = Config(cfile).load()
+    conf.args = Args((("less_secure", False),))
+    flags = {"tls_cert": SNI_CERT, "tls_key": SNI_KEY}
+    with mock.patch("socket.socket.bind"):
+        _server = server(
+            "127.0.0.1",
+            25,
+            socket.AF_INET,
+            starttls=True,
+            flags=flags,
+        )
+        _server["sock"].close()
+    assert _server["flags"] == flags
+    client = _handshake(_client_context(), _server["starttls"])
+    assert client.getpeercert(True) == _der(SNI_CERT)
+
+
 @unittest.skipIf(socket.has_ipv6 is False, "No IPv6 support")
 @unittest.skipIf(ssl is None, "No ssl module")
 @pytest.mark.usefixtures("reset", "cleandir")
@@ -373,3 +447,209 @@ def test_set_pid_permissions():
     ) as err:
         pid_permissions()
     assert err.value.code == 64
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_worker_cpus_not_pinned():
+    Config(None).load()
+    assert worker_cpus("1") is None
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_worker_cpus():
+    cfile = create_config(("worker_cpu_affinity=0-1 2 3",))
+    Config(cfile).load()
+    assert worker_cpus("1") == {0, 1}
+    assert worker_cpus("3") == {3}
+    assert worker_cpus("4") == {0, 1}
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_worker_cpus_supervisor_pinned():
+    cfile = create_config(("supervisor_cpu_affinity=0",))
+    Config(cfile).load()
+    with mock.patch(
+        "blackhole.control.available_cpus",
+        return_value=frozenset(range(4)),
+    ):
+        assert worker_cpus("1") == {0, 1, 2, 3}
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_worker_cpus_auto():
+    cfile = create_config(("worker_cpu_affinity=auto",))
+    conf = Config(cfile).load()
+    conf.supervisor_cpu_affinity = "0"
+    with mock.patch(
+        "blackhole.control._cpu_order",
+        return_value=[0, 2, 1, 3],
+    ):
+        assert [worker_cpus(str(idx)) for idx in range(1, 6)] == [
+            {2},
+            {1},
+            {3},
+            {0},
+            {2},
+        ]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_affinity():
+    with mock.patch("os.sched_setaffinity", create=True) as mock_affinity:
+        set_affinity(None)
+        assert mock_affinity.called is False
+        set_affinity({1, 2})
+    mock_affinity.assert_called_once_with(0, {1, 2})
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_affinity_fails():
+    with mock.patch(
+        "os.sched_setaffinity",
+        create=True,
+        side_effect=OSError,
+    ), mock.patch("blackhole.control.logger.warning") as mock_log:
+        set_affinity({1})
+    assert mock_log.called is True
+
+
+def _server_context():
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(TLS_CERT, TLS_KEY)
+    return ctx
+
+
+def _client_context():
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def _handshake(client_ctx, server_ctx, session=None, server_hostname=None):
+    bios = [ssl.MemoryBIO() for _ in range(4)]
+    client = client_ctx.wrap_bio(
+        bios[0],
+        bios[1],
+        server_hostname=server_hostname,
+        session=session,
+    )
+    server = server_ctx.wrap_bio(bios[2], bios[3], server_side=True)
+    for _ in range(10):
+        for conn, incoming, outgoing in (
+            (client, bios[0], bios[3]),
+            (server, bios[2], bios[1]),
+        ):
+            try:
+                conn.do_handshake()
+            except ssl.SSLWantReadError:
+                pass
+            incoming.write(outgoing.read())
+    # TLSv1.3 tickets are sent after the handshake.
+    try:
+        client.read()
+    except ssl.SSLWantReadError:
+        pass
+    return client
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_ticket_keys():
+    keys = ticket_keys()
+    assert len(keys) == TICKET_KEYS_SIZE
+    assert keys != ticket_keys()
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys_resumes():
+    ctx = _client_context()
+    first, second = _server_context(), _server_context()
+    client = _handshake(ctx, first)
+    assert _handshake(ctx, second, client.session).session_reused is False
+    keys = ticket_keys()
+    assert set_ticket_keys([first, None, second], keys) is True
+    client = _handshake(ctx, first)
+    assert client.session_reused is False
+    assert _handshake(ctx, second, client.session).session_reused is True
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys_unavailable():
+    with mock.patch("blackhole.control._ssl_ctx_ctrl", return_value=None):
+        assert set_ticket_keys([_server_context()], ticket_keys()) is False
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys_fails():
+    ctrl = mock.Mock(return_value=0)
+    with mock.patch("blackhole.control._ssl_ctx_ctrl", return_value=ctrl):
+        assert set_ticket_keys([_server_context()], ticket_keys()) is False
+    assert ctrl.call_count == 1
+
+
+def _der(cert):
+    with open(cert) as pem:
+        return ssl.PEM_cert_to_DER_cert(pem.read())
+
+
+def _sni_config(names):
+    sni = ", ".join(
+        "{} tls_cert={} tls_key={}".format(name, SNI_CERT, SNI_KEY)
+        for name in names
+    )
+    settings = (
+        "tls_cert={}".format(TLS_CERT),
+        "tls_key={}".format(TLS_KEY),
+        "tls_sni={}".format(sni),
+    )
+    conf = Config(create_config(settings)).load()
+    conf.args = Args((("less_secure", False),))
+    return conf
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_sni_contexts():
+    _sni_config(("mx.blackhole.io", "*.blackhole.org"))
+    contexts = sni_contexts()
+    assert sorted(contexts) == ["*.blackhole.org", "mx.blackhole.io"]
+    ctx = _context(use_tls=True, sni=contexts)
+    client_ctx = _client_context()
+    for name, cert in (
+        ("mx.blackhole.io", SNI_CERT),
+        ("MX.Blackhole.IO", SNI_CERT),
+        ("mx.blackhole.org", SNI_CERT),
+        ("blackhole.org", TLS_CERT),
+        ("a.mx.blackhole.org", TLS_CERT),
+        ("blackhole.io", TLS_CERT),
+        (None, TLS_CERT),
+    ):
+        client = _handshake(client_ctx, ctx, server_hostname=name)
+        assert client.getpeercert(True) == _der(cert)
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_tls_contexts():
+    _sni_config(("mx.blackhole.io",))
+    ctx, starttls_ctx = tls_contexts(use_tls=True)
+    assert starttls_ctx is None
+    client_ctx = _client_context()
+    client = _handshake(client_ctx, ctx)
+    assert client.getpeercert(True) == _der(TLS_CERT)
+    client = _handshake(client_ctx, ctx, server_hostname="mx.blackhole.io")
+    assert client.getpeercert(True) == _der(SNI_CERT)
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_tls_contexts_listener_flags():
+    _sni_config(())
+    flags = {"tls_cert": SNI_CERT, "tls_key": SNI_KEY, "mode": "bounce"}
+    ctx, starttls_ctx = tls_contexts(starttls=True, flags=flags)
+    assert ctx is None
+    client = _handshake(_client_context(), starttls_ctx)
+    assert client.getpeercert(True) == _der(SNI_CERT)
@@ -24,10 +24,11 @@
 
 
 import logging
+from unittest import mock
 
 import pytest
 
-from blackhole.logs import configure_logs
+from blackhole.logs import Trace, configure_logs, trace
 
 
 from ._utils import (  # noqa: F401; isort:skip
@@ -69,3 +70,46 @@ def test_quiet():
     logger = logging.getLogger("blackhole")
     configure_logs(args)
     assert logger.handlers[0].level is logging.ERROR
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_trace_disabled():
+    with mock.patch("blackhole.logs.logger.isEnabledFor", return_value=False):
+        assert trace(("127.0.0.1", 2525)) is None
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_trace_enabled():
+    with mock.patch("blackhole.logs.logger.isEnabledFor", return_value=True):
+        tracer = trace(("127.0.0.1", 2525))
+    assert isinstance(tracer, Trace)
+    assert tracer.peer == "127.0.0.1:2525"
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_trace_sampled():
+    with mock.patch(
+        "blackhole.logs.logger.isEnabledFor",
+        return_value=True,
+    ), mock.patch("random.random", side_effect=(0.2, 0.7)):
+        assert trace(("127.0.0.1", 2525), 0.5) is not None
+        assert trace(("127.0.0.1", 2525), 0.5) is None
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_trace_message():
+    with mock.patch("blackhole.logs.logger.debug") as mock_debug:
+        Trace("127.0.0.1:2525")("RECV %r", b"QUIT\r\n")
+    mock_debug.assert_called_once_with(
+        "[%s] RECV %r",
+        "127.0.0.1:2525",
+        b"QUIT\r\n",
+    )
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_trace_message_percent_peer():
+    with mock.patch("blackhole.logs.logger.debug") as mock_debug:
+        Trace("fe80::1%eth0:2525")("RECV %r", b"QUIT\r\n")
+    msg, *args = mock_debug.call_args[0]
+    assert msg % tuple(args) == "[fe80::1%eth0:2525] RECV b'QUIT\\r\\n'"
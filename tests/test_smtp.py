@@ -27,6 +27,7 @@
 import inspect
 import random
 import socket
+import ssl
 import string
 import threading
 import time
@@ -37,11 +38,14 @@
 import pytest
 
 from blackhole.config import Config
-from blackhole.control import _socket
-from blackhole.smtp import Smtp
+from blackhole.control import _context, _socket
+from blackhole.protocols import CallbackProtocol, Stats
+from blackhole.smtp import ENGINES, CallbackSmtp, Smtp
 
 
 from ._utils import (  # noqa: F401; isort:skip
+    TLS_CERT,
+    TLS_KEY,
     Args,
     cleandir,
     create_config,
@@ -67,19 +71,19 @@ def test_initiation():
     ):
         conf = Config(cfile)
     conf.load()
-    smtp = Smtp([])
+    smtp = Smtp(set())
     assert smtp.fqdn == "a.blackhole.io"
 
 
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_auth_mechanisms():
-    smtp = Smtp([])
+    smtp = Smtp(set())
     assert smtp.get_auth_members() == ["CRAM-MD5", "LOGIN", "PLAIN"]
 
 
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_handler_lookup():
-    smtp = Smtp([])
+    smtp = Smtp(set())
     assert smtp.lookup_handler("AUTH CRAM-MD5") == smtp.auth_CRAM_MD5
     assert smtp.lookup_handler("AUTH LOGIN") == smtp.auth_LOGIN
     assert smtp.lookup_handler("AUTH PLAIN") == smtp.auth_PLAIN
@@ -115,6 +119,115 @@ def test_handler_lookup():
     assert smtp.lookup_handler("HELP KURA") == smtp.help_UNKNOWN
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_handler_lookup_case_insensitive():
+    smtp = Smtp(set())
+    assert smtp.lookup_handler("noop") == smtp.do_NOOP
+    assert smtp.lookup_handler("Rcpt TO: <kura@example.com>") == smtp.do_RCPT
+    assert smtp.lookup_handler("help data") == smtp.help_DATA
+    assert smtp.lookup_handler("auth cram-md5") == smtp.auth_CRAM_MD5
+    assert smtp.lookup_handler("auth plain pass=test") == smtp._auth_success
+    assert smtp.lookup_handler("auth plain fail=test") == smtp._auth_failure
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_handler_tables():
+    assert Smtp._auth_mechanisms == ("CRAM-MD5", "LOGIN", "PLAIN")
+    assert Smtp._verb_handlers["NOOP"] == "do_NOOP"
+    assert Smtp._help_handlers["DATA"] == "help_DATA"
+    assert Smtp._auth_handlers["CRAM-MD5"] == "auth_CRAM_MD5"
+    assert "UNKNOWN" not in Smtp._help_handlers
+    assert "UNKNOWN" not in Smtp._auth_handlers
+    with pytest.raises(TypeError):
+        Smtp._verb_handlers["KURA"] = "do_KURA"
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_handler_tables_subclass():
+    class SubSmtp(Smtp):
+        async def do_KURA(self):
+            pass
+
+        async def help_KURA(self):
+            pass
+
+        async def auth_XOAUTH2(self):
+            pass
+
+    smtp = SubSmtp(set())
+    assert smtp.lookup_handler("KURA") == smtp.do_KURA
+    assert smtp.lookup_handler("HELP KURA") == smtp.help_KURA
+    assert smtp.lookup_handler("AUTH XOAUTH2") == smtp.auth_XOAUTH2
+    assert smtp.get_auth_members() == ["CRAM-MD5", "LOGIN", "PLAIN", "XOAUTH2"]
+    assert "KURA" in smtp.get_help_members()
+    assert "KURA" not in Smtp._verb_handlers
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_responses_cached():
+    Config(None).mailname = "blackhole.io"
+    smtp, smtp2 = Smtp(set()), Smtp(set())
+    assert smtp.responses is smtp2.responses
+    assert smtp.responses["greeting"] == b"220 blackhole.io ESMTP\r\n"
+    assert smtp.responses["help_auth"] == (
+        b"250 Syntax: AUTH CRAM-MD5 LOGIN PLAIN\r\n"
+    )
+    ehlo = smtp.responses["ehlo"].split(b"\r\n")
+    assert ehlo[0] == b"250-blackhole.io"
+    assert b"250-SIZE 512000" in ehlo
+    assert ehlo[-2:] == [b"250 DSN", b""]
+    ehlo_starttls = smtp.responses["ehlo_starttls"].split(b"\r\n")
+    assert ehlo_starttls[-3:] == [b"250-STARTTLS", b"250 DSN", b""]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_snapshot_shared():
+    conf = Config(None)
+    snapshot = conf.snapshot()
+    smtp = CallbackSmtp(set(), snapshot=snapshot)
+    assert smtp.config is snapshot
+    assert not hasattr(smtp, "__dict__")
+    conf.max_message_size = 1024
+    assert smtp.config.max_message_size == 512000
+    assert CallbackSmtp(set()).config.max_message_size == 1024
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_responses_cache_invalidated_by_config():
+    conf = Config(None)
+    conf.mailname = "blackhole.io"
+    responses = Smtp(set()).responses
+    conf.max_message_size = 1024
+    smtp = Smtp(set())
+    assert smtp.responses is not responses
+    assert b"250-SIZE 1024\r\n" in smtp.responses["ehlo"]
+    conf.mailname = "a.blackhole.io"
+    smtp = Smtp(set())
+    assert smtp.responses["greeting"] == b"220 a.blackhole.io ESMTP\r\n"
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_responses_batched_until_flush(event_loop):
+    smtp = Smtp([], loop=event_loop)
+    smtp._writer = mock.MagicMock()
+
+    async def drain():
+        pass
+
+    smtp._writer.drain = drain
+    await smtp.push(250, "2.0.0 OK")
+    await smtp.push(250, "2.1.5 OK")
+    assert smtp._writer.write.called is False
+    await smtp.flush()
+    smtp._writer.write.assert_called_once_with(
+        b"250 2.0.0 OK\r\n250 2.1.5 OK\r\n",
+    )
+    assert smtp._pending == []
+    await smtp.flush()
+    assert smtp._writer.write.call_count == 1
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_unknown_handlers():
     # Protection against adding/removing without updating tests
@@ -151,7 +264,7 @@ def test_unknown_handlers():
         "help_VRFY",
     ]
     auths = ["auth_CRAM_MD5", "auth_LOGIN", "auth_PLAIN", "auth_UNKNOWN"]
-    smtp = Smtp([])
+    smtp = Smtp(set())
     for mem in inspect.getmembers(smtp, inspect.ismethod):
         f, _ = mem
         if f.startswith("do_"):
@@ -177,7 +290,11 @@ def _run(self, ready_event):
         asyncio.set_event_loop(self.loop)
         conf = Config(None)
         conf.mailname = "blackhole.io"
-        _server = self.loop.create_server(lambda: Smtp([]), sock=self.sock)
+        protocol = ENGINES[conf.engine]
+        _server = self.loop.create_server(
+            lambda: protocol(set()),
+            sock=self.sock,
+        )
         self.server = self.loop.run_until_complete(_server)
         self.loop.call_soon(ready_event.set)
         self.loop.run_forever()
@@ -313,6 +430,278 @@ async def test_timeout(event_loop):
     controller.stop()
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.slow
+async def test_timeout_reset_by_activity(event_loop):
+    cfile = create_config(("timeout=2",))
+    Config(cfile).load()
+    controller = Controller()
+    controller.start()
+    host, port = controller.sock.getsockname()
+    with SMTP(host, port) as client:
+        for _ in range(3):
+            await asyncio.sleep(1.2)
+            code, resp = client.noop()
+            assert code == 250
+        await asyncio.sleep(3)
+        code, resp = client.noop()
+        assert code == 421
+        assert resp == b"Timeout"
+    controller.stop()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_clients_registry(event_loop, engine):
+    Config(None).mailname = "blackhole.io"
+    clients = set()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(
+        lambda: engine(clients, loop=event_loop),
+        sock=sock,
+    )
+    reader, writer = await asyncio.open_connection(*sock.getsockname())
+    assert (await reader.readline()).startswith(b"220 ")
+    assert len(clients) == 1
+    writer.write(b"QUIT\r\n")
+    assert await reader.readline() == b"221 2.0.0 Goodbye\r\n"
+    assert await reader.read() == b""
+    writer.close()
+    await asyncio.sleep(0.1)
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_stats(event_loop, engine):
+    Config(None).mailname = "blackhole.io"
+    stats = Stats()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(
+        lambda: engine(set(), loop=event_loop, stats=stats),
+        sock=sock,
+    )
+    reader, writer = await asyncio.open_connection(*sock.getsockname())
+    writer.write(
+        b"MAIL FROM: <a@b.c>\r\nRCPT TO: <a@b.c>\r\nDATA\r\n"
+        b"Subject: stats\r\n\r\nbody\r\n.\r\nQUIT\r\n",
+    )
+    await reader.read()
+    writer.close()
+    assert stats.messages == 1
+    assert stats.bytes == len(b"Subject: stats\r\n\r\nbody\r\n.\r\n")
+    assert stats.codes == {220: 1, 250: 3, 354: 1, 221: 1}
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_drain_idle(event_loop, engine):
+    Config(None).mailname = "blackhole.io"
+    protocols = []
+
+    def factory():
+        protocols.append(engine(set(), loop=event_loop))
+        return protocols[-1]
+
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(factory, sock=sock)
+    reader, writer = await asyncio.open_connection(*sock.getsockname())
+    await reader.readline()
+    writer.write(b"EHLO blackhole.io\r\n")
+    while not (await reader.readline()).startswith(b"250 "):
+        pass
+    protocols[0].drain()
+    assert await reader.read() == b"421 4.3.2 Service shutting down\r\n"
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_drain_transaction(event_loop, engine):
+    Config(None).mailname = "blackhole.io"
+    protocols = []
+
+    def factory():
+        protocols.append(engine(set(), loop=event_loop))
+        return protocols[-1]
+
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(factory, sock=sock)
+    reader, writer = await asyncio.open_connection(*sock.getsockname())
+    await reader.readline()
+    writer.write(b"MAIL FROM: <a@b.c>\r\nRCPT TO: <a@b.c>\r\n")
+    await reader.readline()
+    await reader.readline()
+    protocols[0].drain()
+    writer.write(b"DATA\r\n")
+    assert (await reader.readline()).startswith(b"354 ")
+    writer.write(b"Subject: drain\r\n\r\nbody\r\n.\r\n")
+    assert (await reader.readline()).startswith(b"250 ")
+    assert await reader.read() == b"421 4.3.2 Service shutting down\r\n"
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+@pytest.mark.parametrize("debug", (True, False))
+async def test_trace(event_loop, engine, debug):
+    Config(None).mailname = "blackhole.io"
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(
+        lambda: engine(set(), loop=event_loop),
+        sock=sock,
+    )
+    with mock.patch(
+        "blackhole.logs.logger.isEnabledFor",
+        return_value=debug,
+    ), mock.patch("blackhole.logs.logger.debug") as mock_debug:
+        reader, writer = await asyncio.open_connection(*sock.getsockname())
+        await reader.readline()
+        writer.write(b"QUIT\r\n")
+        await reader.read()
+        writer.close()
+    messages = [call[0][0] for call in mock_debug.call_args_list]
+    assert ("RECV %r" in " ".join(messages)) is debug
+    server.close()
+    await server.wait_closed()
+
+
+async def starttls_server(event_loop, engine, clients=None):
+    conf = Config(None)
+    conf.mailname = "blackhole.io"
+    conf.tls_cert, conf.tls_key = TLS_CERT, TLS_KEY
+    conf.args = Args((("less_secure", False),))
+    snapshot = conf.snapshot(starttls=_context(use_tls=True))
+    clients = clients if clients is not None else set()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(
+        lambda: engine(clients, loop=event_loop, snapshot=snapshot),
+        sock=sock,
+    )
+    return server, sock.getsockname()
+
+
+def client_context():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_starttls(event_loop, engine):
+    clients = set()
+    server, (host, port) = await starttls_server(event_loop, engine, clients)
+
+    def client():
+        with SMTP(host, port) as smtp:
+            smtp.ehlo()
+            assert smtp.has_extn("starttls") is True
+            code, resp = smtp.starttls(context=client_context())
+            assert (code, resp) == (220, b"2.0.0 Ready to start TLS")
+            assert len(clients) == 1
+            smtp.ehlo()
+            assert smtp.has_extn("starttls") is False
+            code, resp = smtp.docmd("STARTTLS")
+            assert (code, resp) == (503, b"5.5.1 TLS already active")
+            assert smtp.sendmail("a@b.c", ["a@b.c"], b"Subject: tls") == {}
+
+    await event_loop.run_in_executor(None, client)
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_starttls_parameters(event_loop, engine):
+    server, address = await starttls_server(event_loop, engine)
+    reader, writer = await asyncio.open_connection(*address)
+    await reader.readline()
+    writer.write(b"STARTTLS now\r\n")
+    assert await reader.readline() == (
+        b"501 5.5.4 Syntax error, no parameters allowed\r\n"
+    )
+    writer.write(b"QUIT\r\n")
+    assert await reader.read() == b"221 2.0.0 Goodbye\r\n"
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_starttls_discards_pipelined(event_loop, engine):
+    server, address = await starttls_server(event_loop, engine)
+
+    def client():
+        with socket.create_connection(address, timeout=5) as sock:
+            sock.recv(1024)
+            sock.sendall(b"STARTTLS\r\nNOOP\r\n")
+            assert sock.recv(1024) == b"220 2.0.0 Ready to start TLS\r\n"
+            with client_context().wrap_socket(sock) as tls:
+                tls.sendall(b"RSET\r\n")
+                assert tls.recv(1024) == b"250 2.0.0 OK\r\n"
+                tls.sendall(b"QUIT\r\n")
+                assert tls.recv(1024) == b"221 2.0.0 Goodbye\r\n"
+
+    await event_loop.run_in_executor(None, client)
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_starttls_handshake_fails(event_loop, engine):
+    clients = set()
+    server, address = await starttls_server(event_loop, engine, clients)
+    reader, writer = await asyncio.open_connection(*address)
+    await reader.readline()
+    writer.write(b"STARTTLS\r\n")
+    assert await reader.readline() == b"220 2.0.0 Ready to start TLS\r\n"
+    writer.write(b"EHLO blackhole.io\r\n")
+    assert await reader.read() == b""
+    await asyncio.sleep(0.1)
+    assert len(clients) == 0
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_idle_timer_rearms_while_busy(event_loop):
+    smtp = Smtp([], loop=event_loop)
+    smtp._idle_timeout()
+    assert smtp._interrupt is None
+    assert smtp._idle_handle is not None
+    smtp._idle_handle.cancel()
+    smtp._last_activity -= smtp.config.timeout
+    smtp._read_waiter = mock.Mock()
+    smtp._idle_timeout()
+    assert smtp._interrupt == smtp.timeout
+    assert smtp._idle_handle is None
+    smtp._read_waiter.cancel.assert_called_once_with()
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 @pytest.mark.asyncio
 @pytest.mark.slow
@@ -528,6 +917,17 @@ def test_data_too_large(self):
             assert code == 552
             assert resp == b"Message size exceeds fixed maximum message size"
 
+    def test_data_too_large_session_continues(self):
+        with SMTP(self.host, self.port) as client:
+            msg = "\r\n".join("x" * 76 for _ in range(100))
+            code, resp = client.data(msg)
+            assert code == 552
+            code, resp = client.noop()
+            assert code == 250
+            code, resp = client.data(b"testing 1, 2, 3")
+            assert code == 250
+            assert resp.startswith(b"2.0.0 OK: queued as")
+
     def test_data_fail(self):
         with SMTP(self.host, self.port) as client:
             msg = [
@@ -883,6 +1283,55 @@ def test_auth_unknown(self):
             assert code == 501
             assert resp == b"5.5.4 Syntax: AUTH mechanism"
 
+    def test_pipelining(self):
+        client = socket.create_connection((self.host, self.port))
+        client.settimeout(5)
+        assert client.recv(1024).startswith(b"220 ")
+        cmds = [b"EHLO example.com", b"MAIL FROM: <kura@example.com>"]
+        cmds.extend(b"RCPT TO: <kura%d@example.com>" % i for i in range(10))
+        cmds.append(b"NOOP")
+        client.sendall(b"\r\n".join(cmds) + b"\r\n")
+        data = b""
+        while not data.endswith(b"250 2.0.0 OK\r\n"):
+            data += client.recv(4096)
+        lines = data.split(b"\r\n")[:-1]
+        finals = [line for line in lines if line[3:4] == b" "]
+        assert finals[0] == b"250 DSN"
+        assert finals[1] == b"250 2.1.0 OK"
+        assert finals[2:12] == [b"250 2.1.5 OK"] * 10
+        assert finals[12] == b"250 2.0.0 OK"
+        client.sendall(b"QUIT\r\n")
+        assert client.recv(1024) == b"221 2.0.0 Goodbye\r\n"
+        client.close()
+
+    def test_data_terminator_split(self):
+        client = socket.create_connection((self.host, self.port))
+        client.settimeout(5)
+        assert client.recv(1024).startswith(b"220 ")
+        client.sendall(b"MAIL FROM: <kura@example.com>\r\n")
+        client.sendall(b"RCPT TO: <kura@example.com>\r\nDATA\r\n")
+        data = b""
+        while not data.endswith(
+            b"\r\n354 End data with <CR><LF>.<CR><LF>\r\n",
+        ):
+            data += client.recv(1024)
+        client.sendall(b"X-Blackhole-Mode: accept\r\n\r\n..\r\nx.\r\n")
+        client.sendall(b"testing 1, 2, 3.\r")
+        client.sendall(b"\n.")
+        client.sendall(b"\r\nNOOP\r\n")
+        data = b""
+        while not data.endswith(b"250 2.0.0 OK\r\n"):
+            data += client.recv(1024)
+        assert data.startswith(b"250 2.0.0 OK: queued as")
+        client.close()
+
+    def test_data_long_line(self):
+        with SMTP(self.host, self.port) as client:
+            code, resp = client.data(b"x" * 200000)
+            assert code == 552
+            code, resp = client.data(b"testing 1, 2, 3")
+            assert code == 250
+
     def test_too_many_unknown_commands(self):
         with SMTP(self.host, self.port) as client, pytest.raises(
             SMTPServerDisconnected,
@@ -891,3 +1340,101 @@ def test_too_many_unknown_commands(self):
                 code, resp = client.docmd("KURA")
             assert code == 502
             assert resp == b"5.5.3 Too many unknown commands"
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+class TestCallbackSmtp(TestSmtp):
+    def setUp(self):
+        cfile = create_config(
+            ("timeout=5", "max_message_size=1024", "engine=callback"),
+        )
+        Config(cfile).load()
+        controller = Controller()
+        controller.start()
+        self.host, self.port = controller.sock.getsockname()
+        self.addCleanup(controller.stop)
+
+    def test_pipelined_lines_wait_for_suspended_handler(self):
+        client = socket.create_connection((self.host, self.port))
+        client.settimeout(5)
+        assert client.recv(1024).startswith(b"220 ")
+        client.sendall(b"AUTH LOGIN\r\n")
+        assert client.recv(1024) == b"334 VXNlcm5hbWU6\r\n"
+        client.sendall(b"dGVzdA==\r\nNOOP\r\n")
+        data = b""
+        while not data.endswith(b"250 2.0.0 OK\r\n"):
+            data += client.recv(1024)
+        assert (
+            data == b"235 2.7.0 Authentication successful\r\n250 2.0.0 OK\r\n"
+        )
+        client.close()
+
+
+class _LineProtocol(CallbackProtocol):
+    async def _handle_line(self, line):
+        self.tasks.append(asyncio.current_task())
+        await asyncio.sleep(0)
+        self.lines.append(line)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_callback_protocol_is_abstract():
+    with pytest.raises(TypeError):
+        CallbackProtocol(set())
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_callback_handlers_run_without_task(event_loop):
+    protocol = _LineProtocol(set(), loop=event_loop)
+    protocol.tasks, protocol.lines = [], []
+    protocol.connection_made(mock.Mock())
+    # Transports call data_received from the event loop, outside any task.
+    event_loop.call_soon(protocol.data_received, b"one\r\ntwo\r\n")
+    await asyncio.sleep(0)
+    assert protocol.lines == []
+    for _ in range(4):
+        await asyncio.sleep(0)
+    assert protocol.lines == [b"one\r\n", b"two\r\n"]
+    assert protocol.tasks == [None, None]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.slow
+async def test_callback_timeout(event_loop):
+    cfile = create_config(("timeout=2", "engine=callback"))
+    Config(cfile).load()
+    controller = Controller()
+    controller.start()
+    host, port = controller.sock.getsockname()
+    with SMTP(host, port) as client:
+        await asyncio.sleep(1.2)
+        code, resp = client.noop()
+        assert code == 250
+        await asyncio.sleep(3)
+        code, resp = client.noop()
+        assert code == 421
+        assert resp == b"Timeout"
+    controller.stop()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.slow
+async def test_callback_delay(event_loop):
+    cfile = create_config(("timeout=10", "engine=callback"))
+    Config(cfile).load()
+    controller = Controller()
+    controller.start()
+    host, port = controller.sock.getsockname()
+    with SMTP(host, port) as client:
+        msg = "\n".join(("X-Blackhole-Delay: 2", "", "Testing 1, 2, 3"))
+        start = time.time()
+        code, resp = client.data(msg.encode("utf-8"))
+        stop = time.time()
+        assert code == 250
+        assert round(stop - start) in (1, 2, 3)
+        code, resp = client.noop()
+        assert code == 250
+    controller.stop()
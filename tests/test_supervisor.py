@@ -23,6 +23,7 @@
 # SOFTWARE.
 
 
+import asyncio
 import unittest
 from unittest import mock
 
@@ -30,10 +31,15 @@
 
 from blackhole.config import Config
 from blackhole.exceptions import BlackholeRuntimeException
+from blackhole.smtp import CallbackSmtp, Smtp
 from blackhole.supervisor import Supervisor
 
 
 from ._utils import (  # noqa: F401; isort:skip
+    SNI_CERT,
+    SNI_KEY,
+    TLS_CERT,
+    TLS_KEY,
     Args,
     cleandir,
     create_config,
@@ -350,6 +356,79 @@ def test_create(event_loop):
     event_loop.close()
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_create_reuse_port(event_loop):
+    cfile = create_config(
+        ("listen=:9999, :::9999", "workers=2", "reuse_port=true"),
+    )
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        assert len(supervisor.socks) == 4
+        supervisor.start_workers()
+        first, second = supervisor.workers
+        assert len(first.socks) == 2
+        assert len(second.socks) == 2
+        socks = [s["sock"] for s in first.socks + second.socks]
+        assert len(set(socks)) == 4
+        supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_scale(event_loop):
+    cfile = create_config(
+        ("listen=:9999", "workers=auto", "min_workers=1", "max_workers=2"),
+    )
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+        assert len(supervisor.workers) == 1
+        supervisor.scale_cooldown = 0
+        supervisor.workers[0].cpu = 0.9
+        supervisor.scale()
+        assert len(supervisor.workers) == 2
+        supervisor.scale()
+        assert len(supervisor.workers) == 2
+        for worker in supervisor.workers:
+            worker.cpu = 0.1
+        supervisor.workers[0].connections = 10
+        with mock.patch(
+            "blackhole.supervisor.Supervisor.drain_worker",
+        ) as mock_drain:
+            supervisor.scale()
+            supervisor.scale()
+        assert mock_drain.call_count == 1
+        assert mock_drain.call_args[0][0].idx == "2"
+        assert [w.idx for w in supervisor.workers] == ["1"]
+        supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_scale_cooldown(event_loop):
+    cfile = create_config(("listen=:9999", "workers=auto", "max_workers=2"))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+        supervisor.workers[0].cpu = 0.9
+        supervisor.scale()
+        assert len(supervisor.workers) == 1
+        supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_run(event_loop):
     cfile = create_config(("listen=:9999, :::9999", "workers=2"))
@@ -366,27 +445,308 @@ def test_run(event_loop):
 
 
 @pytest.mark.usefixtures("reset", "cleandir")
-def test_stop(event_loop):
-    cfile = create_config(("listen=:9999, :::9999", "workers=2"))
+def test_prefork(event_loop):
+    cfile = create_config(("listen=:9999", "max_message_size=2048"))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"):
+        supervisor = Supervisor(loop=event_loop)
+    with mock.patch("gc.collect") as mock_collect:
+        supervisor.prefork()
+    assert mock_collect.called is True
+    for engine in (Smtp, CallbackSmtp):
+        key = (engine, supervisor.config.mailname, 2048)
+        assert key in engine._response_cache
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_rotate_ticket_keys(event_loop):
+    cfile = create_config(("listen=:9999", "workers=2"))
     Config(cfile).load()
     with mock.patch("socket.socket.bind"), mock.patch(
         "blackhole.worker.Worker.start",
     ):
         supervisor = Supervisor(loop=event_loop)
         supervisor.start_workers()
-        assert len(supervisor.workers) == 2
+    with mock.patch("blackhole.supervisor.set_ticket_keys") as mock_keys:
+        supervisor.rotate_ticket_keys()
+    assert mock_keys.called is False
+    assert supervisor.ticket_keys is None
+    supervisor.socks[0]["starttls"] = "starttls"
+    with mock.patch(
+        "blackhole.supervisor.set_ticket_keys",
+        return_value=True,
+    ) as mock_keys, mock.patch(
+        "blackhole.worker.Worker.set_ticket_keys",
+    ) as mock_worker:
+        supervisor.rotate_ticket_keys()
+    keys = supervisor.ticket_keys
+    mock_keys.assert_called_once_with([None, "starttls"], keys)
+    assert mock_worker.call_count == 2
+    mock_worker.assert_called_with(keys)
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_rotate_ticket_keys_fails(event_loop):
+    cfile = create_config(("listen=:9999",))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"):
+        supervisor = Supervisor(loop=event_loop)
+    supervisor.socks[0]["starttls"] = "starttls"
+    with mock.patch(
+        "blackhole.supervisor.set_ticket_keys",
+        return_value=False,
+    ), mock.patch("blackhole.supervisor.logger.warning") as mock_log:
+        supervisor.rotate_ticket_keys()
+    assert mock_log.called is True
+    assert supervisor.ticket_keys is None
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap(event_loop):
+    cfile = create_config(("listen=:9999", "workers=2"))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+    with mock.patch("blackhole.worker.Worker.reap") as mock_reap:
+        supervisor.reap()
+    assert mock_reap.call_count == 2
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_drain_worker(event_loop):
+    cfile = create_config(("listen=:9999",))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+    worker = supervisor.workers.pop()
+    with mock.patch("blackhole.worker.Worker.drain") as mock_drain, mock.patch(
+        "blackhole.worker.Worker.stop",
+    ) as mock_stop:
+        task = supervisor.drain_worker(worker)
+        assert supervisor.draining == [worker]
+        event_loop.run_until_complete(task)
+    assert mock_drain.call_count == 1
+    assert mock_stop.call_count == 1
+    assert supervisor.draining == []
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reload(event_loop):
+    cfile = create_config(("listen=:9999", "workers=2", "mode=accept"))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+        create_config(("listen=:9998", "workers=2", "mode=bounce"))
         with mock.patch(
-            "blackhole.worker.Worker.stop",
-        ) as mock_stop, pytest.raises(SystemExit) as exc:
-            supervisor.stop()
-    assert mock_stop.call_count == 2
-    assert exc.value.code == 0
+            "blackhole.supervisor.Supervisor.drain_worker",
+        ) as mock_drain:
+            supervisor.reload()
+    assert [w.idx for w in supervisor.workers] == ["3", "4"]
+    assert [c[0][0].idx for c in mock_drain.call_args_list] == ["1", "2"]
+    assert supervisor.workers[0].socks is supervisor.socks
+    assert supervisor.config.mode == "bounce"
+    assert supervisor.config.listen[0][1] == 9999
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reload_invalid(event_loop):
+    cfile = create_config(("listen=:9999", "mode=accept"))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+        create_config(("listen=:9999", "mode=bounce", "timeout=abc"))
+        with mock.patch(
+            "blackhole.supervisor.Supervisor.drain_worker",
+        ) as mock_drain:
+            supervisor.reload()
+    assert mock_drain.called is False
+    assert [w.idx for w in supervisor.workers] == ["1"]
+    assert supervisor.config.mode == "accept"
+    supervisor.close_socks()
     event_loop.run_until_complete(event_loop.shutdown_asyncgens())
     event_loop.close()
 
 
+@unittest.skipIf(ssl is None, "No ssl module")
 @pytest.mark.usefixtures("reset", "cleandir")
-def test_stop_runtime_error(event_loop):
+def test_spawn_listener_certificates(event_loop):
+    cfile = create_config(
+        (
+            "listen=127.0.0.1:9997, 127.0.0.1:9998 tls_cert={} "
+            "tls_key={}".format(SNI_CERT, SNI_KEY),
+            "tls_listen=127.0.0.1:9999 tls_cert={} tls_key={}, "
+            "127.0.0.1:9996".format(SNI_CERT, SNI_KEY),
+        ),
+    )
+    conf = Config(cfile).load()
+    conf.args = Args((("less_secure", False),))
+    with mock.patch("socket.socket.bind"):
+        supervisor = Supervisor(loop=event_loop)
+    assert len(supervisor.socks) == 3
+    plain, starttls, tls = supervisor.socks
+    assert plain["ssl"] is None and plain["starttls"] is None
+    assert starttls["ssl"] is None and starttls["starttls"] is not None
+    assert tls["ssl"] is not None and tls["starttls"] is None
+    assert tls["flags"] == {"tls_cert": SNI_CERT, "tls_key": SNI_KEY}
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+def _tls_supervisor(event_loop, *settings):
+    cfile = create_config(
+        (
+            "listen=127.0.0.1:9998",
+            "tls_listen=127.0.0.1:9999",
+            "tls_cert={}".format(TLS_CERT),
+            "tls_key={}".format(TLS_KEY),
+            "reuse_port=true",
+            "workers=2",
+        )
+        + settings,
+    )
+    conf = Config(cfile).load()
+    conf.args = Args((("less_secure", False),))
+    with mock.patch("socket.socket.bind"), mock.patch(
+        "blackhole.worker.Worker.start",
+    ):
+        supervisor = Supervisor(loop=event_loop)
+        supervisor.start_workers()
+    return supervisor
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reload_tls(event_loop):
+    supervisor = _tls_supervisor(event_loop)
+    old = [(s["ssl"], s["starttls"]) for s in supervisor.socks]
+    supervisor.ticket_keys = b"keys"
+    with mock.patch("blackhole.supervisor.set_ticket_keys") as mock_keys:
+        assert supervisor.reload_tls() is True
+    new = [(s["ssl"], s["starttls"]) for s in supervisor.socks]
+    assert len(new) == 4
+    assert not set(old) & set(new)
+    # Each worker's socket for a listener shares the listener's contexts.
+    assert new[0] == new[1] and new[2] == new[3]
+    assert new[0][0] is None and new[2][1] is None
+    assert sorted(mock_keys.call_args[0][0], key=id) == sorted(
+        [None, new[0][1], new[2][0], None],
+        key=id,
+    )
+    assert mock_keys.call_args[0][1] == b"keys"
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reload_tls_fails(event_loop):
+    supervisor = _tls_supervisor(event_loop)
+    old = [(s["ssl"], s["starttls"]) for s in supervisor.socks]
+    with mock.patch(
+        "blackhole.supervisor.tls_contexts",
+        side_effect=[(None, "starttls"), ssl.SSLError()],
+    ), mock.patch("blackhole.supervisor.logger.error") as mock_log:
+        assert supervisor.reload_tls() is False
+    assert mock_log.called is True
+    assert [(s["ssl"], s["starttls"]) for s in supervisor.socks] == old
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reload_tls_no_tls(event_loop):
+    cfile = create_config(("listen=:9999",))
+    Config(cfile).load()
+    with mock.patch("socket.socket.bind"):
+        supervisor = Supervisor(loop=event_loop)
+    with mock.patch("blackhole.supervisor.tls_contexts") as mock_tls:
+        assert supervisor.reload_tls() is False
+    assert mock_tls.called is False
+    assert supervisor.tls_files() == {}
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_tls_files(event_loop):
+    supervisor = _tls_supervisor(
+        event_loop,
+        "tls_sni=mx.blackhole.io tls_cert={} tls_key={}".format(
+            SNI_CERT,
+            SNI_KEY,
+        ),
+    )
+    files = supervisor.tls_files()
+    assert sorted(files) == sorted((TLS_CERT, TLS_KEY, SNI_CERT, SNI_KEY))
+    with mock.patch("os.stat", side_effect=OSError):
+        assert set(supervisor.tls_files().values()) == {None}
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@unittest.skipIf(ssl is None, "No ssl module")
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_watch_tls(event_loop):
+    supervisor = _tls_supervisor(event_loop)
+    states = iter(({"a": 1}, {"a": 1}, {"a": 2}, {"a": 3}))
+    supervisor.config._tls_watch_interval = 0
+    with mock.patch(
+        "blackhole.supervisor.Supervisor.tls_files",
+        side_effect=lambda: next(states, {"a": 3}),
+    ), mock.patch(
+        "blackhole.supervisor.Supervisor.reload_tls",
+        side_effect=[True, False],
+    ) as mock_reload, mock.patch(
+        "blackhole.supervisor.Supervisor.replace_workers",
+    ) as mock_replace:
+        task = asyncio.ensure_future(supervisor.watch_tls())
+        event_loop.run_until_complete(asyncio.sleep(0.01))
+        task.cancel()
+    assert mock_reload.call_count == 2
+    assert mock_replace.call_count == 1
+    supervisor.close_socks()
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_stop(event_loop):
     cfile = create_config(("listen=:9999, :::9999", "workers=2"))
     Config(cfile).load()
     with mock.patch("socket.socket.bind"), mock.patch(
@@ -396,16 +756,20 @@ def test_stop_runtime_error(event_loop):
         supervisor.start_workers()
         assert len(supervisor.workers) == 2
         with mock.patch(
+            "blackhole.worker.Worker.terminate",
+        ) as mock_terminate, mock.patch(
             "blackhole.worker.Worker.stop",
         ) as mock_stop, mock.patch(
             f"{_LOOP}.stop",
-            side_effect=RuntimeError,
-        ) as mock_rt, pytest.raises(
-            SystemExit,
-        ) as exc:
+        ) as mock_loop_stop:
+            supervisor.stop()
+            task = supervisor.stop_task
             supervisor.stop()
-    assert mock_rt.call_count == 1
+            assert supervisor.stop_task is task
+            event_loop.run_until_complete(task)
+    assert mock_terminate.call_count == 2
     assert mock_stop.call_count == 2
-    assert exc.value.code == 0
+    assert mock_loop_stop.call_count == 1
+    assert all(s["sock"].fileno() == -1 for s in supervisor.socks)
     event_loop.run_until_complete(event_loop.shutdown_asyncgens())
     event_loop.close()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+# (The MIT License)
+#
+# Copyright (c) 2013-2021 Kura
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the 'Software'), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import concurrent.futures
+import socket
+import ssl
+from smtplib import SMTP_SSL
+from unittest import mock
+
+import pytest
+
+from blackhole.config import Config
+from blackhole.control import _context, _socket
+from blackhole.smtp import ENGINES
+from blackhole.tls import (
+    HandshakeProtocol,
+    SocketHandshakeProtocol,
+    SocketTLSTransport,
+    TLSTransport,
+    ktls,
+)
+
+
+from ._utils import (  # noqa: F401; isort:skip
+    TLS_CERT,
+    TLS_KEY,
+    Args,
+    cleandir,
+    create_config,
+    create_file,
+    reset,
+)
+
+
+async def tls_server(
+    event_loop,
+    engine,
+    clients,
+    executor,
+    timeout=30,
+    protocol=HandshakeProtocol,
+):
+    conf = Config(None)
+    conf.mailname = "blackhole.io"
+    conf.tls_cert, conf.tls_key = TLS_CERT, TLS_KEY
+    conf.args = Args((("less_secure", False),))
+    context = _context(use_tls=True)
+    snapshot = conf.snapshot()
+    sock = _socket("127.0.0.1", 0, socket.AF_INET)
+    server = await event_loop.create_server(
+        lambda: protocol(
+            engine(clients, loop=event_loop, snapshot=snapshot),
+            context,
+            executor,
+            timeout,
+            loop=event_loop,
+        ),
+        sock=sock,
+    )
+    return server, sock.getsockname()
+
+
+def client_context():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_handshake_in_thread(event_loop, engine):
+    clients = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    server, (host, port) = await tls_server(
+        event_loop,
+        engine,
+        clients,
+        executor,
+    )
+
+    def client():
+        with SMTP_SSL(host, port, context=client_context()) as smtp:
+            assert len(clients) == 1
+            client = next(iter(clients))
+            transport = getattr(client, "transport", client)
+            assert isinstance(transport, TLSTransport)
+            assert smtp.ehlo()[0] == 250
+            assert smtp.has_extn("starttls") is False
+            assert smtp.sendmail("a@b.c", ["a@b.c"], b"Subject: tls") == {}
+
+    await event_loop.run_in_executor(None, client)
+    await asyncio.sleep(0.1)
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+    executor.shutdown()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+async def test_handshake_fails(event_loop, engine):
+    clients = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    server, addr = await tls_server(event_loop, engine, clients, executor)
+
+    def client():
+        with socket.create_connection(addr) as sock:
+            sock.sendall(b"EHLO blackhole.io\r\n")
+            sock.settimeout(5)
+            while sock.recv(1024):
+                pass
+
+    await event_loop.run_in_executor(None, client)
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+    executor.shutdown()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_handshake_timeout(event_loop):
+    clients = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    server, addr = await tls_server(
+        event_loop,
+        ENGINES["stream"],
+        clients,
+        executor,
+        timeout=0.5,
+    )
+
+    def client():
+        with socket.create_connection(addr) as sock:
+            sock.settimeout(5)
+            try:
+                return sock.recv(1024)
+            except ConnectionResetError:
+                return b""
+
+    assert await event_loop.run_in_executor(None, client) == b""
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+    executor.shutdown()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_transport_extra_info():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(TLS_CERT, TLS_KEY)
+    plain = mock.Mock()
+    protocol = mock.Mock()
+    transport = TLSTransport(plain, context, protocol)
+    assert transport.get_extra_info("sslcontext") is context
+    assert transport.get_extra_info("ssl_object") is transport.sslobj
+    peername = transport.get_extra_info("peername")
+    assert peername is plain.get_extra_info.return_value
+    plain.get_extra_info.assert_called_once_with("peername", None)
+    assert transport.get_protocol() is protocol
+    assert transport.can_write_eof() is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_transport_close():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(TLS_CERT, TLS_KEY)
+    plain = mock.Mock()
+    plain.is_closing.return_value = False
+    transport = TLSTransport(plain, context, mock.Mock())
+    transport.close()
+    transport.close()
+    assert plain.close.call_count == 1
+    assert transport.is_closing() is True
+    transport.write(b"220 OK\r\n")
+    assert plain.write.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ENGINES.values())
+@pytest.mark.parametrize("threads", (0, 1))
+async def test_socket_handshake(event_loop, engine, threads):
+    clients = set()
+    executor = None
+    if threads:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    server, (host, port) = await tls_server(
+        event_loop,
+        engine,
+        clients,
+        executor,
+        protocol=SocketHandshakeProtocol,
+    )
+    Config().max_message_size = 2 * 1024 * 1024
+    body = b"Subject: ktls\r\n\r\n" + b"x" * 76 + b"\r\n" * (1024 * 1024 // 78)
+
+    def client():
+        with SMTP_SSL(host, port, context=client_context()) as smtp:
+            assert len(clients) == 1
+            client = next(iter(clients))
+            transport = getattr(client, "transport", client)
+            assert isinstance(transport, SocketTLSTransport)
+            assert transport.get_extra_info("ktls") in (
+                (False, False),
+                (True, False),
+                (True, True),
+            )
+            assert transport.get_extra_info("sslcontext") is not None
+            assert smtp.ehlo()[0] == 250
+            assert smtp.has_extn("starttls") is False
+            assert smtp.sendmail("a@b.c", ["a@b.c"], body) == {}
+
+    await event_loop.run_in_executor(None, client)
+    await asyncio.sleep(0.1)
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+    if executor is not None:
+        executor.shutdown()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_socket_handshake_fails(event_loop):
+    clients = set()
+    server, addr = await tls_server(
+        event_loop,
+        ENGINES["stream"],
+        clients,
+        None,
+        protocol=SocketHandshakeProtocol,
+    )
+
+    def client():
+        with socket.create_connection(addr) as sock:
+            sock.sendall(b"EHLO blackhole.io\r\n")
+            sock.settimeout(5)
+            try:
+                while sock.recv(1024):
+                    pass
+            except ConnectionResetError:
+                pass
+
+    await event_loop.run_in_executor(None, client)
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_socket_handshake_timeout(event_loop):
+    clients = set()
+    server, addr = await tls_server(
+        event_loop,
+        ENGINES["stream"],
+        clients,
+        None,
+        timeout=0.5,
+        protocol=SocketHandshakeProtocol,
+    )
+
+    def client():
+        with socket.create_connection(addr) as sock:
+            sock.settimeout(5)
+            try:
+                return sock.recv(1024)
+            except ConnectionResetError:
+                return b""
+
+    assert await event_loop.run_in_executor(None, client) == b""
+    assert len(clients) == 0
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_ktls():
+    sock = mock.Mock()
+    assert ktls(sock) == (True, True)
+    sock.getsockopt.side_effect = [None, OSError()]
+    assert ktls(sock) == (True, False)
+    with socket.socket() as sock:
+        assert ktls(sock) == (False, False)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_socket_transport_write_buffer():
+    sock, protocol, loop = mock.Mock(), mock.Mock(), mock.Mock()
+    sock.send.side_effect = ssl.SSLWantWriteError()
+    transport = SocketTLSTransport(sock, protocol, loop)
+    assert transport.get_extra_info("ktls") == (True, True)
+    transport.set_write_buffer_limits(high=8)
+    transport.write(b"250 OK\r\n250 OK\r\n")
+    assert transport.get_write_buffer_size() == 16
+    assert protocol.pause_writing.call_count == 1
+    loop.add_writer.assert_called_once_with(
+        sock.fileno.return_value,
+        transport._write_ready,
+    )
+    transport.close()
+    assert loop.call_soon.called is False
+    sock.send.side_effect = [4, 12]
+    transport._write_ready()
+    assert sock.send.call_args_list[-2][0][0] == b"250 OK\r\n250 OK\r\n"
+    assert sock.send.call_args_list[-1][0][0] == b"OK\r\n250 OK\r\n"
+    assert transport.get_write_buffer_size() == 0
+    assert protocol.resume_writing.call_count == 1
+    assert loop.remove_writer.called is True
+    sock.unwrap.assert_called_once_with()
+    protocol.connection_lost.assert_called_once_with(None)
+    sock.close.assert_called_once_with()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_socket_transport_abort():
+    sock, protocol, loop = mock.Mock(), mock.Mock(), mock.Mock()
+    transport = SocketTLSTransport(sock, protocol, loop)
+    transport.abort()
+    assert transport.is_closing() is True
+    loop.call_soon.assert_called_once_with(
+        transport._call_connection_lost,
+        None,
+    )
+    transport._call_connection_lost(None)
+    transport._call_connection_lost(None)
+    protocol.connection_lost.assert_called_once_with(None)
+    sock.close.assert_called_once_with()
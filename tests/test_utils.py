@@ -28,7 +28,14 @@
 
 import pytest
 
-from blackhole.utils import get_version, mailname, message_id
+from blackhole.utils import (
+    cpu_list,
+    get_version,
+    ktls_available,
+    mailname,
+    message_id,
+    rss,
+)
 
 
 from ._utils import (  # noqa: F401; isort:skip
@@ -175,3 +182,57 @@ def test_get_version_version_not_found():
     ) as err:
         get_version()
     assert str(err.value) == "No __version__ assignment found"
+
+
+def test_cpu_list():
+    assert cpu_list("3") == (3,)
+    assert cpu_list("0-3,8") == (0, 1, 2, 3, 8)
+    assert cpu_list("8,0-1") == (8, 0, 1)
+
+
+@pytest.mark.parametrize("value", ("", "a", "3-1", "-1", "0,,1"))
+def test_cpu_list_invalid(value):
+    with pytest.raises(ValueError):
+        cpu_list(value)
+
+
+def test_rss():
+    assert rss() > 0
+
+
+def test_rss_no_proc():
+    usage = mock.Mock(ru_maxrss=1000)
+    with mock.patch("builtins.open", side_effect=OSError), mock.patch(
+        "resource.getrusage",
+        return_value=usage,
+    ), mock.patch("sys.platform", "linux"):
+        assert rss() == 1024000
+
+
+@pytest.mark.parametrize(
+    "ulp, expected",
+    (("mptcp tls\n", True), ("mptcp\n", False), ("", False)),
+)
+def test_ktls_available(ulp, expected):
+    with mock.patch("builtins.open", return_value=StringIO(ulp)), mock.patch(
+        "ssl.OPENSSL_VERSION_INFO",
+        (3, 0, 0, 0, 0),
+    ):
+        assert ktls_available() is expected
+
+
+def test_ktls_available_no_proc():
+    with mock.patch("builtins.open", side_effect=OSError), mock.patch(
+        "ssl.OPENSSL_VERSION_INFO",
+        (3, 0, 0, 0, 0),
+    ):
+        assert ktls_available() is False
+
+
+def test_ktls_available_old_openssl():
+    with mock.patch("builtins.open") as mock_open, mock.patch(
+        "ssl.OPENSSL_VERSION_INFO",
+        (1, 1, 1, 0, 0),
+    ):
+        assert ktls_available() is False
+    assert mock_open.called is False
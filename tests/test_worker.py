@@ -24,11 +24,15 @@
 
 
 import asyncio
+import os
+import signal
 from unittest import mock
 
 import pytest
 
+from blackhole import protocols
 from blackhole.config import Config
+from blackhole.protocols import Stats
 from blackhole.worker import Worker
 
 
@@ -48,10 +52,284 @@ async def test_start_stop(event_loop):
     worker = Worker(1, [], loop=event_loop)
     assert worker._started is True
     await asyncio.sleep(10)
-    worker.stop()
+    await worker.stop()
     assert worker._started is False
 
 
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_update_stats(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    stats = Stats()
+    stats.cpu = 1.0
+    with mock.patch("time.monotonic", side_effect=(10.0, 20.0, 30.0)):
+        worker.update_stats(stats)
+        assert worker.cpu is None
+        stats.connections, stats.lag, stats.cpu = 5, 0.2, 6.0
+        worker.update_stats(stats)
+        assert worker.cpu == 0.5
+        stats.cpu = 16.0
+        worker.update_stats(stats)
+    assert worker.cpu == pytest.approx(0.6)
+    assert worker.connections == 5
+    assert worker.lag == 0.2
+    assert worker.stats is stats
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_send(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.writer = mock.Mock()
+    worker.send(protocols.DRAIN)
+    worker.writer.write.assert_called_once_with(
+        protocols.frame(protocols.DRAIN),
+    )
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_set_ticket_keys(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.set_ticket_keys(b"keys")
+    assert worker.ticket_keys == b"keys"
+    worker.writer = mock.Mock()
+    worker.set_ticket_keys(b"new keys")
+    worker.writer.write.assert_called_once_with(
+        protocols.frame(protocols.TICKETS, b"new keys"),
+    )
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_drain(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.heartbeat_task = mock.Mock()
+    worker.writer = mock.Mock()
+    worker.connections = 0
+    with mock.patch("asyncio.sleep") as mock_sleep:
+        await worker.drain()
+    assert mock_sleep.call_count == 1
+    assert worker.heartbeat_task.cancel.called is True
+    worker.writer.write.assert_called_once_with(
+        protocols.frame(protocols.DRAIN),
+    )
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_drain_timeout(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.heartbeat_task = mock.Mock()
+    worker.writer = mock.Mock()
+    worker.connections = 5
+    with mock.patch("asyncio.sleep") as mock_sleep, mock.patch(
+        "time.monotonic",
+        side_effect=(0.0, 30.0, 61.0),
+    ):
+        await worker.drain()
+    assert mock_sleep.call_count == 1
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_kill_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid = 1234
+    with mock.patch("os.kill") as mock_kill, mock.patch(
+        "os.waitpid",
+        side_effect=((0, 0), (1234, 0)),
+    ), mock.patch("asyncio.sleep") as mock_sleep:
+        event_loop.run_until_complete(worker.kill_child())
+    mock_kill.assert_called_once_with(1234, signal.SIGTERM)
+    mock_sleep.assert_called_once_with(worker.kill_interval)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_kill_child_timeout(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid = 1234
+    with mock.patch("os.kill") as mock_kill, mock.patch(
+        "os.waitpid",
+        side_effect=((0, 0), (0, 0), (0, 0), (1234, 9)),
+    ), mock.patch("asyncio.sleep"), mock.patch(
+        "time.monotonic",
+        side_effect=(0.0, 30.0, 62.0),
+    ):
+        event_loop.run_until_complete(worker.kill_child())
+    assert mock_kill.call_args_list == [
+        mock.call(1234, signal.SIGTERM),
+        mock.call(1234, signal.SIGKILL),
+    ]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_kill_does_not_block(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.kill_interval = 0
+    ticks = []
+    exited = []
+
+    def waitpid(pid, options):
+        assert options == os.WNOHANG
+        return (pid, 0) if exited else (0, 0)
+
+    async def tick():
+        for _ in range(3):
+            ticks.append(None)
+            await asyncio.sleep(0)
+        exited.append(True)
+
+    with mock.patch("os.kill"), mock.patch("os.waitpid", side_effect=waitpid):
+        event_loop.run_until_complete(
+            asyncio.gather(worker.kill(1234), tick()),
+        )
+    assert len(ticks) == 3
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_restart_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid, worker.recycling = 1234, []
+    with mock.patch("os.kill") as mock_kill, mock.patch(
+        "os.waitpid",
+    ) as mock_waitpid, mock.patch(
+        "blackhole.worker.Worker.replace_child",
+    ) as mock_replace:
+        worker.restart_child()
+    mock_kill.assert_called_once_with(1234, signal.SIGKILL)
+    assert mock_waitpid.called is False
+    assert mock_replace.call_count == 1
+    assert worker.recycling == [1234]
+    with mock.patch("os.kill", side_effect=ProcessLookupError), mock.patch(
+        "blackhole.worker.Worker.replace_child",
+    ):
+        worker.restart_child()
+    assert worker.recycling == [1234]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_stop(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started, worker.pid, worker.recycling = True, 1234, [1235]
+    worker.spares = []
+    killed = []
+
+    async def kill(pid, sig=signal.SIGTERM):
+        assert worker._started is False
+        killed.append(pid)
+
+    with mock.patch.object(worker, "kill", side_effect=kill), mock.patch(
+        "blackhole.worker.Worker.disconnect",
+    ) as mock_disconnect:
+        event_loop.run_until_complete(worker.stop())
+    assert sorted(killed) == [1234, 1235]
+    assert worker.recycling == []
+    assert mock_disconnect.call_count == 1
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_fork(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    with mock.patch("gc.freeze") as mock_freeze, mock.patch(
+        "gc.unfreeze",
+    ) as mock_unfreeze, mock.patch("os.fork", return_value=1234):
+        assert worker.fork() == 1234
+    assert mock_freeze.called is True
+    assert mock_unfreeze.called is True
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_fork_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    with mock.patch("gc.freeze") as mock_freeze, mock.patch(
+        "gc.unfreeze",
+    ) as mock_unfreeze, mock.patch("os.fork", return_value=0):
+        assert worker.fork() == 0
+    assert mock_freeze.called is True
+    assert mock_unfreeze.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_running(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid = 1234
+    with mock.patch("os.waitpid", return_value=(0, 0)), mock.patch(
+        "os.fork",
+    ) as mock_fork:
+        worker.reap()
+    assert mock_fork.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_exited(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.pid, worker.ping_count, worker.cpu = 1234, 5, 0.5
+    with mock.patch("os.waitpid", return_value=(1234, 9)), mock.patch(
+        "os.fork",
+        return_value=1235,
+    ) as mock_fork, mock.patch(
+        "blackhole.worker.Worker.watch_child",
+    ) as mock_watch, mock.patch(
+        "os.kill",
+    ) as mock_kill:
+        worker.reap()
+    assert mock_fork.call_count == 1
+    assert mock_watch.call_count == 1
+    assert mock_kill.called is False
+    assert worker.pid == 1235
+    assert worker.ping_count == 0
+    assert worker.cpu is None
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_stopped(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid = 1234
+    with mock.patch("os.waitpid", return_value=(1234, 0)), mock.patch(
+        "os.fork",
+    ) as mock_fork:
+        worker.reap()
+    assert mock_fork.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_already_reaped(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.pid = 1234
+    with mock.patch("os.waitpid", side_effect=ChildProcessError), mock.patch(
+        "os.fork",
+    ) as mock_fork:
+        worker.reap()
+    assert mock_fork.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.skipif(not hasattr(os, "pidfd_open"), reason="No pidfd support")
+def test_watch_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid = os.getpid()
+    worker.watch_child()
+    assert worker._pidfd is not None
+    worker.unwatch_child()
+    assert worker._pidfd is None
+
+
 @pytest.mark.usefixtures("reset", "cleandir")
 def test_child_start_setgid_fails_invalid_group(event_loop):
     cfile = create_config(
@@ -126,3 +404,191 @@ def test_child_start_setuid_fails_permissions(event_loop):
     ) as exc:
         Worker([], [], loop=event_loop)
     assert exc.value.code == 64
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_spawn_spare(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.spares = []
+    with mock.patch("os.pipe", side_effect=((10, 11), (12, 13))), mock.patch(
+        "os.fork",
+        return_value=1235,
+    ):
+        worker.spawn_spare()
+    assert worker.spares == [(1235, 10, 11, 12, 13)]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_spawn_spare_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.spares = []
+    with mock.patch("os.pipe", side_effect=((10, 11), (12, 13))), mock.patch(
+        "os.fork",
+        return_value=0,
+    ), mock.patch("blackhole.worker.Worker.setup_child") as mock_setup:
+        worker.spawn_spare()
+    mock_setup.assert_called_once_with(spare=True)
+    assert (worker.up_read, worker.down_write) == (10, 13)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_replace_child_without_spares(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    with mock.patch(
+        "blackhole.worker.Worker.spawn_child",
+    ) as mock_spawn, mock.patch(
+        "blackhole.worker.Worker.promote_spare",
+    ) as mock_promote:
+        worker.replace_child()
+    assert mock_spawn.called is True
+    assert mock_promote.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_promote_spare(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.pid, worker.up_read, worker.down_write = 1234, 1, 4
+    worker.spares = [(1235, 10, 11, 12, 13), (1236, 14, 15, 16, 17)]
+    with mock.patch("blackhole.worker.Worker.disconnect"), mock.patch(
+        "os.close",
+    ) as mock_close, mock.patch(
+        "blackhole.worker.Worker.watch_child",
+    ), mock.patch(
+        "asyncio.ensure_future",
+    ) as mock_future, mock.patch(
+        "blackhole.worker.Worker.serve_spare",
+        new_callable=mock.Mock,
+    ):
+        worker.replace_child()
+    assert mock_close.call_args_list == [mock.call(1), mock.call(4)]
+    assert mock_future.called is True
+    assert worker.pid == 1235
+    assert (worker.up_read, worker.up_write) == (10, 11)
+    assert (worker.down_read, worker.down_write) == (12, 13)
+    assert worker.spares == [(1236, 14, 15, 16, 17)]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_serve_spare(event_loop):
+    cfile = create_config(("spare_children=1",))
+    Config(cfile).load()
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.writer = mock.Mock()
+    with mock.patch("blackhole.worker.Worker.connect"), mock.patch(
+        "blackhole.worker.Worker.spawn_spare",
+    ) as mock_spawn:
+        await worker.serve_spare()
+    worker.writer.write.assert_called_once_with(
+        protocols.frame(protocols.SERVE),
+    )
+    assert mock_spawn.called is True
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_spares(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.spares = [(1235, 10, 11, 12, 13), (1236, 14, 15, 16, 17)]
+    with mock.patch(
+        "os.waitpid",
+        side_effect=((0, 0), (1236, 9)),
+    ), mock.patch("os.close") as mock_close, mock.patch(
+        "blackhole.worker.Worker.spawn_spare",
+    ) as mock_spawn:
+        worker.reap_spares()
+    assert worker.spares == [(1235, 10, 11, 12, 13)]
+    assert mock_close.call_count == 4
+    assert mock_spawn.call_count == 1
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_stop_spares(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.spares = [(1235, 10, 11, 12, 13)]
+    with mock.patch("os.kill") as mock_kill, mock.patch(
+        "os.waitpid",
+    ), mock.patch("os.close") as mock_close:
+        worker.stop_spares()
+    mock_kill.assert_called_once_with(1235, signal.SIGKILL)
+    assert mock_close.call_count == 4
+    assert worker.spares == []
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_serve_spare_enough_spares(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker._started = True
+    worker.writer = mock.Mock()
+    with mock.patch("blackhole.worker.Worker.connect"), mock.patch(
+        "blackhole.worker.Worker.spawn_spare",
+    ) as mock_spawn:
+        await worker.serve_spare()
+    assert mock_spawn.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle_child(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid, worker.spares, worker.recycling = 1234, [], []
+    with mock.patch(
+        "blackhole.worker.Worker.spawn_spare",
+    ) as mock_spawn, mock.patch(
+        "blackhole.worker.Worker.promote_spare",
+    ) as mock_promote:
+        worker.recycle_child("10 connections")
+    assert mock_spawn.called is True
+    assert mock_promote.called is True
+    assert worker.recycling == [1234]
+    assert worker.recycled == 1
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_recycle_child_spare(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid, worker.recycling = 1234, []
+    worker.spares = [(1235, 10, 11, 12, 13)]
+    with mock.patch(
+        "blackhole.worker.Worker.spawn_spare",
+    ) as mock_spawn, mock.patch("blackhole.worker.Worker.promote_spare"):
+        worker.recycle_child("10 connections")
+    assert mock_spawn.called is False
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_reap_recycled(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.recycling = [1235, 1236, 1237]
+    with mock.patch(
+        "os.waitpid",
+        side_effect=((0, 0), (1236, 0), ChildProcessError),
+    ):
+        worker.reap_recycled()
+    assert worker.recycling == [1235]
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_terminate_recycling(event_loop):
+    with mock.patch("blackhole.worker.Worker.start"):
+        worker = Worker("1", [], loop=event_loop)
+    worker.pid, worker.recycling = 1234, [1235]
+    with mock.patch("os.kill", side_effect=(None, ProcessLookupError)) as k:
+        worker.terminate()
+    assert k.call_args_list == [
+        mock.call(1234, signal.SIGTERM),
+        mock.call(1235, signal.SIGTERM),
+    ]
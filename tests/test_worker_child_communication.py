@@ -29,6 +29,7 @@
 
 import pytest
 
+from blackhole import protocols
 from blackhole.control import server
 from blackhole.worker import Worker
 
@@ -82,3 +83,38 @@ async def test_restart(unused_tcp_port, event_loop):
     assert worker.ping > started
     assert worker.ping_count == 0
     aserver["sock"].close()
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+@pytest.mark.asyncio
+async def test_frame(event_loop):
+    reader = asyncio.StreamReader()
+    reader.feed_data(protocols.frame(protocols.PING))
+    reader.feed_data(protocols.frame(protocols.RECYCLE, b"10 connections"))
+    assert await protocols.read_frame(reader) == (protocols.PING, b"")
+    assert await protocols.read_frame(reader) == (
+        protocols.RECYCLE,
+        b"10 connections",
+    )
+    reader.feed_eof()
+    with pytest.raises(asyncio.IncompleteReadError):
+        await protocols.read_frame(reader)
+
+
+@pytest.mark.usefixtures("reset", "cleandir")
+def test_stats():
+    stats = protocols.Stats()
+    stats.connections, stats.messages, stats.bytes = 3, 2, 1024
+    stats.lag, stats.cpu = 0.25, 1.5
+    stats.drained, stats.cut = 6, 1
+    stats.codes[250] += 4
+    stats.codes[421] += 1
+    unpacked = protocols.Stats.unpack(stats.pack())
+    assert unpacked.connections == 3
+    assert unpacked.messages == 2
+    assert unpacked.bytes == 1024
+    assert unpacked.lag == 0.25
+    assert unpacked.cpu == 1.5
+    assert unpacked.drained == 6
+    assert unpacked.cut == 1
+    assert unpacked.codes == {250: 4, 421: 1}